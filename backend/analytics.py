@@ -17,16 +17,29 @@ sessionStorage id generated client-side.
 from __future__ import annotations
 
 import asyncio
+import collections
+import contextlib
 import datetime as _dt
+import glob
 import hashlib
+import heapq
 import json
 import logging
 import os
+import pathlib
+import random
 import re
 import secrets
-from typing import Any, Dict, List, Optional, Tuple
+import struct
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
 from urllib.parse import urlparse, parse_qs
 
+import funnels
+from live import LiveWindow
+from pages import page_class
+from sketches import HLL, TopK
+
 logger = logging.getLogger("onda.analytics")
 
 EVENT_TYPES = {
@@ -37,44 +50,344 @@ EVENT_TYPES = {
     "form_view",
     "form_submit",
 }
+# Under overload these are kept 1-in-SAMPLE_1_IN (stored with that weight);
+# pageview and form_submit are never shed, not even when the queue is full
+# (nor is an event that sets a new funnel/goal step of its session).
+SAMPLED_TYPES = {"scroll", "nav_click"}
+ALWAYS_KEEP = {"pageview", "form_submit"}
 
 _BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 _DEFAULT_SQLITE = os.path.join(_BASE_DIR, "backend", "analytics.db")
 
+# The repeated strings of an event (_DICT_COLUMNS) are stored as ids into
+# `dims`; readers see the decoded values through AnalyticsDB._sources().
 _SCHEMA_SQLITE = """
 CREATE TABLE IF NOT EXISTS events (
     id           INTEGER PRIMARY KEY AUTOINCREMENT,
     ts           TEXT NOT NULL,
     day          TEXT NOT NULL,
     event_type   TEXT NOT NULL,
-    session_id   TEXT,
-    visitor_hash TEXT,
-    page         TEXT,
-    lang         TEXT,
-    referrer_host TEXT,
-    utm_source   TEXT,
-    device       TEXT,
-    country      TEXT,
+    session_id   INTEGER,
+    visitor_hash INTEGER,
+    page         INTEGER,
+    lang         INTEGER,
+    referrer_host INTEGER,
+    utm_source   INTEGER,
+    device       INTEGER,
+    country      INTEGER,
     scroll_depth INTEGER,
-    meta         TEXT
+    meta         TEXT,
+    weight       INTEGER,
+    page_class   TEXT
 );
 """
 _SCHEMA_PG = _SCHEMA_SQLITE.replace(
     "INTEGER PRIMARY KEY AUTOINCREMENT", "BIGSERIAL PRIMARY KEY"
 )
+# Dictionary of the encoded strings: one id per (column, value). Lives in the
+# main DB (SQLite partition files refer to it).
+_SCHEMA_DIMS = """
+CREATE TABLE IF NOT EXISTS dims (
+    id    INTEGER PRIMARY KEY,
+    kind  TEXT NOT NULL,
+    value TEXT NOT NULL,
+    UNIQUE (kind, value)
+);
+"""
+_SCHEMA_DIMS_PG = _SCHEMA_DIMS.replace("INTEGER PRIMARY KEY", "SERIAL PRIMARY KEY")
+# The (..., day, id) indexes serve the event explorer's keyset pages (see
+# AnalyticsDB.events) as well as plain day-range scans; they supersede the
+# older single-column/(type, day) ones in _SUPERSEDED_INDEXES, which a one-off
+# migration drops where they still exist.
 _INDEXES = [
-    "CREATE INDEX IF NOT EXISTS idx_events_day ON events(day)",
-    "CREATE INDEX IF NOT EXISTS idx_events_type_day ON events(event_type, day)",
-    "CREATE INDEX IF NOT EXISTS idx_events_session ON events(session_id)",
+    "CREATE INDEX IF NOT EXISTS idx_events_day_id ON events(day, id)",
+    "CREATE INDEX IF NOT EXISTS idx_events_type_day_id ON events(event_type, day, id)",
+    "CREATE INDEX IF NOT EXISTS idx_events_session_day ON events(session_id, day, id)",
+    "CREATE INDEX IF NOT EXISTS idx_events_page_day ON events(page, day, id)",
+    "CREATE INDEX IF NOT EXISTS idx_events_class_day ON events(page_class, day, id)",
     "CREATE INDEX IF NOT EXISTS idx_events_visitor ON events(visitor_hash, day)",
 ]
+_SUPERSEDED_INDEXES = ("idx_events_day", "idx_events_type_day", "idx_events_session")
+# Postgres with ANALYTICS_PARTITION=month|day: events is a declarative range
+# partitioned table on `day` (the PK has to include the partition key).
+_SCHEMA_PG_PARTITIONED = _SCHEMA_PG.replace(
+    "BIGSERIAL PRIMARY KEY", "BIGSERIAL"
+).replace("\n);", ",\n    PRIMARY KEY (id, day)\n) PARTITION BY RANGE (day);")
+# Columns added after the first release: (name, type), added on connect to
+# tables created by an older schema.
+_ADDED_COLUMNS = [
+    ("weight", "INTEGER"),  # sampling weight; NULL means 1
+    ("page_class", "TEXT"),  # pages.page_class(page), set at ingest
+]
+
+# Per-day aggregates upserted with every ingest batch, same SQL on both
+# backends: agg_dims (pageview hits per breakdown value), agg_counts, and
+# agg_hll (HyperLogLog registers for the distinct counts, see sketches.py).
+# They outlive raw events, so the dashboard keeps covering days dropped by
+# retention.
+_SCHEMA_AGG = """
+CREATE TABLE IF NOT EXISTS agg_dims (
+    day          TEXT NOT NULL,
+    dim          TEXT NOT NULL,
+    value        TEXT NOT NULL,
+    hits         INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, dim, value)
+);
+CREATE INDEX IF NOT EXISTS idx_agg_dims_dim_day ON agg_dims (dim, day);
+CREATE TABLE IF NOT EXISTS agg_counts (
+    day          TEXT PRIMARY KEY,
+    pageviews    INTEGER NOT NULL DEFAULT 0,
+    leads        INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS agg_hll (
+    day          TEXT NOT NULL,
+    kind         TEXT NOT NULL,
+    regs         BLOB NOT NULL,
+    PRIMARY KEY (day, kind)
+);
+CREATE TABLE IF NOT EXISTS agg_hours (
+    day          TEXT NOT NULL,
+    hour         INTEGER NOT NULL,
+    pageviews    INTEGER NOT NULL DEFAULT 0,
+    leads        INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, hour)
+);
+CREATE TABLE IF NOT EXISTS agg_topk (
+    day          TEXT NOT NULL,
+    dim          TEXT NOT NULL,
+    summary      TEXT NOT NULL,
+    PRIMARY KEY (day, dim)
+);
+CREATE TABLE IF NOT EXISTS agg_edges (
+    day          TEXT NOT NULL,
+    src          INTEGER NOT NULL,
+    dst          INTEGER NOT NULL,
+    n            INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, src, dst)
+);
+"""
+_SCHEMA_AGG_PG = _SCHEMA_AGG.replace("BLOB", "BYTEA")
 
-_INSERT = """
-INSERT INTO events
- (ts, day, event_type, session_id, visitor_hash, page, lang,
-  referrer_host, utm_source, device, country, scroll_depth, meta)
-VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
+# Per-session state, one row per session, upserted with every batch like the
+# rollups and, like them, kept past raw-event retention. funnel(),
+# session_stats() and entry_pages() read it instead of raw events. `day` is
+# the day the session started (reads attribute a session to it); session_id
+# and entry/exit_page are dims ids; first/last_ts are unix seconds (a duration
+# is a plain subtraction on both backends); bit i of steps is set once one of
+# the session's events matched the funnel/goal condition of bit i in `flags`.
+_SCHEMA_SESSIONS = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id   INTEGER PRIMARY KEY,
+    day          TEXT NOT NULL,
+    first_ts     BIGINT NOT NULL,
+    last_ts      BIGINT NOT NULL,
+    entry_page   INTEGER,
+    exit_page    INTEGER,
+    pageviews    INTEGER NOT NULL DEFAULT 0,
+    max_scroll   INTEGER NOT NULL DEFAULT 0,
+    steps        BIGINT NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_day ON sessions (day);
+CREATE TABLE IF NOT EXISTS flags (
+    bit          INTEGER PRIMARY KEY,
+    matcher      TEXT NOT NULL UNIQUE
+);
 """
+_MAX_FLAGS = 63  # bits of a signed BIGINT
+
+# Funnels and goals (see funnels.py), compiled at startup. Sketched distinct
+# counts are visitors and sessions per day, plus visitors per UTC hour (kind
+# "visitors:HH", next to the agg_hours counts); days from before the sessions
+# table also have sketches of the funnels.LEGACY steps, which funnels() falls
+# back to.
+FUNNELS_PATH = os.getenv(
+    "ANALYTICS_FUNNELS", os.path.join(_BASE_DIR, "backend", "funnels.json")
+)
+_SKETCHES = ("visitors", "sessions")
+_HOURLY_SKETCH = "visitors:"
+_EXPLORE_CLASSES = ("portfolio", "process", "example")
+BREAKDOWN_FIELDS = ("page", "referrer_host", "device", "country", "lang", "utm_source",
+                    "page_class")
+# Top-N panels of these open-ended dimensions read per-day Space-Saving
+# summaries (agg_topk, see sketches.TopK) of TOPK_CAPACITY values each, so a
+# wave of millions of distinct spam referrers costs the same to read as a
+# quiet day. Exact while a day has at most TOPK_CAPACITY distinct values;
+# past that, counts of the top values are upper bounds. Each batch merges
+# into them in its own transaction, like the agg_hll sketches.
+TOPK_FIELDS = ("page", "referrer_host", "utm_source")
+TOPK_CAPACITY = int(os.getenv("ANALYTICS_TOPK_CAPACITY", "200"))
+# Equality filters of the raw event explorer (AnalyticsDB.events).
+EVENT_FILTERS = ("event_type", "page", "page_class", "session_id", "device", "country")
+
+# Rollup upserts; the backfill variants aggregate existing raw rows ({src}).
+_UPSERT_DIM = (
+    "INSERT INTO agg_dims (day, dim, value, hits) VALUES (?, ?, ?, ?)"
+    " ON CONFLICT (day, dim, value) DO UPDATE SET hits = agg_dims.hits + excluded.hits"
+)
+_UPSERT_COUNTS = (
+    "INSERT INTO agg_counts (day, pageviews, leads) VALUES (?, ?, ?)"
+    " ON CONFLICT (day) DO UPDATE SET pageviews = agg_counts.pageviews + excluded.pageviews,"
+    " leads = agg_counts.leads + excluded.leads"
+)
+_UPSERT_HOURS = (
+    "INSERT INTO agg_hours (day, hour, pageviews, leads) VALUES (?, ?, ?, ?)"
+    " ON CONFLICT (day, hour) DO UPDATE SET pageviews = agg_hours.pageviews + excluded.pageviews,"
+    " leads = agg_hours.leads + excluded.leads"
+)
+# Page-to-page transitions (agg_edges: dims ids of the pages): a pageview of
+# dst on `day` whose session was last on src. Within a batch src comes from
+# the session's previous event; for a session's first pageview in a batch,
+# from its `sessions` row (exit_page), so that statement has to run before
+# the batch's session upserts.
+_UPSERT_EDGE = (
+    "INSERT INTO agg_edges (day, src, dst, n) VALUES (?, ?, ?, ?)"
+    " ON CONFLICT (day, src, dst) DO UPDATE SET n = agg_edges.n + excluded.n"
+)
+_UPSERT_EDGE_FROM_SESSION = (
+    "INSERT INTO agg_edges (day, src, dst, n)"
+    " SELECT ?, exit_page, ?, 1 FROM sessions WHERE session_id = ?"
+    " AND exit_page IS NOT NULL AND exit_page <> ? AND last_ts <= ?"
+    " ON CONFLICT (day, src, dst) DO UPDATE SET n = agg_edges.n + excluded.n"
+)
+_UPSERT_TOPK = (
+    "INSERT INTO agg_topk (day, dim, summary) VALUES (?, ?, ?)"
+    " ON CONFLICT (day, dim) DO UPDATE SET summary = excluded.summary"
+)
+_UPSERT_HLL = (
+    "INSERT INTO agg_hll (day, kind, regs) VALUES (?, ?, ?)"
+    " ON CONFLICT (day, kind) DO UPDATE SET regs = excluded.regs"
+)
+# Folds a batch's partial session into the stored one: earliest entry,
+# latest exit, summed pageviews, deepest scroll, OR of the step bits.
+_UPSERT_SESSION = (
+    "INSERT INTO sessions (session_id, day, first_ts, last_ts, entry_page, exit_page,"
+    " pageviews, max_scroll, steps) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    " ON CONFLICT (session_id) DO UPDATE SET"
+    " day = CASE WHEN excluded.first_ts < sessions.first_ts"
+    " THEN excluded.day ELSE sessions.day END,"
+    " first_ts = CASE WHEN excluded.first_ts < sessions.first_ts"
+    " THEN excluded.first_ts ELSE sessions.first_ts END,"
+    " entry_page = CASE WHEN excluded.first_ts < sessions.first_ts"
+    " THEN excluded.entry_page ELSE sessions.entry_page END,"
+    " last_ts = CASE WHEN excluded.last_ts >= sessions.last_ts"
+    " THEN excluded.last_ts ELSE sessions.last_ts END,"
+    " exit_page = CASE WHEN excluded.last_ts >= sessions.last_ts"
+    " THEN excluded.exit_page ELSE sessions.exit_page END,"
+    " pageviews = sessions.pageviews + excluded.pageviews,"
+    " max_scroll = CASE WHEN excluded.max_scroll > sessions.max_scroll"
+    " THEN excluded.max_scroll ELSE sessions.max_scroll END,"
+    " steps = sessions.steps | excluded.steps"
+)
+_BACKFILL_DIM = (
+    "INSERT INTO agg_dims (day, dim, value, hits)"
+    " SELECT day, '{f}', COALESCE({f}, 'direct'), SUM(COALESCE(weight, 1))"
+    " FROM {src} WHERE event_type='pageview'"
+    " GROUP BY day, COALESCE({f}, 'direct')"
+    " ON CONFLICT (day, dim, value) DO UPDATE SET hits = agg_dims.hits + excluded.hits"
+)
+_BACKFILL_COUNTS = (
+    "INSERT INTO agg_counts (day, pageviews, leads)"
+    " SELECT day,"
+    " SUM(CASE WHEN event_type='pageview' THEN COALESCE(weight, 1) ELSE 0 END),"
+    " SUM(CASE WHEN event_type='form_submit' THEN COALESCE(weight, 1) ELSE 0 END)"
+    " FROM {src} WHERE event_type IN ('pageview', 'form_submit') GROUP BY day"
+    " ON CONFLICT (day) DO UPDATE SET pageviews = agg_counts.pageviews + excluded.pageviews,"
+    " leads = agg_counts.leads + excluded.leads"
+)
+_BACKFILL_HOURS = (
+    "INSERT INTO agg_hours (day, hour, pageviews, leads)"
+    " SELECT day, CAST(SUBSTR(ts, 12, 2) AS INTEGER),"
+    " SUM(CASE WHEN event_type='pageview' THEN COALESCE(weight, 1) ELSE 0 END),"
+    " SUM(CASE WHEN event_type='form_submit' THEN COALESCE(weight, 1) ELSE 0 END)"
+    " FROM {src} WHERE event_type IN ('pageview', 'form_submit')"
+    " GROUP BY day, CAST(SUBSTR(ts, 12, 2) AS INTEGER)"
+    " ON CONFLICT (day, hour) DO UPDATE SET pageviews = agg_hours.pageviews + excluded.pageviews,"
+    " leads = agg_hours.leads + excluded.leads"
+)
+
+# Time partitioning of raw events: "none" (one table), "month" or "day".
+# Postgres uses declarative range partitions created PARTITION_AHEAD periods
+# in advance; SQLite keeps one database file per month (always monthly), next
+# to the main file and ATTACHed on demand. With RETENTION_DAYS > 0, whole
+# partitions older than that are dropped (unpartitioned: a DELETE by day).
+PARTITION = os.getenv("ANALYTICS_PARTITION", "none").strip().lower()
+PARTITION_AHEAD = int(os.getenv("ANALYTICS_PARTITION_AHEAD", "2"))
+RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "0"))
+MAINTENANCE_INTERVAL = 3600.0  # partition creation + retention, seconds
+_ATTACH_MAX = 8  # SQLite allows 10 attached databases per connection
+
+# Durable spool: batches that cannot reach the DB (down at startup, connection
+# blip, failed insert) are appended here and replayed once it is back.
+# Set ANALYTICS_SPOOL= (empty) to disable.
+SPOOL_PATH = os.getenv(
+    "ANALYTICS_SPOOL", os.path.join(_BASE_DIR, "backend", "analytics.spool")
+)
+RECONNECT_INTERVAL = float(os.getenv("ANALYTICS_RECONNECT_S", "15"))
+
+# Dashboard result cache: aggregates over closed days (before today, UTC) never
+# change, so they are kept in an LRU of CACHE_SIZE entries (0 disables) and
+# optionally persisted to CACHE_PATH across restarts. Only today is read live.
+CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", "512"))
+CACHE_PATH = os.getenv("ANALYTICS_CACHE_PATH", "")
+
+# Write-behind ingest: track() only enqueues; one background task drains the
+# queue in batches (flushed on size or age), so a spike costs one commit per
+# batch instead of one fsync per beacon.
+QUEUE_MAX = int(os.getenv("ANALYTICS_QUEUE_MAX", "10000"))
+BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", "200"))
+FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_MS", "500")) / 1000.0
+_STOP = object()  # queue sentinel: flush what is pending and exit
+
+# Load shedding: once the queue is SHED_AT full, SAMPLED_TYPES are sampled,
+# except for events that give their session a new funnel/goal step bit.
+SHED_AT = float(os.getenv("ANALYTICS_SHED_AT", "0.5"))
+SAMPLE_1_IN = max(1, int(os.getenv("ANALYTICS_SAMPLE_1_IN", "10")))
+_SHED_SESSIONS = 50000  # sessions whose step bits shedding remembers
+
+# SQLite runs in WAL mode with one writer connection (serialised by _lock) and
+# this many read-only connections, so dashboard scans never wait on ingest.
+SQLITE_READERS = int(os.getenv("ANALYTICS_SQLITE_READERS", "4"))
+
+# "insert" = executemany of parameterised INSERTs (both backends);
+# "copy" = asyncpg binary COPY into events (Postgres only, falls back to insert).
+INGEST_MODE = os.getenv("ANALYTICS_INGEST_MODE", "insert").strip().lower()
+
+# Column order of every event row tuple (see AnalyticsDB._row).
+_COLUMNS = (
+    "ts", "day", "event_type", "session_id", "visitor_hash", "page", "lang",
+    "referrer_host", "utm_source", "device", "country", "scroll_depth", "meta",
+    "weight", "page_class",
+)
+_INSERT = (
+    f"INSERT INTO events ({', '.join(_COLUMNS)}) "
+    f"VALUES ({','.join('?' * len(_COLUMNS))})"
+)
+EVENT_COLUMNS = _COLUMNS  # public name, e.g. for exports of iter_events()
+# Dictionary-encoded columns. (value -> id) lookups are cached in-process in an
+# LRU of DICT_CACHE_SIZE entries, so ingest only goes to `dims` for new values.
+_DICT_COLUMNS = ("session_id", "visitor_hash", "page", "lang", "referrer_host",
+                 "utm_source", "device", "country")
+_DICT_IDX = [(c, _COLUMNS.index(c)) for c in _DICT_COLUMNS]
+DICT_CACHE_SIZE = int(os.getenv("ANALYTICS_DICT_CACHE", "50000"))
+# Decoded view of a raw events relation aliased `events`: its columns, and the
+# joins back to `dims` (dims.id is unique across kinds).
+_DECODED_COLS = "events.id, " + ", ".join(
+    f"d_{c}.value AS {c}" if c in _DICT_COLUMNS else f"events.{c}" for c in _COLUMNS
+)
+_DECODE_JOINS = "".join(
+    f" LEFT JOIN dims d_{c} ON d_{c}.id = events.{c}" for c in _DICT_COLUMNS
+)
+_TS = _COLUMNS.index("ts")
+_DAY = _COLUMNS.index("day")
+_TYPE = _COLUMNS.index("event_type")
+_WEIGHT = _COLUMNS.index("weight")
+_DIM_IDX = [(f, _COLUMNS.index(f)) for f in BREAKDOWN_FIELDS]
+_TOPK_IDX = [(f, _COLUMNS.index(f)) for f in TOPK_FIELDS]
+_SESSION = _COLUMNS.index("session_id")
+_VISITOR = _COLUMNS.index("visitor_hash")
+_PAGE = _COLUMNS.index("page")
+_DEPTH = _COLUMNS.index("scroll_depth")
+_CLASS = _COLUMNS.index("page_class")
 
 # ---------------------------------------------------------------------------
 # Cookieless identity helpers
@@ -133,20 +446,257 @@ def utm_source_from(page: str, referrer: str) -> Optional[str]:
     return None
 
 
+# ---------------------------------------------------------------------------
+# Partition periods ("YYYYMM" for month, "YYYYMMDD" for day)
+# ---------------------------------------------------------------------------
+def _period(day: str, granularity: str) -> str:
+    return day[0:4] + day[5:7] + (day[8:10] if granularity == "day" else "")
+
+
+def _period_bounds(period: str) -> Tuple[str, str]:
+    """First day of the period and first day of the next one (exclusive)."""
+    y, m = int(period[0:4]), int(period[4:6])
+    if len(period) == 8:
+        d0 = _dt.date(y, m, int(period[6:8]))
+        return d0.isoformat(), (d0 + _dt.timedelta(days=1)).isoformat()
+    nxt = _dt.date(y + m // 12, m % 12 + 1, 1)
+    return _dt.date(y, m, 1).isoformat(), nxt.isoformat()
+
+
+def _unix(ts: str) -> int:
+    """Unix seconds of an event timestamp (UTC ISO-8601)."""
+    return int(_dt.datetime.fromisoformat(ts[:19]).replace(
+        tzinfo=_dt.timezone.utc).timestamp())
+
+
+def _periods(d0: str, d1: str, granularity: str) -> List[str]:
+    """Every period overlapping the inclusive day range [d0, d1]."""
+    out, day = [], d0
+    while day <= d1:
+        p = _period(day, granularity)
+        out.append(p)
+        day = _period_bounds(p)[1]
+    return out
+
+
+# ---------------------------------------------------------------------------
+# On-disk spool
+# ---------------------------------------------------------------------------
+class _Spool:
+    """Append-only file of length-prefixed JSON event rows.
+
+    Each append is one write + one fsync for the whole group of rows. Replay
+    first moves the live file aside (`<path>.replay`), so new appends never
+    race with rows that are being written back to the DB. All methods are
+    blocking and meant to run via asyncio.to_thread.
+    """
+
+    _LEN = struct.Struct(">I")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.replay_path = path + ".replay"
+
+    def append(self, rows: List[Tuple]) -> None:
+        self._write(self.path, "ab", rows)
+
+    def _write(self, path: str, mode: str, rows: List[Tuple]) -> None:
+        buf = bytearray()
+        for r in rows:
+            b = json.dumps(r, separators=(",", ":")).encode()
+            buf += self._LEN.pack(len(b)) + b
+        with open(path, mode) as f:
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def pending(self) -> bool:
+        return any(
+            os.path.exists(p) and os.path.getsize(p) > 0
+            for p in (self.path, self.replay_path)
+        )
+
+    def claim(self) -> List[Tuple]:
+        """Rows awaiting replay; moves the live spool aside if needed."""
+        if not os.path.exists(self.replay_path) and os.path.exists(self.path):
+            os.replace(self.path, self.replay_path)
+        return self._read(self.replay_path)
+
+    def settle(self, remaining: List[Tuple]) -> None:
+        """Record replay progress: keep only the rows not yet written."""
+        if not remaining:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.replay_path)
+            return
+        tmp = self.replay_path + ".tmp"
+        self._write(tmp, "wb", remaining)  # "wb": drop a tmp left by a crash
+        os.replace(tmp, self.replay_path)
+
+    def _read(self, path: str) -> List[Tuple]:
+        if not os.path.exists(path):
+            return []
+        with open(path, "rb") as f:
+            data = f.read()
+        rows, pos, n = [], 0, self._LEN.size
+        while pos + n <= len(data):
+            (size,) = self._LEN.unpack_from(data, pos)
+            if pos + n + size > len(data):
+                break  # torn tail from a crash mid-append
+            row = tuple(json.loads(data[pos + n:pos + n + size]))
+            if len(row) == _CLASS:  # spooled before page_class existed
+                row += (page_class(row[_PAGE]),)
+            rows.append(row)
+            pos += n + size
+        return rows
+
+
+# ---------------------------------------------------------------------------
+# Closed-day result cache
+# ---------------------------------------------------------------------------
+def _utc_today() -> str:
+    return _dt.datetime.utcnow().strftime("%Y-%m-%d")
+
+
+class _ResultCache:
+    """LRU of read results keyed by (kind, args..., d0, d1) tuples.
+
+    Only ranges made of closed days go in. A batch that lands on a closed day
+    (spool replay, the flush right after midnight) clears everything; the
+    generation counter stops a read that raced with that from storing its
+    stale result. Persistence is a JSON file written atomically on save().
+    """
+
+    def __init__(self, size: int, path: str = ""):
+        self.size = size
+        self.path = path
+        self.generation = 0
+        self._data: "collections.OrderedDict[Tuple, Any]" = collections.OrderedDict()
+        if path:
+            self._load()
+
+    def get(self, key: Tuple) -> Any:
+        val = self._data.get(key)
+        if val is not None:
+            self._data.move_to_end(key)
+        return val
+
+    def put(self, key: Tuple, val: Any) -> None:
+        self._data[key] = val
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._data.clear()
+
+    def discard(self, stale: Callable[[Tuple, Any], bool]) -> None:
+        """Drop the entries for which stale(key, value) holds."""
+        for key in [k for k, v in self._data.items() if stale(k, v)]:
+            del self._data[key]
+
+    @staticmethod
+    def _encode(o: Any) -> Any:
+        if isinstance(o, bytes):
+            return {"__hex__": o.hex()}
+        raise TypeError(type(o).__name__)
+
+    @staticmethod
+    def _decode(o: Dict[str, Any]) -> Any:
+        return bytes.fromhex(o["__hex__"]) if "__hex__" in o else o
+
+    @classmethod
+    def _tuple(cls, v: Any) -> Any:
+        return tuple(cls._tuple(x) for x in v) if isinstance(v, list) else v
+
+    def items(self) -> List[Tuple[Tuple, Any]]:
+        return list(self._data.items())
+
+    def save(self, items: Optional[List[Tuple[Tuple, Any]]] = None) -> None:
+        """Write `items` (default: a snapshot of now); safe in a thread."""
+        if not self.path:
+            return
+        items = self.items() if items is None else items
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump([[k, v] for k, v in items], f, default=self._encode)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning("Analytics cache not saved: %s", e)
+
+    def _load(self) -> None:
+        try:
+            with open(self.path) as f:
+                items = json.load(f, object_hook=self._decode)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Analytics cache not loaded: %s", e)
+            return
+        for k, v in items[-self.size:]:
+            self._data[self._tuple(k)] = v
+
+
 # ---------------------------------------------------------------------------
 # DB abstraction
 # ---------------------------------------------------------------------------
 class AnalyticsDB:
-    def __init__(self, database_url: Optional[str]):
+    def __init__(self, database_url: Optional[str],
+                 ingest_mode: Optional[str] = None):
         url = (database_url or "").strip()
         self.is_pg = url.startswith("postgres://") or url.startswith("postgresql://")
         self.url = url
+        self.ingest_mode = ingest_mode or INGEST_MODE
+        part = PARTITION if PARTITION in ("month", "day") else "none"
+        if not self.is_pg and part == "day":
+            part = "month"  # SQLite partitions are monthly files
+        self.partition = part
         self._pool = None          # asyncpg pool
-        self._sqlite = None        # aiosqlite connection
-        self._lock = asyncio.Lock()
+        self._sqlite = None        # aiosqlite writer connection
+        self._sqlite_path = ""
+        self._readers: Optional[asyncio.Queue] = None  # read-only aiosqlite pool
+        self._attached: Dict[int, "collections.OrderedDict[str, None]"] = {}
+        self._lock = asyncio.Lock()  # serialises use of the writer
+        # held from encoding a batch to its commit, and by _dims_gc: a batch
+        # never writes an id that GC deleted since it was looked up
+        self._dims_lock = asyncio.Lock()
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_MAX)
+        self._writer: Optional[asyncio.Task] = None
+        self._supervisor: Optional[asyncio.Task] = None
+        self._spool = _Spool(SPOOL_PATH) if SPOOL_PATH else None
+        self._spool_lock = asyncio.Lock()
+        self._overflow: List[Tuple] = []  # must-keep rows that hit a full queue
+        self.dropped = 0           # events lost to a full queue / bad batch
+        self.sampled = 0           # low-value events shed by sampling
+        self.spooled = 0           # events parked on disk while the DB was away
+        self._maint_lock = asyncio.Lock()
+        self._next_maintenance = 0.0
+        self._cache = _ResultCache(CACHE_SIZE, CACHE_PATH) if CACHE_SIZE > 0 else None
+        self._ids = _ResultCache(max(1, DICT_CACHE_SIZE))  # (kind, value) -> dims id
+        self._read_errors = 0      # failed reads; their empty results are not cached
+        self._closed_writes = 0    # writes that changed a closed day, see data_version
+        self._sessions_from: Optional[str] = None  # see _sessions_start
+        self.config = funnels.load(FUNNELS_PATH, _COLUMNS)
+        self._bits: Dict[str, int] = {}  # match key -> bit, see _flags_resolve
+        self._tags: List[Tuple[int, Any]] = []  # (1 << bit, predicate)
+        self._started_today: Tuple[str, set] = ("", set())  # see _sessions_reopened
+        self._shed_steps = _ResultCache(_SHED_SESSIONS)  # session -> bits, see _new_steps
+        self.live = LiveWindow()   # "right now" panel, fed by enqueue()
         self.ready = False
 
-    async def connect(self) -> None:
+    async def connect(self, background: bool = True) -> None:
+        """Open the DB and start the ingest tasks. A failed connect is not
+        fatal: events are spooled and the supervisor keeps retrying.
+        background=False only opens it (offline tools: no writer, no
+        maintenance); check `ready`."""
+        await self._open()
+        if not background:
+            return
+        self._writer = asyncio.create_task(self._drain())
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    async def _open(self) -> bool:
         try:
             if self.is_pg:
                 import asyncpg
@@ -156,35 +706,594 @@ class AnalyticsDB:
                     dsn, min_size=1, max_size=5, command_timeout=10
                 )
                 async with self._pool.acquire() as con:
-                    await con.execute(_SCHEMA_PG)
-                    for ix in _INDEXES:
-                        await con.execute(ix)
+                    await self._pg_schema(con)
+                    await self._classify_raw(con)
+                    fresh = await con.fetchval("SELECT to_regclass('agg_counts')") is None
+                    fresh_hll = await con.fetchval("SELECT to_regclass('agg_hll')") is None
+                    fresh_sessions = await con.fetchval(
+                        "SELECT to_regclass('sessions')") is None
+                    fresh_edges = await con.fetchval(
+                        "SELECT to_regclass('agg_edges')") is None
+                    fresh_hours = await con.fetchval(
+                        "SELECT to_regclass('agg_hours')") is None
+                    fresh_topk = await con.fetchval(
+                        "SELECT to_regclass('agg_topk')") is None
+                    await con.execute(_SCHEMA_AGG_PG)
+                    await con.execute(_SCHEMA_SESSIONS)
+                    if await con.fetchval(
+                            "SELECT data_type FROM information_schema.columns"
+                            " WHERE table_name = 'sessions' AND column_name = 'steps'"
+                            " AND table_schema = current_schema()") == "integer":
+                        await con.execute("ALTER TABLE sessions ALTER COLUMN steps TYPE BIGINT")
+                    async with con.transaction():
+                        if fresh:
+                            for sql in self._backfill_sql(self._sources()[0][0]):
+                                await con.execute(sql)
+                        if fresh_hours:
+                            await con.execute(
+                                _BACKFILL_HOURS.format(src=self._sources()[0][0]))
+                        if fresh_topk:
+                            await self._backfill_topk(con)
+                        if fresh_hll or fresh_hours:
+                            # merging is idempotent: existing sketches only
+                            # gain the hourly kinds
+                            await self._backfill_sketches(con, self._sources())
+                        if fresh_edges:
+                            await self._backfill_edges(con)
+                        new = await self._flags_resolve(con)
+                        if fresh_sessions:
+                            await self._backfill_sessions(con)
+                        elif new:
+                            await self._backfill_sessions(con, new)
+                        await self._classify_rollups(con)
+                    self._sessions_from = await self._sessions_start(con)
             else:
                 import aiosqlite
 
                 path = self.url[len("sqlite://"):] if self.url.startswith("sqlite://") else _DEFAULT_SQLITE
-                self._sqlite = await aiosqlite.connect(path or _DEFAULT_SQLITE)
+                path = path or _DEFAULT_SQLITE
+                if path == ":memory:" and self.partition != "none":
+                    logger.warning("Analytics partitioning needs a SQLite file; disabled")
+                    self.partition = "none"
+                self._sqlite_path = path
+                self._sqlite = await aiosqlite.connect(path)
                 self._sqlite.row_factory = aiosqlite.Row
-                await self._sqlite.executescript(_SCHEMA_SQLITE)
-                for ix in _INDEXES:
-                    await self._sqlite.execute(ix)
+                await self._sqlite.execute("PRAGMA synchronous=NORMAL")
+                await self._sqlite.executescript(_SCHEMA_DIMS)
+                await self._sqlite_schema(self._sqlite)
+                cur = await self._sqlite.execute(
+                    "SELECT name FROM sqlite_master"
+                    " WHERE name IN ('agg_counts', 'agg_hll', 'agg_hours', 'agg_topk',"
+                    " 'agg_edges', 'sessions')"
+                )
+                existing = {r[0] for r in await cur.fetchall()}
+                await self._sqlite.executescript(_SCHEMA_AGG + _SCHEMA_SESSIONS)
+                if self.partition != "none":
+                    # (re)opening every month file also encodes old ones
+                    parts = self._sqlite_partitions()
+                    for i in range(0, len(parts), _ATTACH_MAX):
+                        await self._sqlite_attach(
+                            self._sqlite, parts[i:i + _ATTACH_MAX], create=True
+                        )
+                    await self._sqlite_move_to_partitions()
+                await self._classify_raw(self._sqlite)
+                new = await self._flags_resolve(self._sqlite)
+                await self._sqlite_backfill(
+                    "agg_counts" not in existing, "agg_hll" not in existing,
+                    "sessions" not in existing, new, "agg_edges" not in existing,
+                    "agg_hours" not in existing, "agg_topk" not in existing,
+                )
+                await self._classify_rollups(self._sqlite)
                 await self._sqlite.commit()
+                self._sessions_from = await self._sessions_start(self._sqlite)
+                if path != ":memory:" and SQLITE_READERS > 0:
+                    uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+                    self._readers = asyncio.Queue()
+                    for _ in range(SQLITE_READERS):
+                        con = await aiosqlite.connect(uri, uri=True)
+                        con.row_factory = aiosqlite.Row
+                        self._readers.put_nowait(con)
             self.ready = True
             logger.info(
-                "Analytics DB ready (%s)", "postgres" if self.is_pg else "sqlite"
+                "Analytics DB ready (%s, ingest=%s, partition=%s)",
+                "postgres" if self.is_pg else "sqlite",
+                self.ingest_mode if self.is_pg else "insert",
+                self.partition,
             )
+            return True
         except Exception as e:  # never let analytics break the app
             self.ready = False
             logger.error("Analytics DB connect failed: %s", e)
+            await self._disconnect()
+            return False
+
+    # -- schema + partitions ------------------------------------------------
+    async def _pg_schema(self, con) -> None:
+        await con.execute(_SCHEMA_DIMS_PG)
+        typ = await con.fetchval(
+            "SELECT data_type FROM information_schema.columns WHERE table_name = 'events'"
+            " AND column_name = 'page' AND table_schema = current_schema()"
+        )
+        if typ == "text":
+            await self._pg_encode_existing(con)
+        if self.partition == "none":
+            await con.execute(_SCHEMA_PG)
+        else:
+            kind = await con.fetchval(
+                "SELECT relkind::text FROM pg_class WHERE oid = to_regclass('events')"
+            )
+            if kind == "r":
+                await self._pg_partition_existing(con)
+            else:
+                await con.execute(_SCHEMA_PG_PARTITIONED)
+                await con.execute(
+                    "CREATE TABLE IF NOT EXISTS events_default PARTITION OF events DEFAULT"
+                )
+            await self._pg_create_partitions(con, self._upcoming_periods())
+        for col, typ in _ADDED_COLUMNS:
+            await con.execute(
+                f"ALTER TABLE events ADD COLUMN IF NOT EXISTS {col} {typ}"
+            )
+        for ix in _INDEXES:
+            await con.execute(ix)
+        for ix in _SUPERSEDED_INDEXES:
+            if await con.fetchval("SELECT to_regclass($1)", ix) is not None:
+                logger.info("Dropping superseded index %s", ix)
+                await con.execute(f"DROP INDEX {ix}")
+
+    async def _pg_partition_existing(self, con) -> None:
+        """One-off migration of a plain events table to the partitioned layout."""
+        logger.info("Partitioning the existing events table (%s)", self.partition)
+        cols = "id, " + ", ".join(_COLUMNS)
+        async with con.transaction():
+            for col, typ in _ADDED_COLUMNS:
+                await con.execute(
+                    f"ALTER TABLE events ADD COLUMN IF NOT EXISTS {col} {typ}"
+                )
+            await con.execute("ALTER TABLE events RENAME TO events_unpartitioned")
+            await con.execute(_SCHEMA_PG_PARTITIONED)
+            await con.execute(
+                "CREATE TABLE events_default PARTITION OF events DEFAULT"
+            )
+            lo, hi = await con.fetchrow(
+                "SELECT MIN(day), MAX(day) FROM events_unpartitioned"
+            )
+            if lo:
+                await self._pg_create_partitions(con, _periods(lo, hi, self.partition))
+            await con.execute(
+                f"INSERT INTO events ({cols}) SELECT {cols} FROM events_unpartitioned",
+                timeout=3600,
+            )
+            await con.execute(
+                "SELECT setval(pg_get_serial_sequence('events', 'id'),"
+                " COALESCE((SELECT MAX(id) FROM events), 0) + 1, false)"
+            )
+            await con.execute("DROP TABLE events_unpartitioned")
+
+    async def _pg_encode_existing(self, con) -> None:
+        """One-off migration of a text events table (plain or partitioned) to
+        the dictionary-encoded layout: fill `dims`, then copy into a new
+        table of the same shape."""
+        logger.info("Dictionary-encoding the existing events table")
+        kind = await con.fetchval(
+            "SELECT relkind::text FROM pg_class WHERE oid = to_regclass('events')"
+        )
+        async with con.transaction():
+            for col, typ in _ADDED_COLUMNS:
+                await con.execute(
+                    f"ALTER TABLE events ADD COLUMN IF NOT EXISTS {col} {typ}"
+                )
+            for c in _DICT_COLUMNS:
+                await con.execute(
+                    f"INSERT INTO dims (kind, value) SELECT DISTINCT '{c}', {c}"
+                    f" FROM events WHERE {c} IS NOT NULL"
+                    " ON CONFLICT (kind, value) DO NOTHING", timeout=3600,
+                )
+            children = await con.fetch(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid"
+                " WHERE i.inhparent = 'events'::regclass"
+            )
+            for (name,) in children:  # free the partition names
+                await con.execute(f"ALTER TABLE {name} RENAME TO {name}_text")
+            await con.execute("ALTER TABLE events RENAME TO events_text")
+            if kind == "p":
+                await con.execute(_SCHEMA_PG_PARTITIONED)
+                await con.execute(
+                    "CREATE TABLE events_default PARTITION OF events DEFAULT"
+                )
+                lo, hi = await con.fetchrow("SELECT MIN(day), MAX(day) FROM events_text")
+                if lo:
+                    part = self.partition if self.partition != "none" else "month"
+                    await self._pg_create_partitions(con, _periods(lo, hi, part))
+            else:
+                await con.execute(_SCHEMA_PG)
+            await con.execute(self._encode_sql("events_text", "events"), timeout=3600)
+            await con.execute(
+                "SELECT setval(pg_get_serial_sequence('events', 'id'),"
+                " COALESCE((SELECT MAX(id) FROM events), 0) + 1, false)"
+            )
+            await con.execute("DROP TABLE events_text")
+
+    @staticmethod
+    def _encode_sql(src: str, dst: str) -> str:
+        """Copy text-layout rows of `src` into the encoded table `dst`."""
+        cols = ", ".join(_COLUMNS)
+        sel = ", ".join(
+            f"d_{c}.id" if c in _DICT_COLUMNS else f"events.{c}" for c in _COLUMNS
+        )
+        joins = "".join(
+            f" LEFT JOIN dims d_{c} ON d_{c}.kind = '{c}' AND d_{c}.value = events.{c}"
+            for c in _DICT_COLUMNS
+        )
+        return (f"INSERT INTO {dst} (id, {cols})"
+                f" SELECT events.id, {sel} FROM {src} AS events{joins}")
+
+    @staticmethod
+    async def _pg_create_partitions(con, periods: List[str]) -> None:
+        for p in periods:
+            lo, hi = _period_bounds(p)
+            try:
+                await con.execute(
+                    f"CREATE TABLE IF NOT EXISTS events_p{p} PARTITION OF events"
+                    f" FOR VALUES FROM ('{lo}') TO ('{hi}')"
+                )
+            except Exception as e:  # e.g. rows for it already sit in events_default
+                logger.error("Could not create partition events_p%s: %s", p, e)
+
+    def _upcoming_periods(self) -> List[str]:
+        """Yesterday's period through PARTITION_AHEAD periods past today."""
+        today = _dt.datetime.utcnow().date()
+        last = _period(today.isoformat(), self.partition)
+        for _ in range(PARTITION_AHEAD):
+            last = _period(_period_bounds(last)[1], self.partition)
+        start = (today - _dt.timedelta(days=1)).isoformat()
+        return _periods(start, _period_bounds(last)[0], self.partition)
+
+    @classmethod
+    async def _sqlite_schema(cls, con, schema: str = "main") -> None:
+        await con.execute(f"PRAGMA {schema}.journal_mode=WAL")
+        await con.executescript(
+            _SCHEMA_SQLITE.replace("EXISTS events", f"EXISTS {schema}.events")
+        )
+        cur = await con.execute(f"PRAGMA {schema}.table_info(events)")
+        have = {r[1] for r in await cur.fetchall()}
+        for col, typ in _ADDED_COLUMNS:
+            if col not in have:
+                await con.execute(f"ALTER TABLE {schema}.events ADD COLUMN {col} {typ}")
+        await con.commit()
+        await cls._sqlite_encode_existing(con, schema)
+        for ix in _INDEXES:
+            await con.execute(ix.replace("EXISTS idx_", f"EXISTS {schema}.idx_"))
+        cur = await con.execute(
+            f"SELECT name FROM {schema}.sqlite_master WHERE type = 'index' AND name IN"
+            f" ({', '.join('?' * len(_SUPERSEDED_INDEXES))})", _SUPERSEDED_INDEXES,
+        )
+        for (ix,) in await cur.fetchall():
+            logger.info("Dropping superseded index %s.%s", schema, ix)
+            await con.execute(f"DROP INDEX {schema}.{ix}")
+        await con.commit()
+
+    @classmethod
+    async def _sqlite_encode_existing(cls, con, schema: str) -> None:
+        """One-off migration of a text-layout events table (main or a month
+        file) to the dictionary-encoded one; `dims` stays in main."""
+        cur = await con.execute(f"PRAGMA {schema}.table_info(events)")
+        if {r[1]: (r[2] or "").upper() for r in await cur.fetchall()}.get("page") != "TEXT":
+            return
+        logger.info("Dictionary-encoding the existing events table (%s)", schema)
+        try:
+            for c in _DICT_COLUMNS:
+                await con.execute(
+                    f"INSERT OR IGNORE INTO main.dims (kind, value) SELECT DISTINCT ?, {c}"
+                    f" FROM {schema}.events WHERE {c} IS NOT NULL", (c,),
+                )
+            await con.execute(
+                _SCHEMA_SQLITE.replace("EXISTS events", f"EXISTS {schema}.events_encoded")
+            )
+            await con.execute(
+                cls._encode_sql(f"{schema}.events", f"{schema}.events_encoded")
+            )
+            await con.execute(f"DROP TABLE {schema}.events")
+            await con.execute(f"ALTER TABLE {schema}.events_encoded RENAME TO events")
+            await con.commit()
+        except Exception:
+            await con.rollback()
+            raise
+        await con.execute(f"VACUUM {schema}")  # give the space back
+
+    def _partition_path(self, period: str) -> str:
+        return os.path.splitext(self._sqlite_path)[0] + f"-{period}.db"
+
+    def _sqlite_partitions(self) -> List[str]:
+        stem = os.path.splitext(self._sqlite_path)[0]
+        found = []
+        for f in glob.glob(glob.escape(stem) + "-*.db"):
+            m = re.fullmatch(r"-(\d{6})\.db", f[len(stem):])
+            if m:
+                found.append(m.group(1))
+        return sorted(found)
+
+    async def _sqlite_attach(self, con, periods: List[str],
+                             create: bool = False) -> None:
+        """ATTACH monthly partition files to `con` as schema p<YYYYMM>.
+
+        Least recently used attachments are detached to stay under the
+        per-connection limit. Readers attach read-only and skip months with
+        no file; the writer (create=True) creates the file and its schema.
+        Must not be called inside an open transaction.
+        """
+        att = self._attached.setdefault(id(con), collections.OrderedDict())
+        for p in periods:
+            if p in att:
+                att.move_to_end(p)
+                continue
+            path = self._partition_path(p)
+            if not create and not os.path.exists(path):
+                continue
+            while len(att) >= _ATTACH_MAX:
+                old = next(o for o in att if o not in periods)
+                await con.execute(f"DETACH DATABASE p{old}")
+                del att[old]
+            if create:
+                await con.execute(f"ATTACH DATABASE ? AS p{p}", (path,))
+                await self._sqlite_schema(con, f"p{p}")
+            else:
+                uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+                await con.execute(f"ATTACH DATABASE ? AS p{p}", (uri,))
+            att[p] = None
+
+    async def _sqlite_detach(self, con, period: str) -> None:
+        att = self._attached.get(id(con))
+        if att is not None and period in att:
+            await con.execute(f"DETACH DATABASE p{period}")
+            del att[period]
+
+    async def _sqlite_move_to_partitions(self) -> None:
+        """Move rows left in the main events table into their monthly files."""
+        con = self._sqlite
+        cur = await con.execute("SELECT MIN(day), MAX(day) FROM main.events")
+        lo, hi = await cur.fetchone()
+        if not lo:
+            return
+        cols = ", ".join(_COLUMNS)
+        for p in _periods(lo, hi, "month"):
+            d0, d1 = _period_bounds(p)
+            await self._sqlite_attach(con, [p], create=True)
+            await con.execute(
+                f"INSERT INTO p{p}.events ({cols}) SELECT {cols} FROM main.events"
+                " WHERE day >= ? AND day < ?", (d0, d1),
+            )
+            await con.execute(
+                "DELETE FROM main.events WHERE day >= ? AND day < ?", (d0, d1)
+            )
+            await con.commit()
+        logger.info("Moved existing events into monthly partition files")
+
+    def _sources(self, d0: Optional[str] = None,
+                 d1: Optional[str] = None) -> List[Tuple[str, List[str]]]:
+        """(relation, partitions to attach) chunks covering [d0, d1] (all
+        events when no range is given).
+
+        Always just `events`, except for SQLite partitions, which are UNION
+        ALLed in groups that fit the attach limit. Chunks are day-disjoint, so
+        callers can add their per-chunk aggregates together. Relations are
+        aliased `events` and have the decoded (text) _COLUMNS plus id.
+        """
+        return [(f"(SELECT {_DECODED_COLS} FROM {rel}{_DECODE_JOINS}) AS events", parts)
+                for rel, parts in self._raw_sources(d0, d1)]
+
+    def _raw_sources(self, d0: Optional[str] = None,
+                     d1: Optional[str] = None) -> List[Tuple[str, List[str]]]:
+        """Like _sources, but the stored (dictionary-encoded) rows."""
+        if self.is_pg or self.partition == "none":
+            return [("events", [])]
+        if d0 is None:
+            periods = self._sqlite_partitions()
+        else:
+            periods = [
+                p for p in _periods(d0, d1, "month")
+                if os.path.exists(self._partition_path(p))
+            ]
+        return [
+            (self._union(periods[i:i + _ATTACH_MAX]), periods[i:i + _ATTACH_MAX])
+            for i in range(0, len(periods), _ATTACH_MAX)
+        ]
+
+    def _raw_tables(self) -> List[Tuple[str, List[str]]]:
+        """The stored events tables one by one (no UNION): for UPDATEs and
+        per-table index lookups."""
+        if self.is_pg or self.partition == "none":
+            return [("events", [])]
+        return [(f"p{p}.events", [p]) for p in self._sqlite_partitions()]
+
+    async def _classify_raw(self, con) -> None:
+        """Set page_class on rows stored before the column existed. One
+        UPDATE per distinct page (a handful), found via the page_class index;
+        unknown pages get "other", so this is a no-op once done."""
+        for table, periods in self._raw_tables():
+            sql = (f"SELECT DISTINCT d.id, d.value FROM {table} e JOIN dims d ON d.id = e.page"
+                   " WHERE e.page_class IS NULL AND e.page IS NOT NULL")
+            if self.is_pg:
+                pages = await con.fetch(sql)
+            else:
+                await self._sqlite_attach(con, periods, create=True)
+                pages = await (await con.execute(sql)).fetchall()
+            if not pages:
+                continue
+            logger.info("Classifying %d page(s) of existing events in %s", len(pages), table)
+            upd = f"UPDATE {table} SET page_class = ? WHERE page = ? AND page_class IS NULL"
+            args = [(page_class(v), i) for i, v in pages]
+            if self.is_pg:
+                await con.executemany(self._to_pg(upd), args)
+            else:
+                await con.executemany(upd, args)
+                await con.commit()
+
+    async def _classify_rollups(self, con) -> None:
+        """Derive the page_class rollup from the page one when it has none
+        yet (upgrades). agg_dims outlives raw events, so this covers every
+        day the dashboard can show."""
+        has = "SELECT 1 FROM agg_dims WHERE dim = ? LIMIT 1"
+        get = "SELECT day, value, hits FROM agg_dims WHERE dim = 'page'"
+        if self.is_pg:
+            if await con.fetchval(self._to_pg(has), "page_class"):
+                return
+            rows = await con.fetch(get)
+        else:
+            if await (await con.execute(has, ("page_class",))).fetchone():
+                return
+            rows = await (await con.execute(get)).fetchall()
+        sums: Dict[Tuple[str, str], int] = collections.Counter()
+        for day, value, hits in rows:
+            sums[(day, "direct" if value == "direct" else page_class(value))] += hits
+        args = [(day, "page_class", cls, n) for (day, cls), n in sorted(sums.items())]
+        if args:
+            await con.executemany(self._to_pg(_UPSERT_DIM) if self.is_pg else _UPSERT_DIM, args)
+
+    @staticmethod
+    def _union(periods: List[str]) -> str:
+        cols = "id, " + ", ".join(_COLUMNS)
+        rel = " UNION ALL ".join(f"SELECT {cols} FROM p{p}.events" for p in periods)
+        return f"({rel}) AS events"
+
+    @staticmethod
+    def _backfill_sql(src: str) -> List[str]:
+        return [_BACKFILL_COUNTS.format(src=src)] + [
+            _BACKFILL_DIM.format(f=f, src=src) for f in BREAKDOWN_FIELDS
+        ]
+
+    async def _sqlite_backfill(self, rollups: bool, sketches: bool,
+                               sessions: bool = False,
+                               flags: List[Tuple[int, Any]] = (),
+                               edges: bool = False, hours: bool = False,
+                               topk: bool = False) -> None:
+        """Fill freshly created rollups/sketches/sessions/edges/hours from
+        the stored raw events (or just the new `flags` of existing
+        sessions), and agg_topk from agg_dims."""
+        if not (rollups or sketches or sessions or flags or edges or hours or topk):
+            return
+        con = self._sqlite
+        sources = self._sources()
+        try:
+            if rollups or hours:
+                for src, periods in sources:
+                    await self._sqlite_attach(con, periods)
+                    sqls = self._backfill_sql(src) if rollups else []
+                    if hours:
+                        sqls.append(_BACKFILL_HOURS.format(src=src))
+                    for sql in sqls:
+                        await con.execute(sql)
+            if topk:
+                await self._backfill_topk(con)
+            if sketches or hours:
+                await self._backfill_sketches(con, sources)
+            if edges:
+                await self._backfill_edges(con)
+            if sessions:
+                await self._backfill_sessions(con)
+            elif flags:
+                await self._backfill_sessions(con, flags)
+            await con.commit()
+        except Exception:
+            await con.rollback()
+            raise
+
+    async def _maintain(self) -> None:
+        """Create upcoming partitions, apply the retention policy and persist
+        the result cache."""
+        async with self._maint_lock:
+            await self._maintain_locked()
+        if self._cache is not None and self._cache.path:
+            await asyncio.to_thread(self._cache.save, self._cache.items())
+
+    async def _maintain_locked(self) -> None:
+        if self.is_pg and self.partition != "none":
+            async with self._pool.acquire() as con:
+                await self._pg_create_partitions(con, self._upcoming_periods())
+        if RETENTION_DAYS <= 0:
+            return
+        today = _dt.datetime.utcnow().date()
+        cutoff = (today - _dt.timedelta(days=RETENTION_DAYS)).isoformat()
+        if self.partition == "none":
+            await self._exec("DELETE FROM events WHERE day < ?", (cutoff,))
+        elif self.is_pg:
+            async with self._pool.acquire() as con:
+                names = await con.fetch(
+                    "SELECT c.relname FROM pg_inherits i"
+                    " JOIN pg_class c ON c.oid = i.inhrelid"
+                    " WHERE i.inhparent = 'events'::regclass"
+                )
+                for (name,) in names:
+                    m = re.fullmatch(r"events_p(\d{6}|\d{8})", name)
+                    if m and _period_bounds(m.group(1))[1] <= cutoff:
+                        await con.execute(f"DROP TABLE {name}")
+                        logger.info("Retention: dropped partition %s", name)
+                await con.execute("DELETE FROM events_default WHERE day < $1", cutoff)
+        else:
+            for p in self._sqlite_partitions():
+                if _period_bounds(p)[1] <= cutoff:
+                    await self._sqlite_drop_partition(p)
+        await self._dims_gc()
+
+    async def _sqlite_drop_partition(self, period: str) -> None:
+        async with self._lock:
+            await self._sqlite_detach(self._sqlite, period)
+        if self._readers is not None:
+            borrowed = []
+            try:
+                while len(borrowed) < SQLITE_READERS:
+                    borrowed.append(await self._readers.get())
+                for con in borrowed:
+                    await self._sqlite_detach(con, period)
+            finally:
+                for con in borrowed:
+                    self._readers.put_nowait(con)
+        path = self._partition_path(period)
+        for f in (path, path + "-wal", path + "-shm"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(f)
+        logger.info("Retention: removed partition file %s", path)
 
     async def close(self) -> None:
+        if self._supervisor:
+            self._supervisor.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._supervisor
+            self._supervisor = None
+        if self._writer:
+            await self._queue.put(_STOP)  # flush everything still queued
+            await self._writer
+            self._writer = None
+        if self._cache is not None:
+            self._cache.save()
+        await self._disconnect()
+
+    async def _disconnect(self) -> None:
         try:
             if self._pool:
                 await self._pool.close()
+            while self._readers and not self._readers.empty():
+                await self._readers.get_nowait().close()
             if self._sqlite:
                 await self._sqlite.close()
         except Exception:
             pass
+        self._pool = self._sqlite = self._readers = None
+        self._attached.clear()
+
+    @contextlib.asynccontextmanager
+    async def _sqlite_reader(self):
+        """Borrow a read-only connection; falls back to the writer (under the
+        lock) for :memory: databases, which cannot be shared."""
+        if self._readers is None:
+            async with self._lock:
+                yield self._sqlite
+            return
+        con = await self._readers.get()
+        try:
+            yield con
+        finally:
+            self._readers.put_nowait(con)
 
     @staticmethod
     def _to_pg(sql: str) -> str:
@@ -211,105 +1320,1407 @@ class AnalyticsDB:
         except Exception as e:
             logger.error("Analytics insert failed: %s", e)
 
-    async def _query(self, sql: str, params: Tuple = ()) -> List[Dict[str, Any]]:
+    async def _exec_many(self, sql: str, rows: List[Tuple],
+                         derived: List[Tuple[str, List[Tuple]]] = (),
+                         sketches: Optional[Dict[Tuple[str, str], HLL]] = None,
+                         topk: Optional[Dict[Tuple[str, str], TopK]] = None) -> bool:
+        """executemany `rows`, plus the `derived` (sql, rows) statements and
+        the `sketches` and `topk` merges in the same transaction."""
         if not self.ready:
-            return []
+            return False
+        if not rows:
+            return True
+        try:
+            if self.is_pg:
+                async with self._pool.acquire() as con:
+                    async with con.transaction():
+                        await con.executemany(self._to_pg(sql), rows)
+                        await self._pg_derived(con, derived)
+                        await self._merge_sketches(con, sketches)
+                        await self._merge_topk(con, topk)
+            else:
+                async with self._lock:
+                    await self._sqlite.executemany(sql, rows)
+                    for dsql, drows in derived:
+                        await self._sqlite.executemany(dsql, drows)
+                    await self._merge_sketches(self._sqlite, sketches)
+                    await self._merge_topk(self._sqlite, topk)
+                    await self._sqlite.commit()
+            return True
+        except Exception as e:
+            logger.error("Analytics batch insert failed (%d rows): %s", len(rows), e)
+            if not self.is_pg:
+                with contextlib.suppress(Exception):
+                    await self._sqlite.rollback()
+            return False
+
+    async def _pg_derived(self, con, derived: List[Tuple[str, List[Tuple]]]) -> None:
+        for dsql, drows in derived:
+            if drows:
+                await con.executemany(self._to_pg(dsql), drows)
+
+    @staticmethod
+    def _rollups(rows: List[Tuple]) -> List[Tuple[str, List[Tuple]]]:
+        """Rollup upserts for a batch, pre-summed so each key is written once."""
+        counts: Dict[str, List[int]] = {}
+        hours: Dict[Tuple[str, int], List[int]] = {}
+        dims: Dict[Tuple[str, str, str], int] = collections.Counter()
+        for r in rows:
+            et = r[_TYPE]
+            if et != "pageview" and et != "form_submit":
+                continue
+            w = r[_WEIGHT] or 1
+            c = counts.setdefault(r[_DAY], [0, 0])
+            h = hours.setdefault((r[_DAY], int(r[_TS][11:13])), [0, 0])
+            if et == "form_submit":
+                c[1] += w
+                h[1] += w
+                continue
+            c[0] += w
+            h[0] += w
+            for f, i in _DIM_IDX:
+                dims[(r[_DAY], f, "direct" if r[i] is None else r[i])] += w
+        return [
+            (_UPSERT_COUNTS, [(d, pv, ld) for d, (pv, ld) in sorted(counts.items())]),
+            (_UPSERT_HOURS, [k + (pv, ld) for k, (pv, ld) in sorted(hours.items())]),
+            (_UPSERT_DIM, [k + (v,) for k, v in sorted(dims.items())]),
+        ]
+
+    @staticmethod
+    def _sketch_batch(rows: List[Tuple],
+                      into: Optional[Dict[Tuple[str, str], HLL]] = None
+                      ) -> Dict[Tuple[str, str], HLL]:
+        """Add a batch to per-(day, kind) sketches of _SKETCHES and the
+        hourly visitor sketches."""
+        out = {} if into is None else into
+
+        def add(day: str, kind: str, item: Optional[str]) -> None:
+            if item:
+                sk = out.get((day, kind))
+                if sk is None:
+                    sk = out[(day, kind)] = HLL()
+                sk.add(item)
+
+        for r in rows:
+            add(r[_DAY], "visitors", r[_VISITOR])
+            add(r[_DAY], "sessions", r[_SESSION])
+            add(r[_DAY], _HOURLY_SKETCH + r[_TS][11:13], r[_VISITOR])
+        return out
+
+    def _flags(self, rows: List[Tuple]) -> List[int]:
+        """Step flags of each (decoded) event row: the OR of the bits of the
+        funnel/goal conditions it matches."""
+        tags = self._tags
+        out = []
+        for r in rows:
+            f = 0
+            for bit, match in tags:
+                if match(r):
+                    f |= bit
+            out.append(f)
+        return out
+
+    @staticmethod
+    def _session_batch(rows: List[Tuple], flags: List[int],
+                       into: Optional[Dict[int, List]] = None) -> Dict[int, List]:
+        """Fold encoded rows and their flags into per-session state: [day,
+        first ts, last ts, entry page, exit page, pageviews, max scroll,
+        step bits]."""
+        out = {} if into is None else into
+        for r, f in zip(rows, flags):
+            sid = r[_SESSION]
+            if sid is None:
+                continue
+            ts, page = r[_TS], r[_PAGE]
+            s = out.get(sid)
+            if s is None:
+                s = out[sid] = [r[_DAY], ts, ts, page, page, 0, 0, 0]
+            elif ts < s[1]:
+                s[0], s[1], s[3] = r[_DAY], ts, page
+            elif ts >= s[2]:
+                s[2], s[4] = ts, page
+            et = r[_TYPE]
+            if et == "pageview":
+                s[5] += 1
+            elif et == "scroll" and (r[_DEPTH] or 0) > s[6]:
+                s[6] = r[_DEPTH]
+            s[7] |= f
+        return out
+
+    @staticmethod
+    def _session_upserts(state: Dict[int, List]) -> Tuple[str, List[Tuple]]:
+        return _UPSERT_SESSION, [
+            (sid, day, _unix(a), _unix(b), entry, exit_, pv, depth, steps)
+            for sid, (day, a, b, entry, exit_, pv, depth, steps) in sorted(state.items())
+        ]
+
+    @staticmethod
+    def _edge_walk(rows: List[Tuple], counts: Dict[Tuple[str, int, int], int],
+                   last: Optional[List] = None) -> List[Tuple]:
+        """Count page-to-page transitions of encoded rows sorted by (session,
+        ts) into `counts`, keyed (day, src, dst). `last` carries [session,
+        page] across calls. Returns the pageviews that open a session in
+        `rows` (their previous page, if any, is not in `rows`)."""
+        last = [None, None] if last is None else last
+        firsts = []
+        for r in rows:
+            sid, page = r[_SESSION], r[_PAGE]
+            if sid is None:
+                continue
+            if r[_TYPE] == "pageview" and page is not None:
+                if sid != last[0]:
+                    firsts.append(r)
+                elif last[1] is not None and last[1] != page:
+                    counts[(r[_DAY], last[1], page)] += 1
+            last[0], last[1] = sid, page
+        return firsts
+
+    @classmethod
+    def _edge_upserts(cls, rows: List[Tuple]) -> List[Tuple[str, List[Tuple]]]:
+        """agg_edges upserts for a batch of encoded rows."""
+        counts: Dict[Tuple[str, int, int], int] = collections.Counter()
+        ordered = sorted((r for r in rows if r[_SESSION] is not None),
+                         key=lambda r: (r[_SESSION], r[_TS]))
+        firsts = cls._edge_walk(ordered, counts)
+        return [
+            (_UPSERT_EDGE, [k + (n,) for k, n in sorted(counts.items())]),
+            (_UPSERT_EDGE_FROM_SESSION, [
+                (r[_DAY], r[_PAGE], r[_SESSION], r[_PAGE], _unix(r[_TS])) for r in firsts
+            ]),
+        ]
+
+    async def _backfill_edges(self, con) -> None:
+        """Fill a fresh agg_edges from the stored raw events, one pass in
+        (session, ts) order per source chunk."""
+        counts: Dict[Tuple[str, int, int], int] = collections.Counter()
+        sql = self._to_pg(_UPSERT_EDGE) if self.is_pg else _UPSERT_EDGE
+        cols = ", ".join(_COLUMNS)
+        for src, periods in self._raw_sources():
+            q = (f"SELECT {cols} FROM {src} WHERE session_id IS NOT NULL"
+                 " ORDER BY session_id, ts")
+            if self.is_pg:
+                cur = await con.cursor(q)
+                fetch = cur.fetch
+            else:
+                await self._sqlite_attach(con, periods)
+                cur = await con.execute(q)
+                fetch = cur.fetchmany
+            last: List = [None, None]
+            while True:
+                chunk = await fetch(5000)
+                if not chunk:
+                    break
+                self._edge_walk([tuple(r) for r in chunk], counts, last)
+            if counts:
+                await con.executemany(sql, [k + (n,) for k, n in sorted(counts.items())])
+                counts.clear()
+
+    async def _sessions_start(self, con) -> Optional[str]:
+        """First day funnels() reads from `sessions` rather than the step
+        sketches of older installs: its first day or, while it is still
+        empty, the day after the last step sketch (None: all days)."""
+        sql = ("SELECT (SELECT MIN(day) FROM sessions),"
+               " (SELECT MAX(day) FROM agg_hll WHERE kind IN ({}))".format(
+                   ", ".join(f"'{k}'" for k, _ in funnels.LEGACY)))
+        if self.is_pg:
+            first, sketched = await con.fetchrow(sql)
+        else:
+            first, sketched = await (await con.execute(sql)).fetchone()
+        if first or not sketched:
+            return first
+        return (_dt.date.fromisoformat(sketched) + _dt.timedelta(days=1)).isoformat()
+
+    async def _flags_resolve(self, con) -> List[Tuple[int, Any]]:
+        """Give every compiled funnel/goal condition a stable bit in `flags`
+        and set self._tags; returns the tags that are new, whose bit stored
+        sessions do not have yet.
+
+        A new table starts with funnels.LEGACY at bits 0-3, the bits of
+        sessions written before funnels were configurable. When all bits are
+        taken, the bit of a condition no longer configured is recycled (and
+        cleared from every session first).
+        """
+        async def run(sql: str, *args) -> None:
+            if self.is_pg:
+                await con.execute(self._to_pg(sql), *args)
+            else:
+                await con.execute(sql, args)
+
+        get = "SELECT bit, matcher FROM flags"
+        rows = await con.fetch(get) if self.is_pg else await (await con.execute(get)).fetchall()
+        bits = {r[1]: r[0] for r in rows}
+        if not bits:
+            for i, (_, match) in enumerate(funnels.LEGACY):
+                bits[funnels.match_key(match)] = i
+                await run("INSERT INTO flags (bit, matcher) VALUES (?, ?)",
+                          i, funnels.match_key(match))
+        new = []
+        for key in self.config.matchers:
+            if key in bits:
+                continue
+            taken = set(bits.values())
+            free = [b for b in range(_MAX_FLAGS) if b not in taken]
+            if not free:
+                stale = [k for k in bits if k not in self.config.matchers]
+                if not stale:
+                    logger.error("Over %d funnel/goal conditions; not counting %s",
+                                 _MAX_FLAGS, key)
+                    continue
+                b = bits.pop(stale[0])
+                await run("UPDATE sessions SET steps = steps & ? WHERE (steps & ?) <> 0",
+                          ~(1 << b), 1 << b)
+                await run("DELETE FROM flags WHERE bit = ?", b)
+                free = [b]
+            bits[key] = free[0]
+            await run("INSERT INTO flags (bit, matcher) VALUES (?, ?)", free[0], key)
+            new.append(key)
+        if new:
+            logger.info("New funnel/goal conditions: %d", len(new))
+        self._bits = bits
+        self._tags = [(1 << bits[k], m) for k, m in self.config.matchers.items() if k in bits]
+        return [(1 << bits[k], self.config.matchers[k]) for k in new]
+
+    async def _backfill_sessions(self, con, tags: Optional[List[Tuple[int, Any]]] = None
+                                 ) -> None:
+        """Build `sessions` from the stored raw events (first start with it),
+        flushing every 50k sessions; the upsert merges partial sessions.
+        With `tags`, only OR those new flags into the existing sessions."""
+        state: Dict[int, List] = {}
+        only: Dict[int, int] = collections.defaultdict(int)
+        sql = self._to_pg(_UPSERT_SESSION) if self.is_pg else _UPSERT_SESSION
+        upd = "UPDATE sessions SET steps = steps | ? WHERE session_id = ?"
+        saved = self._tags
+        if tags is not None:
+            self._tags = tags
+        # decoded rows for the matchers, plus the stored session/page ids
+        n = len(_COLUMNS)
+
+        async def flush() -> None:
+            if state:
+                await con.executemany(sql, self._session_upserts(state)[1])
+                state.clear()
+            if only:
+                args = [(f, sid) for sid, f in sorted(only.items()) if f]
+                if args:
+                    await con.executemany(self._to_pg(upd) if self.is_pg else upd, args)
+                only.clear()
+
+        try:
+            for rel, periods in self._raw_sources():
+                q = (f"SELECT {_DECODED_COLS}, events.session_id, events.page"
+                     f" FROM {rel}{_DECODE_JOINS}")
+                if self.is_pg:
+                    cur = await con.cursor(q)
+                    fetch = cur.fetch
+                else:
+                    await self._sqlite_attach(con, periods)
+                    cur = await con.execute(q)
+                    fetch = cur.fetchmany
+                while True:
+                    chunk = await fetch(5000)
+                    if not chunk:
+                        break
+                    rows = [tuple(r)[1:n + 1] for r in chunk]
+                    flags = self._flags(rows)
+                    if tags is not None:
+                        for r, f in zip(chunk, flags):
+                            if r[n + 1] is not None:
+                                only[r[n + 1]] |= f
+                    else:
+                        enc = []
+                        for r in chunk:
+                            e = list(r[1:n + 1])
+                            e[_SESSION], e[_PAGE] = r[n + 1], r[n + 2]
+                            enc.append(e)
+                        self._session_batch(enc, flags, state)
+                    if len(state) + len(only) >= 50000:
+                        await flush()
+            await flush()
+        finally:
+            self._tags = saved
+
+    async def _merge_sketches(self, con,
+                              sketches: Optional[Dict[Tuple[str, str], HLL]]) -> None:
+        """Fold batch sketches into agg_hll (inside the caller's transaction).
+
+        Read-merge-write; on Postgres the rows are created first and locked
+        with FOR UPDATE so concurrent writers cannot lose registers.
+        """
+        if not sketches:
+            return
+        keys = sorted(sketches)
+        days = sorted({d for d, _ in keys})
+        if self.is_pg:
+            empty = HLL().to_bytes()
+            await con.executemany(
+                "INSERT INTO agg_hll (day, kind, regs) VALUES ($1, $2, $3)"
+                " ON CONFLICT (day, kind) DO NOTHING",
+                [(d, k, empty) for d, k in keys],
+            )
+            stored = await con.fetch(
+                "SELECT day, kind, regs FROM agg_hll WHERE day = ANY($1::text[])"
+                " ORDER BY day, kind FOR UPDATE", days,
+            )
+        else:
+            cur = await con.execute(
+                "SELECT day, kind, regs FROM agg_hll WHERE day IN ({})".format(
+                    ",".join("?" * len(days))), days,
+            )
+            stored = await cur.fetchall()
+        old = {(r[0], r[1]): r[2] for r in stored}
+        merged = [
+            (d, k, HLL.union([sketches[(d, k)].to_bytes(), old[(d, k)]]).to_bytes()
+             if old.get((d, k)) else sketches[(d, k)].to_bytes())
+            for d, k in keys
+        ]
+        await con.executemany(
+            self._to_pg(_UPSERT_HLL) if self.is_pg else _UPSERT_HLL, merged
+        )
+
+    @staticmethod
+    def _topk_batch(rows: List[Tuple]) -> Dict[Tuple[str, str], TopK]:
+        """Per-(day, field) summaries of a batch's pageviews over TOPK_FIELDS."""
+        out: Dict[Tuple[str, str], TopK] = {}
+        for r in rows:
+            if r[_TYPE] != "pageview":
+                continue
+            w = r[_WEIGHT] or 1
+            for f, i in _TOPK_IDX:
+                t = out.get((r[_DAY], f))
+                if t is None:
+                    t = out[(r[_DAY], f)] = TopK(TOPK_CAPACITY)
+                t.add("direct" if r[i] is None else r[i], w)
+        return out
+
+    async def _merge_topk(self, con,
+                          pending: Optional[Dict[Tuple[str, str], TopK]]) -> None:
+        """Fold batch summaries into agg_topk (inside the caller's
+        transaction): read-merge-write, locked on Postgres like
+        _merge_sketches."""
+        if not pending:
+            return
+        keys = sorted(pending)
+        days = sorted({d for d, _ in keys})
+        if self.is_pg:
+            await con.executemany(
+                "INSERT INTO agg_topk (day, dim, summary) VALUES ($1, $2, '[]')"
+                " ON CONFLICT (day, dim) DO NOTHING", keys,
+            )
+            stored = await con.fetch(
+                "SELECT day, dim, summary FROM agg_topk WHERE day = ANY($1::text[])"
+                " ORDER BY day, dim FOR UPDATE", days,
+            )
+        else:
+            cur = await con.execute(
+                "SELECT day, dim, summary FROM agg_topk WHERE day IN ({})".format(
+                    ",".join("?" * len(days))), days,
+            )
+            stored = await cur.fetchall()
+        old = {(r[0], r[1]): r[2] for r in stored}
+        merged = [
+            (d, f, TopK.merge([pending[(d, f)],
+                               TopK.from_json(old[(d, f)], TOPK_CAPACITY)],
+                              TOPK_CAPACITY).to_json()
+             if old.get((d, f)) else pending[(d, f)].to_json())
+            for d, f in keys
+        ]
+        await con.executemany(
+            self._to_pg(_UPSERT_TOPK) if self.is_pg else _UPSERT_TOPK, merged
+        )
+
+    async def _backfill_topk(self, con) -> None:
+        """Build agg_topk from the exact per-day hits in agg_dims (first
+        start with it): each day keeps its TOPK_CAPACITY heaviest values."""
+        sql = ("SELECT day, dim, value, hits FROM agg_dims WHERE dim IN ({})"
+               " ORDER BY day, dim".format(", ".join(f"'{f}'" for f in TOPK_FIELDS)))
+        upsert = self._to_pg(_UPSERT_TOPK) if self.is_pg else _UPSERT_TOPK
+        if self.is_pg:
+            fetch = (await con.cursor(sql)).fetch
+        else:
+            fetch = (await con.execute(sql)).fetchmany
+        key, hits, out = None, {}, []
+
+        def close_group() -> None:
+            if hits:
+                kept = heapq.nlargest(TOPK_CAPACITY, hits.items(),
+                                      key=lambda kv: (kv[1], kv[0]))
+                out.append(key + (TopK(TOPK_CAPACITY, {v: [n, 0] for v, n in kept})
+                                  .to_json(),))
+                hits.clear()
+
+        while True:
+            chunk = await fetch(5000)
+            if not chunk:
+                break
+            for day, dim, value, n in chunk:
+                if (day, dim) != key:
+                    close_group()
+                    key = (day, dim)
+                hits[value] = int(n)
+            if len(out) >= 500:
+                await con.executemany(upsert, out)
+                out.clear()
+        close_group()
+        if out:
+            await con.executemany(upsert, out)
+
+    async def _backfill_sketches(self, con, sources: List[Tuple[str, List[str]]]) -> None:
+        """Build agg_hll from the stored raw events (first start with sketches)."""
+        sketches: Dict[Tuple[str, str], HLL] = {}
+        cols = ", ".join(_COLUMNS)
+        for src, periods in sources:
+            sql = f"SELECT {cols} FROM {src}"
+            if self.is_pg:
+                cur = await con.cursor(sql)
+                while True:
+                    chunk = await cur.fetch(5000)
+                    if not chunk:
+                        break
+                    self._sketch_batch([tuple(r) for r in chunk], sketches)
+            else:
+                await self._sqlite_attach(con, periods)
+                cur = await con.execute(sql)
+                while True:
+                    chunk = await cur.fetchmany(5000)
+                    if not chunk:
+                        break
+                    self._sketch_batch([tuple(r) for r in chunk], sketches)
+        for i in range(0, len(sketches), 500):
+            keys = sorted(sketches)[i:i + 500]
+            await self._merge_sketches(con, {k: sketches[k] for k in keys})
+
+    async def _write_events(self, rows: List[Tuple]) -> bool:
+        async with self._dims_lock:
+            ok = await self._write_batch(rows)
+        if ok and rows:
+            today = _utc_today()
+            if min(r[_DAY] for r in rows) < today \
+                    or await self._sessions_reopened(rows, today):
+                self._closed_changed()  # late rows for a closed day
+        return ok
+
+    def _closed_changed(self) -> None:
+        """Stored data of a closed day changed: drop cached results and
+        move data_version()."""
+        self._closed_writes += 1
+        if self._cache is not None:
+            self._cache.clear()
+
+    async def data_version(self, d0: str, d1: str) -> str:
+        """Tag that changes whenever the dashboard reads of [d0, d1] may:
+        a new UTC day, the funnel config, a write to a closed day (seen by
+        this process, like the result cache), a failed read and, if the
+        range reaches today, the last event id stored for today. One index
+        seek, so callers can check it before running any read."""
+        today = _utc_today()
+        parts: List[Any] = [d0, d1, today, self.ready, self._closed_writes,
+                            self._read_errors, self.config.funnels, self.config.goals]
+        if self.ready and d1 >= today:
+            for rel, attach in self._raw_sources(today, today):
+                rows = await self._query(
+                    f"SELECT MAX(id) AS id FROM {rel} WHERE day = ?", (today,), attach
+                )
+                parts.append(rows[0]["id"] if rows else None)
+        return hashlib.md5(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    async def _sessions_reopened(self, rows: List[Tuple], today: str) -> bool:
+        """Whether the batch extended a session that started on a closed day
+        (so its `sessions` row there changed). Sessions known to have
+        started today are remembered, so most batches need no query."""
+        if self._started_today[0] != today:
+            self._started_today = (today, set())
+        known = self._started_today[1]
+        sids = sorted({r[_SESSION] for r in rows if r[_SESSION] is not None} - known)
+        if not sids:
+            return False
+        old = {r["value"] for r in await self._query(
+            "SELECT d.value FROM dims d JOIN sessions s ON s.session_id = d.id"
+            f" WHERE d.kind = 'session_id' AND d.value IN ({','.join('?' * len(sids))})"
+            " AND s.day < ?", tuple(sids) + (today,),
+        )}
+        known.update(set(sids) - old)
+        return bool(old)
+
+    async def _write_batch(self, rows: List[Tuple]) -> bool:
+        """Store a batch of event rows and fold it into the rollups, in one
+        transaction."""
+        if not self.ready:
+            return False
+        if not rows:
+            return True
+        derived = self._rollups(rows)
+        sketches = self._sketch_batch(rows)
+        topk = self._topk_batch(rows)
+        flags = self._flags(rows)
+        try:
+            rows = await self._encode(rows)
+        except Exception as e:
+            logger.error("Analytics dictionary lookup failed (%d rows): %s", len(rows), e)
+            return False
+        derived += self._edge_upserts(rows)  # before the session upserts
+        derived.append(self._session_upserts(self._session_batch(rows, flags)))
+        if self.is_pg and self.ingest_mode == "copy":
+            try:
+                async with self._pool.acquire() as con:
+                    async with con.transaction():
+                        await con.copy_records_to_table(
+                            "events", records=rows, columns=_COLUMNS
+                        )
+                        await self._pg_derived(con, derived)
+                        await self._merge_sketches(con, sketches)
+                        await self._merge_topk(con, topk)
+                return True
+            except Exception as e:
+                logger.warning("Analytics COPY failed, falling back to INSERT: %s", e)
+        if not self.is_pg and self.partition != "none":
+            return await self._write_partitioned(rows, derived, sketches, topk)
+        return await self._exec_many(_INSERT, rows, derived, sketches, topk)
+
+    async def _encode(self, rows: List[Tuple]) -> List[Tuple]:
+        """Rows with their _DICT_COLUMNS values replaced by `dims` ids."""
+        ids: Dict[Tuple[str, str], int] = {}
+        missing = set()
+        for r in rows:
+            for c, i in _DICT_IDX:
+                v = r[i]
+                if v is not None and (c, v) not in ids:
+                    got = self._ids.get((c, v))
+                    if got is None:
+                        missing.add((c, v))
+                    else:
+                        ids[(c, v)] = got
+        if missing:
+            ids.update(await self._dims_resolve(sorted(missing)))
+        out = []
+        for r in rows:
+            r = list(r)
+            for c, i in _DICT_IDX:
+                if r[i] is not None:
+                    r[i] = ids[(c, r[i])]
+            out.append(tuple(r))
+        return out
+
+    async def _dims_resolve(self, keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], int]:
+        """Ids of (kind, value) pairs, adding the new ones to `dims`.
+
+        Committed on its own, before the batch that uses them: an id in the
+        cache must never belong to a rolled back row.
+        """
+        found: Dict[Tuple[str, str], int] = {}
+        if self.is_pg:
+            kinds, values = [k for k, _ in keys], [v for _, v in keys]
+            async with self._pool.acquire() as con:
+                await con.execute(
+                    "INSERT INTO dims (kind, value)"
+                    " SELECT * FROM unnest($1::text[], $2::text[])"
+                    " ON CONFLICT (kind, value) DO NOTHING", kinds, values,
+                )
+                rows = await con.fetch(
+                    "SELECT d.kind, d.value, d.id FROM dims d"
+                    " JOIN unnest($1::text[], $2::text[]) AS u(kind, value)"
+                    " ON d.kind = u.kind AND d.value = u.value", kinds, values,
+                )
+            found = {(r[0], r[1]): r[2] for r in rows}
+        else:
+            async with self._lock:
+                try:
+                    await self._sqlite.executemany(
+                        "INSERT OR IGNORE INTO dims (kind, value) VALUES (?, ?)", keys
+                    )
+                    for i in range(0, len(keys), 400):
+                        chunk = keys[i:i + 400]
+                        cur = await self._sqlite.execute(
+                            "SELECT kind, value, id FROM dims WHERE {}".format(
+                                " OR ".join(["(kind = ? AND value = ?)"] * len(chunk))),
+                            [x for k in chunk for x in k],
+                        )
+                        found.update({(r[0], r[1]): r[2] for r in await cur.fetchall()})
+                    await self._sqlite.commit()
+                except Exception:
+                    with contextlib.suppress(Exception):
+                        await self._sqlite.rollback()
+                    raise
+        for k, v in found.items():
+            self._ids.put(k, v)
+        return found
+
+    async def _dims_find(self, kind: str, value: str) -> Optional[int]:
+        """Read-only id lookup (None: the value was never stored)."""
+        got = self._ids.get((kind, value))
+        if got is None:
+            rows = await self._query(
+                "SELECT id FROM dims WHERE kind = ? AND value = ?", (kind, value)
+            )
+            if rows:
+                got = rows[0]["id"]
+                self._ids.put((kind, value), got)
+        return got
+
+    async def _dims_gc(self) -> None:
+        """After retention: drop session/visitor ids no stored event can
+        reference any more. Those values are time-local (per visit, per-day
+        hash), so ids below the lowest one still referenced are garbage; the
+        other kinds are small and kept.
+
+        Runs under _dims_lock, so no batch is between looking ids up and
+        storing them, and evicts the deleted ids from the id cache before
+        the next batch can use them."""
+        rels = self._raw_tables()
+        async with self._dims_lock:
+            for kind in ("session_id", "visitor_hash"):
+                lows = []
+                for rel, parts in rels:
+                    rows = await self._query(f"SELECT MIN({kind}) AS low FROM {rel}", (), parts)
+                    if not rows:
+                        return  # failed read: keep everything
+                    if rows[0]["low"] is not None:
+                        lows.append(rows[0]["low"])
+                if lows:
+                    low = min(lows)
+                    await self._exec("DELETE FROM dims WHERE kind = ? AND id < ?", (kind, low))
+                    self._ids.discard(lambda k, v: k[0] == kind and v < low)
+
+    async def _write_partitioned(self, rows: List[Tuple],
+                                 derived: List[Tuple[str, List[Tuple]]],
+                                 sketches: Dict[Tuple[str, str], HLL],
+                                 topk: Dict[Tuple[str, str], TopK]) -> bool:
+        groups: Dict[str, List[Tuple]] = collections.defaultdict(list)
+        for r in rows:
+            groups[_period(r[_DAY], "month")].append(r)
+        periods = sorted(groups)
+        try:
+            async with self._lock:
+                for i in range(0, len(periods), _ATTACH_MAX):
+                    chunk = periods[i:i + _ATTACH_MAX]
+                    await self._sqlite_attach(self._sqlite, chunk, create=True)
+                    for p in chunk:
+                        await self._sqlite.executemany(
+                            _INSERT.replace("INTO events", f"INTO p{p}.events", 1),
+                            groups[p],
+                        )
+                for dsql, drows in derived:
+                    await self._sqlite.executemany(dsql, drows)
+                await self._merge_sketches(self._sqlite, sketches)
+                await self._merge_topk(self._sqlite, topk)
+                await self._sqlite.commit()
+            return True
+        except Exception as e:
+            logger.error("Analytics batch insert failed (%d rows): %s", len(rows), e)
+            with contextlib.suppress(Exception):
+                await self._sqlite.rollback()
+            return False
+
+    async def _ping(self) -> bool:
         try:
             if self.is_pg:
                 async with self._pool.acquire() as con:
-                    rows = await con.fetch(self._to_pg(sql), *params)
-                    return [dict(r) for r in rows]
+                    await con.fetchval("SELECT 1")
             else:
                 async with self._lock:
-                    cur = await self._sqlite.execute(sql, params)
-                    rows = await cur.fetchall()
-                    return [dict(r) for r in rows]
+                    await self._sqlite.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    async def _fetch(self, sql: str, params: Tuple = (), attach: List[str] = ()) -> List:
+        """Run a read and return its rows (asyncpg Records / sqlite3.Rows),
+        letting errors propagate; `attach` lists SQLite partitions the SQL
+        refers to."""
+        if self.is_pg:
+            async with self._pool.acquire() as con:
+                return await con.fetch(self._to_pg(sql), *params)
+        async with self._sqlite_reader() as con:
+            if attach:
+                await self._sqlite_attach(con, list(attach))
+            cur = await con.execute(sql, params)
+            return await cur.fetchall()
+
+    async def _query(self, sql: str, params: Tuple = (),
+                     attach: List[str] = ()) -> List[Dict[str, Any]]:
+        """Like _fetch, but rows as dicts and an empty result on failure."""
+        if not self.ready:
+            return []
+        try:
+            return [dict(r) for r in await self._fetch(sql, params, attach)]
         except Exception as e:
             logger.error("Analytics query failed: %s", e)
+            self._read_errors += 1
             return []
 
+    async def iter_events(self, d0: str, d1: str,
+                          chunk: int = 5000) -> AsyncIterator[List[Tuple]]:
+        """Raw event rows (tuples in EVENT_COLUMNS order) for [d0, d1], ordered
+        by day and id, `chunk` rows at a time.
+
+        Keyset-paged on the (day, id) index: each page is its own short query
+        resuming after the last row sent, and the connection goes back to the
+        pool in between, so a slow download holds no connection (nor, on
+        :memory:, the writer lock). Errors propagate (a half-sent stream cannot
+        be turned into an empty result)."""
+        if not self.ready:
+            return
+        if self.is_pg or self.partition == "none":
+            tables = [("events", [])]
+        else:  # one partition at a time: days never span two
+            tables = [
+                (f"p{p}.events", [p]) for p in _periods(d0, d1, "month")
+                if os.path.exists(self._partition_path(p))
+            ]
+        for table, parts in tables:
+            sql = (f"SELECT {_DECODED_COLS} FROM {table} AS events{_DECODE_JOINS}"
+                   " WHERE {where} ORDER BY events.day, events.id LIMIT ?")
+            where, args, in_day = "events.day >= ? AND events.day <= ?", (d0, d1), False
+            while True:
+                rows = await self._fetch(sql.format(where=where), args + (chunk,), parts)
+                if rows:
+                    yield [tuple(r)[1:] for r in rows]  # drop events.id
+                    last = (rows[-1]["day"], rows[-1]["id"])
+                if len(rows) == chunk:  # rest of the last row's day ...
+                    where, args, in_day = "events.day = ? AND events.id > ?", last, True
+                elif in_day:  # ... then the days after it
+                    where, args, in_day = (
+                        "events.day > ? AND events.day <= ?", (last[0], d1), False
+                    )
+                else:
+                    break
+
+    async def event_days(self, d0: Optional[str] = None,
+                         d1: Optional[str] = None) -> Dict[str, int]:
+        """Raw event count per day in [d0, d1] (open-ended where None)."""
+        out: Dict[str, int] = {}
+        sources = self._sources(d0, d1) if d0 and d1 else self._sources()
+        for src, parts in sources:
+            for r in await self._query(
+                f"SELECT day, COUNT(*) AS n FROM {src}"
+                " WHERE day BETWEEN ? AND ? GROUP BY day",
+                (d0 or "0000-00-00", d1 or "9999-99-99"), parts,
+            ):
+                out[r["day"]] = out.get(r["day"], 0) + int(r["n"])
+        return out
+
     # -- writes -----------------------------------------------------------
-    async def insert_event(self, ev: Dict[str, Any]) -> None:
-        now = _dt.datetime.utcnow()
-        await self._exec(
-            _INSERT,
-            (
-                now.isoformat(timespec="seconds") + "Z",
-                now.strftime("%Y-%m-%d"),
-                ev["event_type"],
-                ev.get("session_id"),
-                ev.get("visitor_hash"),
-                ev.get("page"),
-                ev.get("lang"),
-                ev.get("referrer_host"),
-                ev.get("utm_source"),
-                ev.get("device"),
-                ev.get("country"),
-                ev.get("scroll_depth"),
-                json.dumps(ev.get("meta")) if ev.get("meta") else None,
-            ),
+    @staticmethod
+    def _row(ev: Dict[str, Any]) -> Tuple:
+        # dated when the client captured it: batched beacons send age_ms
+        now = _dt.datetime.utcnow() - _dt.timedelta(milliseconds=ev.get("age_ms") or 0)
+        return (
+            now.isoformat(timespec="seconds") + "Z",
+            now.strftime("%Y-%m-%d"),
+            ev["event_type"],
+            ev.get("session_id"),
+            ev.get("visitor_hash"),
+            ev.get("page"),
+            ev.get("lang"),
+            ev.get("referrer_host"),
+            ev.get("utm_source"),
+            ev.get("device"),
+            ev.get("country"),
+            ev.get("scroll_depth"),
+            json.dumps(ev.get("meta")) if ev.get("meta") else None,
+            ev.get("weight"),
+            page_class(ev.get("page")),
         )
 
+    def enqueue(self, ev: Dict[str, Any]) -> bool:
+        """Queue an event for the background writer. Never blocks.
+
+        Past the SHED_AT budget, SAMPLED_TYPES are kept 1-in-SAMPLE_1_IN with
+        a matching weight. When the queue is full, ALWAYS_KEEP events go to
+        the overflow list (spooled by the writer) and the rest are dropped.
+        While shedding, an event that gives its session a funnel/goal step
+        bit it did not have yet is kept like ALWAYS_KEEP (weight 1), so
+        step counts stay exact. Returns False when the event was not kept.
+        Every event (kept or not) updates the live window.
+        """
+        self.live.add(ev)
+        q = self._queue
+        etype = ev["event_type"]
+        row = self._row(ev)
+        keep = etype in ALWAYS_KEEP
+        if not keep and q.qsize() >= SHED_AT * q.maxsize:
+            keep = self._new_steps(row)
+            if etype in SAMPLED_TYPES and not keep:
+                if random.randrange(SAMPLE_1_IN):
+                    self.sampled += 1
+                    return False
+                row = row[:_WEIGHT] + (SAMPLE_1_IN,) + row[_WEIGHT + 1:]
+        try:
+            q.put_nowait(row)
+            return True
+        except asyncio.QueueFull:
+            if keep and len(self._overflow) < q.maxsize:
+                self._overflow.append(row)
+                return True
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning("Analytics queue full, %d events dropped", self.dropped)
+            return False
+
+    def _new_steps(self, row: Tuple) -> bool:
+        """Whether `row` sets a step bit its session has not set since
+        shedding started (remembered for the last _SHED_SESSIONS sessions)."""
+        sid = row[_SESSION]
+        if sid is None or not self._tags:
+            return False
+        f = self._flags([row])[0]
+        seen = self._shed_steps.get(sid) or 0
+        if not f & ~seen:
+            return False
+        self._shed_steps.put(sid, seen | f)
+        return True
+
+    def ingest_stats(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize() + len(self._overflow),
+            "dropped": self.dropped,
+            "sampled": self.sampled,
+            "spooled": self.spooled,
+        }
+
+    async def insert_event(self, ev: Dict[str, Any]) -> None:
+        """Write one event immediately, bypassing the queue."""
+        await self._store([self._row(ev)])
+
+    async def _store(self, rows: List[Tuple]) -> None:
+        """Write a batch, or park it in the spool if the DB can't take it."""
+        if await self._write_events(rows):
+            return
+        await self._spool_rows(rows)
+
+    async def _spool_rows(self, rows: List[Tuple]) -> None:
+        if self._spool is None:
+            self.dropped += len(rows)
+            return
+        try:
+            async with self._spool_lock:
+                await asyncio.to_thread(self._spool.append, rows)
+            self.spooled += len(rows)
+        except Exception as e:
+            self.dropped += len(rows)
+            logger.error("Analytics spool write failed (%d rows): %s", len(rows), e)
+
+    async def _supervise(self) -> None:
+        """Reconnect while the DB is down; replay the spool once it is up."""
+        while True:
+            try:
+                if not self.ready:
+                    await self._open()
+                if self.ready and self._spool is not None:
+                    await self._replay()
+                if self.ready and time.monotonic() >= self._next_maintenance:
+                    self._next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL
+                    await self._maintain()
+            except Exception as e:
+                logger.error("Analytics supervisor error: %s", e)
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    async def _replay(self) -> None:
+        async with self._spool_lock:
+            if not await asyncio.to_thread(self._spool.pending):
+                return
+            rows = await asyncio.to_thread(self._spool.claim)
+        done = replayed = 0
+        while done < len(rows):
+            batch = rows[done:done + BATCH_SIZE]
+            if await self._write_events(batch):
+                replayed += len(batch)
+            elif await self._ping():
+                # DB is fine, so the batch itself is bad: don't retry forever.
+                logger.error("Dropping %d unreplayable spooled events", len(batch))
+                self.dropped += len(batch)
+            else:
+                break
+            done += len(batch)
+        async with self._spool_lock:
+            await asyncio.to_thread(self._spool.settle, rows[done:])
+        if replayed:
+            logger.info("Replayed %d spooled analytics events", replayed)
+
+    async def _drain(self) -> None:
+        q = self._queue
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            item = await q.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = loop.time() + FLUSH_INTERVAL
+            while len(batch) < BATCH_SIZE:
+                try:
+                    item = q.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(q.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            await self._store(batch)
+            if self._overflow:
+                # The queue was full, so the DB is behind: park these on disk.
+                overflow, self._overflow = self._overflow, []
+                await self._spool_rows(overflow)
+        # Shutdown: anything enqueued after the sentinel still gets written.
+        rest = []
+        while not q.empty():
+            item = q.get_nowait()
+            if item is not _STOP:
+                rest.append(item)
+        rest += self._overflow
+        self._overflow = []
+        for i in range(0, len(rest), BATCH_SIZE):
+            await self._store(rest[i:i + BATCH_SIZE])
+
     # -- reads (dashboard) ------------------------------------------------
+    # Everything is read from the per-day aggregates, so a query costs the
+    # same whatever the traffic: hits, pageviews and leads from the rollups
+    # (agg_dims, agg_counts), distinct counts by merging the day sketches
+    # (agg_hll; approximate, ~1.6% standard error, see sketches.py). The
+    # funnel and session metrics scan `sessions` (one row per session, not
+    # per event).
+    # Each read is split by _closed() into closed days, served from the
+    # result cache, and the live rest, which is queried and merged in.
+    def _closed(self, d0: str, d1: str) -> Tuple[Optional[Tuple[str, str]],
+                                                   Optional[Tuple[str, str]]]:
+        """Split [d0, d1] into (closed days, live days); either may be None."""
+        today = _utc_today()
+        if self._cache is None or d0 >= today:
+            return None, (d0, d1)
+        if d1 < today:
+            return (d0, d1), None
+        yesterday = (_dt.date.fromisoformat(today) - _dt.timedelta(days=1)).isoformat()
+        return (d0, yesterday), (today, d1)
+
+    async def _cached(self, key: Tuple, compute) -> Any:
+        val = self._cache.get(key)
+        if val is None:
+            gen, errors = self._cache.generation, self._read_errors
+            val = await compute()
+            if gen == self._cache.generation and errors == self._read_errors:
+                self._cache.put(key, val)
+        return val
+
+    async def _agg_sum(self, table: str, cols: Tuple[str, ...],
+                       d0: str, d1: str) -> Dict[str, int]:
+        async def query(a: str, b: str) -> Dict[str, int]:
+            sums = ", ".join(f"SUM({c}) AS {c}" for c in cols)
+            rows = await self._query(
+                f"SELECT {sums} FROM {table} WHERE day BETWEEN ? AND ?", (a, b)
+            )
+            return {k: int(v or 0) for k, v in rows[0].items()} if rows else {}
+
+        closed, live = self._closed(d0, d1)
+        out: Dict[str, int] = collections.Counter()
+        if closed:
+            out.update(await self._cached(("sum", table, cols) + closed,
+                                          lambda: query(*closed)))
+        if live:
+            out.update(await query(*live))
+        return {k: out.get(k, 0) for k in cols}
+
+    async def _uniques(self, kinds: Tuple[str, ...], d0: str, d1: str) -> Dict[str, int]:
+        async def query(a: str, b: str) -> Dict[str, bytes]:
+            rows = await self._query(
+                "SELECT kind, regs FROM agg_hll WHERE day BETWEEN ? AND ?"
+                f" AND kind IN ({','.join('?' * len(kinds))})", (a, b) + kinds,
+            )
+            regs: Dict[str, List[bytes]] = collections.defaultdict(list)
+            for r in rows:
+                regs[r["kind"]].append(r["regs"])
+            return {k: HLL.union(v).to_bytes() for k, v in regs.items()}
+
+        closed, live = self._closed(d0, d1)
+        parts: List[Dict[str, bytes]] = []
+        if closed:
+            parts.append(await self._cached(("hll", kinds) + closed,
+                                            lambda: query(*closed)))
+        if live:
+            parts.append(await query(*live))
+        out = {}
+        for k in kinds:
+            regs = [p[k] for p in parts if k in p]
+            out[k] = HLL.union(regs).count() if regs else 0
+        return out
+
+    async def _session_groups(self, d0: str, d1: str) -> List[List[int]]:
+        """[steps, sessions, bounces, seconds] per distinct steps bitmask of
+        the sessions in [d0, d1]: one pass over `sessions`, a handful of rows
+        out. A bounce is a session with at most one pageview."""
+        async def query(a: str, b: str) -> List[List[int]]:
+            rows = await self._query(
+                "SELECT steps, COUNT(*) AS n,"
+                " SUM(CASE WHEN pageviews <= 1 THEN 1 ELSE 0 END) AS bounces,"
+                " SUM(last_ts - first_ts) AS seconds"
+                " FROM sessions WHERE day BETWEEN ? AND ? GROUP BY steps", (a, b),
+            )
+            return [[int(r["steps"]), int(r["n"]), int(r["bounces"] or 0),
+                     int(r["seconds"] or 0)] for r in rows]
+
+        closed, live = self._closed(d0, d1)
+        out: List[List[int]] = []
+        if closed:
+            out += await self._cached(("sess",) + closed, lambda: query(*closed))
+        if live:
+            out += await query(*live)
+        return out
+
+    async def _sessions_with(self, needs: List[int], d0: str, d1: str) -> List[int]:
+        """Sessions in [d0, d1] having all the bits of each mask in `needs`
+        (0: every session). Days before `sessions` existed come from the
+        legacy step sketches, which answer a single legacy bit only."""
+        out = [0] * len(needs)
+        start = max(d0, self._sessions_from or d0)
+        if start <= d1:
+            for steps, n, _, _ in await self._session_groups(start, d1):
+                for i, need in enumerate(needs):
+                    if steps & need == need:
+                        out[i] += n
+        if d0 < start:
+            before = (_dt.date.fromisoformat(start) - _dt.timedelta(days=1)).isoformat()
+            kinds = {1 << self._bits[funnels.match_key(m)]: k for k, m in funnels.LEGACY
+                     if funnels.match_key(m) in self._bits}
+            kinds[0] = "sessions"
+            n = await self._uniques(tuple(sorted(set(kinds.values()))), d0, min(d1, before))
+            for i, need in enumerate(needs):
+                if need in kinds:
+                    out[i] += n[kinds[need]]
+        return out
+
+    def _need(self, key: Optional[str]) -> Optional[int]:
+        """Bit mask of a compiled match key (0 for every session, None when
+        the key has no bit)."""
+        if key is None:
+            return 0
+        bit = self._bits.get(key)
+        return None if bit is None else 1 << bit
+
+    async def funnels(self, d0: str, d1: str) -> Dict[str, Dict[str, int]]:
+        """{funnel id: {step id: sessions}} for the configured funnels; see
+        funnels.py for how steps are matched."""
+        needs: List[int] = []
+        where: List[Tuple[str, str, Optional[int]]] = []
+        for f in self.config.funnels:
+            acc: Optional[int] = 0
+            for step in f["steps"]:
+                need = self._need(step["key"])
+                if f["cumulative"]:
+                    acc = None if acc is None or need is None else acc | need
+                    need = acc
+                if need is None:
+                    where.append((f["id"], step["id"], None))
+                else:
+                    where.append((f["id"], step["id"], len(needs)))
+                    needs.append(need)
+        counts = await self._sessions_with(needs, d0, d1)
+        out: Dict[str, Dict[str, int]] = {}
+        for fid, sid, i in where:
+            out.setdefault(fid, {})[sid] = 0 if i is None else counts[i]
+        return out
+
     async def funnel(self, d0: str, d1: str) -> Dict[str, int]:
-        sql = """
-        SELECT
-          COUNT(DISTINCT session_id) AS landing,
-          COUNT(DISTINCT CASE WHEN event_type='scroll' AND scroll_depth>=50
-                THEN session_id END) AS scrolled,
-          COUNT(DISTINCT CASE WHEN event_type='nav_click'
-                 OR (event_type='pageview' AND (page LIKE '%portfolio%'
-                     OR page LIKE '%process%' OR page LIKE '%/examples/%'))
-                THEN session_id END) AS explored,
-          COUNT(DISTINCT CASE WHEN event_type='form_view'
-                THEN session_id END) AS form_view,
-          COUNT(DISTINCT CASE WHEN event_type='form_submit'
-                THEN session_id END) AS form_submit
-        FROM events WHERE day BETWEEN ? AND ?
-        """
-        rows = await self._query(sql, (d0, d1))
-        if not rows:
-            return {k: 0 for k in
-                    ("landing", "scrolled", "explored", "form_view", "form_submit")}
-        return {k: int(v or 0) for k, v in rows[0].items()}
-
-    async def timeseries(self, d0: str, d1: str) -> List[Dict[str, Any]]:
-        sql = """
-        SELECT day,
-          COUNT(DISTINCT visitor_hash) AS visitors,
-          SUM(CASE WHEN event_type='pageview' THEN 1 ELSE 0 END) AS pageviews
-        FROM events WHERE day BETWEEN ? AND ?
-        GROUP BY day ORDER BY day
+        """The first (main) configured funnel: {step id: sessions}."""
+        return (await self.funnels(d0, d1))[self.config.funnels[0]["id"]]
+
+    async def goals(self, d0: str, d1: str) -> Dict[str, int]:
+        """{goal id: sessions that reached it}."""
+        goals = [(g["id"], self._need(g["key"])) for g in self.config.goals]
+        counts = await self._sessions_with([n for _, n in goals if n is not None], d0, d1)
+        it = iter(counts)
+        return {gid: 0 if n is None else next(it) for gid, n in goals}
+
+    async def session_stats(self, d0: str, d1: str) -> Dict[str, Any]:
+        """Bounce rate (%) and average duration (seconds) of the sessions in
+        [d0, d1], from the same groups as funnel()."""
+        n = bounces = seconds = 0
+        for _, c, b, secs in await self._session_groups(d0, d1):
+            n, bounces, seconds = n + c, bounces + b, seconds + secs
+        return {
+            "sessions": n,
+            "bounce_rate": round(bounces / n * 100, 1) if n else 0.0,
+            "avg_duration_s": round(seconds / n) if n else 0,
+        }
+
+    async def entry_pages(self, d0: str, d1: str, limit: int = 12) -> List[Dict[str, Any]]:
+        """Top `limit` entry pages: sessions that started there and their
+        bounce rate (%)."""
+        return await self._session_pages("entry_page", d0, d1, limit)
+
+    async def exit_pages(self, d0: str, d1: str, limit: int = 12) -> List[Dict[str, Any]]:
+        """Top `limit` exit pages (last page seen), like entry_pages()."""
+        return await self._session_pages("exit_page", d0, d1, limit)
+
+    async def _session_pages(self, column: str, d0: str, d1: str,
+                             limit: int) -> List[Dict[str, Any]]:
+        async def query(a: str, b: str) -> Dict[str, List[int]]:
+            rows = await self._query(
+                "SELECT d.value AS page, g.n, g.bounces FROM ("
+                f" SELECT {column}, COUNT(*) AS n,"
+                "  SUM(CASE WHEN pageviews <= 1 THEN 1 ELSE 0 END) AS bounces"
+                f" FROM sessions WHERE day BETWEEN ? AND ? GROUP BY {column}"
+                f") g LEFT JOIN dims d ON d.id = g.{column}", (a, b),
+            )
+            return {r["page"] or "(none)": [int(r["n"]), int(r["bounces"] or 0)]
+                    for r in rows}
+
+        closed, live = self._closed(d0, d1)
+        parts: List[Dict[str, List[int]]] = []
+        if closed:
+            parts.append(await self._cached((column,) + closed, lambda: query(*closed)))
+        if live:
+            parts.append(await query(*live))
+        total: Dict[str, List[int]] = {}
+        for p in parts:
+            for page, (n, b) in p.items():
+                t = total.setdefault(page, [0, 0])
+                t[0], t[1] = t[0] + n, t[1] + b
+        ranked = sorted(total.items(), key=lambda kv: (-kv[1][0], kv[0]))[:limit]
+        return [{"label": page, "sessions": n, "bounce_rate": round(b / n * 100, 1)}
+                for page, (n, b) in ranked]
+
+    async def transitions(self, d0: str, d1: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """Top `limit` page-to-page transitions ({"from", "to", "count"}) in
+        [d0, d1], from agg_edges."""
+        async def query(a: str, b: str) -> Dict[str, int]:
+            rows = await self._query(
+                "SELECT s.value AS src, t.value AS dst, g.n FROM ("
+                " SELECT src, dst, SUM(n) AS n FROM agg_edges"
+                " WHERE day BETWEEN ? AND ? GROUP BY src, dst"
+                ") g LEFT JOIN dims s ON s.id = g.src LEFT JOIN dims t ON t.id = g.dst",
+                (a, b),
+            )
+            # "src\tdst" keys: the cache is persisted as JSON
+            return {f"{r['src']}\t{r['dst']}": int(r["n"]) for r in rows}
+
+        closed, live = self._closed(d0, d1)
+        total: Dict[str, int] = collections.Counter()
+        if closed:
+            total.update(await self._cached(("edges",) + closed, lambda: query(*closed)))
+        if live:
+            total.update(await query(*live))
+        ranked = sorted(total.items(), key=lambda kv: (-kv[1], kv[0]))[:limit]
+        return [dict(zip(("from", "to"), k.split("\t")), count=n) for k, n in ranked]
+
+    async def timeseries(self, d0: str, d1: str,
+                         granularity: str = "day") -> List[Dict[str, Any]]:
+        """Visitors and pageviews per day or, with granularity "hour", per
+        UTC hour (rows also get "hour": 0-23), from the per-day or per-hour
+        rollups and sketches."""
+        if granularity == "hour":
+            return await self._timeseries_hourly(d0, d1)
+
+        async def query(a: str, b: str) -> List[Dict[str, Any]]:
+            visitors = await self._query(
+                "SELECT day, regs FROM agg_hll WHERE kind = 'visitors'"
+                " AND day BETWEEN ? AND ? ORDER BY day", (a, b),
+            )
+            pageviews = {
+                r["day"]: int(r["pageviews"] or 0) for r in await self._query(
+                    "SELECT day, pageviews FROM agg_counts WHERE day BETWEEN ? AND ?",
+                    (a, b),
+                )
+            }
+            return [
+                {"day": r["day"], "visitors": HLL(r["regs"]).count(),
+                 "pageviews": pageviews.get(r["day"], 0)}
+                for r in visitors
+            ]
+
+        closed, live = self._closed(d0, d1)
+        out: List[Dict[str, Any]] = []
+        if closed:
+            out += await self._cached(("ts",) + closed, lambda: query(*closed))
+        if live:
+            out += await query(*live)
+        return out
+
+    async def _timeseries_hourly(self, d0: str, d1: str) -> List[Dict[str, Any]]:
+        async def query(a: str, b: str) -> List[Dict[str, Any]]:
+            visitors = {
+                (r["day"], int(r["kind"][len(_HOURLY_SKETCH):])): HLL(r["regs"]).count()
+                for r in await self._query(
+                    "SELECT day, kind, regs FROM agg_hll WHERE day BETWEEN ? AND ?"
+                    " AND kind LIKE ?", (a, b, _HOURLY_SKETCH + "%"),
+                )
+            }
+            pageviews = {
+                (r["day"], int(r["hour"])): int(r["pageviews"] or 0)
+                for r in await self._query(
+                    "SELECT day, hour, pageviews FROM agg_hours WHERE day BETWEEN ? AND ?",
+                    (a, b),
+                )
+            }
+            return [
+                {"day": day, "hour": hour, "visitors": visitors.get((day, hour), 0),
+                 "pageviews": pageviews.get((day, hour), 0)}
+                for day, hour in sorted(set(visitors) | set(pageviews))
+            ]
+
+        closed, live = self._closed(d0, d1)
+        out: List[Dict[str, Any]] = []
+        if closed:
+            out += await self._cached(("tsh",) + closed, lambda: query(*closed))
+        if live:
+            out += await query(*live)
+        return out
+
+    async def breakdowns(self, fields: Tuple[str, ...], d0: str, d1: str,
+                         limit: int = 12) -> Dict[str, List[Dict[str, Any]]]:
+        """Top `limit` values of several dimensions: TOPK_FIELDS from the
+        per-day top-value summaries, the others in one scan of agg_dims."""
+        for f in fields:
+            if f not in BREAKDOWN_FIELDS:
+                raise KeyError(f)
+        top = tuple(f for f in fields if f in TOPK_FIELDS)
+        rest = tuple(f for f in fields if f not in TOPK_FIELDS)
+        found: Dict[str, List[Dict[str, Any]]] = {}
+        if top:
+            found.update(await self._top_values(top, d0, d1, limit))
+        if rest:
+            found.update(await self._dim_breakdowns(rest, d0, d1, limit))
+        return {f: found[f] for f in fields}
+
+    async def _top_values(self, fields: Tuple[str, ...], d0: str, d1: str,
+                          limit: int) -> Dict[str, List[Dict[str, Any]]]:
+        """Merge the agg_topk summaries of [d0, d1] (closed days cached as one
+        merged summary per field): at most TOPK_CAPACITY values per day and
+        field, whatever the traffic."""
+        dims = f"dim IN ({','.join('?' * len(fields))})"
+
+        async def query(a: str, b: str) -> Dict[str, str]:
+            rows = await self._query(
+                f"SELECT dim, summary FROM agg_topk WHERE day BETWEEN ? AND ? AND {dims}",
+                (a, b) + fields,
+            )
+            parts: Dict[str, List[TopK]] = collections.defaultdict(list)
+            for r in rows:
+                parts[r["dim"]].append(TopK.from_json(r["summary"], TOPK_CAPACITY))
+            return {f: TopK.merge(p, TOPK_CAPACITY).to_json() for f, p in parts.items()}
+
+        closed, live = self._closed(d0, d1)
+        parts: Dict[str, List[TopK]] = {f: [] for f in fields}
+        stored = []
+        if closed:
+            stored.append(await self._cached(("topk", fields) + closed,
+                                             lambda: query(*closed)))
+        if live:
+            stored.append(await query(*live))
+        for summaries in stored:
+            for f, data in summaries.items():
+                parts[f].append(TopK.from_json(data, TOPK_CAPACITY))
+        return {
+            f: [{"label": v, "hits": n}
+                for v, n in TopK.merge(p, TOPK_CAPACITY).top(limit)]
+            for f, p in parts.items()
+        }
+
+    async def _dim_breakdowns(self, fields: Tuple[str, ...], d0: str, d1: str,
+                              limit: int) -> Dict[str, List[Dict[str, Any]]]:
+        """Top values of several dimensions in one scan of agg_dims.
+
+        Live-only ranges are ranked per dimension in SQL with ROW_NUMBER().
+        With closed days, their full per-value hits come from the cache and
+        the ranking happens after adding today's.
         """
-        return await self._query(sql, (d0, d1))
+        dims = f"dim IN ({','.join('?' * len(fields))})"
+        out: Dict[str, List[Dict[str, Any]]] = {f: [] for f in fields}
+        closed, live = self._closed(d0, d1)
+        if not closed:
+            rows = await self._query(
+                "SELECT dim, label, hits FROM ("
+                " SELECT dim, value AS label, SUM(hits) AS hits,"
+                "  ROW_NUMBER() OVER (PARTITION BY dim ORDER BY SUM(hits) DESC, value) AS rn"
+                f" FROM agg_dims WHERE day BETWEEN ? AND ? AND {dims}"
+                " GROUP BY dim, value"
+                ") ranked WHERE rn <= ? ORDER BY dim, rn",
+                (d0, d1) + fields + (int(limit),),
+            )
+            for r in rows:
+                out[r["dim"]].append({"label": r["label"], "hits": r["hits"]})
+            return out
+
+        async def query(a: str, b: str) -> Dict[str, Dict[str, int]]:
+            rows = await self._query(
+                "SELECT dim, value, SUM(hits) AS hits FROM agg_dims"
+                f" WHERE day BETWEEN ? AND ? AND {dims} GROUP BY dim, value",
+                (a, b) + fields,
+            )
+            hits: Dict[str, Dict[str, int]] = {f: {} for f in fields}
+            for r in rows:
+                hits[r["dim"]][r["value"]] = int(r["hits"] or 0)
+            return hits
+
+        parts = [await self._cached(("dims", fields) + closed, lambda: query(*closed))]
+        if live:
+            parts.append(await query(*live))
+        for f in fields:
+            total: Dict[str, int] = collections.Counter()
+            for p in parts:
+                total.update(p.get(f, {}))
+            ranked = sorted(total.items(), key=lambda kv: (-kv[1], kv[0]))[:limit]
+            out[f] = [{"label": k, "hits": v} for k, v in ranked]
+        return out
 
     async def breakdown(self, field: str, d0: str, d1: str,
                         limit: int = 12) -> List[Dict[str, Any]]:
-        allowed = {
-            "page": "page", "referrer_host": "referrer_host",
-            "device": "device", "country": "country", "lang": "lang",
-            "utm_source": "utm_source",
-        }
-        col = allowed[field]
-        sql = f"""
-        SELECT COALESCE({col}, 'direct' ) AS label, COUNT(*) AS hits
-        FROM events
-        WHERE event_type='pageview' AND day BETWEEN ? AND ?
-        GROUP BY COALESCE({col}, 'direct')
-        ORDER BY hits DESC LIMIT {int(limit)}
-        """
-        return await self._query(sql, (d0, d1))
+        return (await self.breakdowns((field,), d0, d1, limit))[field]
 
     async def totals(self, d0: str, d1: str) -> Dict[str, int]:
-        sql = """
-        SELECT
-          COUNT(DISTINCT visitor_hash) AS visitors,
-          COUNT(DISTINCT session_id) AS sessions,
-          SUM(CASE WHEN event_type='pageview' THEN 1 ELSE 0 END) AS pageviews,
-          SUM(CASE WHEN event_type='form_submit' THEN 1 ELSE 0 END) AS leads
-        FROM events WHERE day BETWEEN ? AND ?
+        out = await self._uniques(("visitors", "sessions"), d0, d1)
+        counts = await self._agg_sum("agg_counts", ("pageviews", "leads"), d0, d1)
+        out.update({k: counts.get(k, 0) for k in ("pageviews", "leads")})
+        return out
+
+    # -- raw events (explorer) --------------------------------------------
+    async def events(self, d0: str, d1: str, filters: Optional[Dict[str, str]] = None,
+                     after: Optional[Tuple[str, int]] = None, limit: int = 100,
+                     ) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, int]]]:
+        """One page of raw events in [d0, d1], newest first, matching the
+        EVENT_FILTERS given in `filters`.
+
+        Keyset pagination on (day, id): pass the returned cursor back as
+        `after` for the next page (None when there is none). Every page is an
+        index range scan that starts at the cursor, so deep pages cost the
+        same as the first one (unlike OFFSET).
         """
-        rows = await self._query(sql, (d0, d1))
-        if not rows:
-            return {"visitors": 0, "sessions": 0, "pageviews": 0, "leads": 0}
-        return {k: int(v or 0) for k, v in rows[0].items()}
+        where, params = [], []
+        for f in EVENT_FILTERS:
+            v = (filters or {}).get(f)
+            if not v:
+                continue
+            if f in _DICT_COLUMNS:  # filter on the stored id (indexed)
+                v = await self._dims_find(f, v)
+                if v is None:
+                    return [], None
+            where.append(f" AND events.{f} = ?")
+            params.append(v)
+        # The cursor is applied as two index seeks (rest of its day, then the
+        # days before) rather than `(day, id) < (?, ?)`, which SQLite only
+        # bounds on `day` and would walk the whole cursor day.
+        if after:
+            segments = [("events.day = ? AND events.id < ?", (after[0], int(after[1])),
+                         after[0], after[0]),
+                        ("events.day >= ? AND events.day < ?", (d0, after[0]),
+                         d0, min(d1, after[0]))]
+        else:
+            segments = [("events.day BETWEEN ? AND ?", (d0, d1), d0, d1)]
+        out: List[Dict[str, Any]] = []
+        for cond, bounds, a, b in segments:
+            for rel, parts in reversed(self._raw_sources(a, b)):
+                if len(out) > limit:
+                    break
+                out += await self._query(
+                    f"SELECT {_DECODED_COLS} FROM {rel}{_DECODE_JOINS}"
+                    f" WHERE {cond}{''.join(where)}"
+                    " ORDER BY events.day DESC, events.id DESC LIMIT ?",
+                    bounds + tuple(params) + (limit + 1 - len(out),), parts,
+                )
+        if len(out) <= limit:
+            return out, None
+        out = out[:limit]
+        return out, (out[-1]["day"], out[-1]["id"])
@@ -0,0 +1,175 @@
+"""Columnar archive of raw analytics events: one Parquet file per day.
+
+    python3 backend/archive.py export [--dir DIR]
+    python3 backend/archive.py stats --from 2025-01-01 --to 2025-03-31 [--dir DIR]
+
+`export` streams closed days (before today, UTC) out of the analytics DB
+configured by DATABASE_URL, one day and one chunk at a time, into
+`events-YYYY-MM-DD.parquet` files (zstd; the low-cardinality dimension
+columns are Arrow dictionaries). It is incremental: a day is (re)written only
+when the DB holds more rows for it than its file, so reruns pick up new days
+and late rows, and files of days already dropped by retention are kept.
+
+`stats` answers the dashboard aggregates (totals, funnel, timeseries and the
+breakdowns) from the files with the columnar engine, exactly, without
+touching the DB. Needs pyarrow (and numpy for `stats`), imported lazily.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime as _dt
+import glob
+import json
+import logging
+import os
+import re
+from typing import Dict, List, Optional
+
+if __name__ == "__main__":  # CLI: analytics reads its settings at import
+    try:
+        from dotenv import load_dotenv
+
+        load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+    except ImportError:
+        pass
+
+import analytics as _an  # noqa: E402
+from pages import page_class  # noqa: E402
+
+logger = logging.getLogger("onda.analytics")
+
+ARCHIVE_DIR = os.getenv(
+    "ANALYTICS_ARCHIVE_DIR", os.path.join(_an._BASE_DIR, "backend", "archive")
+)
+_DICT_COLS = ("event_type", "page", "lang", "referrer_host", "utm_source",
+              "device", "country", "page_class")
+_INT_COLS = ("scroll_depth", "weight")
+
+
+def _schema():
+    import pyarrow as pa
+
+    def typ(c: str):
+        if c in _DICT_COLS:
+            return pa.dictionary(pa.int32(), pa.string())
+        return pa.int32() if c in _INT_COLS else pa.string()
+
+    return pa.schema([(c, typ(c)) for c in _an._COLUMNS])
+
+
+def day_path(out_dir: str, day: str) -> str:
+    return os.path.join(out_dir, f"events-{day}.parquet")
+
+
+def archived_days(out_dir: str) -> List[str]:
+    days = []
+    for f in glob.glob(os.path.join(glob.escape(out_dir), "events-*.parquet")):
+        m = re.fullmatch(r"events-(\d{4}-\d{2}-\d{2})\.parquet", os.path.basename(f))
+        if m:
+            days.append(m.group(1))
+    return sorted(days)
+
+
+async def export(db: "_an.AnalyticsDB", out_dir: str = ARCHIVE_DIR,
+                 through: Optional[str] = None) -> List[str]:
+    """Write every closed day (up to `through`) that is missing or behind.
+    Returns the days written."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _schema()
+    os.makedirs(out_dir, exist_ok=True)
+    if through is None:
+        through = (_dt.date.fromisoformat(_an._utc_today())
+                   - _dt.timedelta(days=1)).isoformat()
+    written = []
+    for day, n in sorted((await db.event_days(None, through)).items()):
+        path = day_path(out_dir, day)
+        if os.path.exists(path) and pq.ParquetFile(path).metadata.num_rows >= n:
+            continue
+        tmp = path + ".tmp"
+        with pq.ParquetWriter(tmp, schema, compression="zstd") as writer:
+            async for rows in db.iter_events(day, day, chunk=50000):
+                cols = list(zip(*rows))
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(col, type=f.type) for col, f in zip(cols, schema)],
+                    schema=schema,
+                ))
+        os.replace(tmp, path)
+        written.append(day)
+        logger.info("Archived %s (%d events) -> %s", day, n, path)
+    return written
+
+
+def _upgrade(table):
+    """Files written before page_class existed: derive it from `page` (per
+    dictionary value, not per row)."""
+    import pyarrow as pa
+
+    if "page_class" in table.column_names:
+        return table
+    page = table.unify_dictionaries().column("page").combine_chunks()
+    classes = pa.array([page_class(v) for v in page.dictionary.to_pylist()], pa.string())
+    derived = pa.DictionaryArray.from_arrays(page.indices, classes)
+    return table.append_column(_schema().field("page_class"), derived)
+
+
+def load(out_dir: str, d0: str, d1: str):
+    """Columnar engine over the archived days in [d0, d1]."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    from columnar import ColumnarEngine
+
+    paths = [day_path(out_dir, d) for d in archived_days(out_dir) if d0 <= d <= d1]
+    if paths:
+        table = pa.concat_tables([_upgrade(pq.read_table(p)) for p in paths])
+    else:
+        table = _schema().empty_table()
+    return ColumnarEngine.from_arrow(table)
+
+
+def stats(out_dir: str, d0: str, d1: str) -> Dict:
+    engine = load(out_dir, d0, d1)
+    return {
+        "range": {"from": d0, "to": d1},
+        "events": engine.rows,
+        "totals": engine.totals(d0, d1),
+        "funnel": engine.funnel(d0, d1),
+        "timeseries": engine.timeseries(d0, d1),
+        "breakdowns": engine.breakdowns(_an.BREAKDOWN_FIELDS, d0, d1),
+    }
+
+
+async def _export_cli(out_dir: str) -> None:
+    db = _an.AnalyticsDB(os.getenv("DATABASE_URL"))
+    await db.connect(background=False)
+    if not db.ready:
+        raise SystemExit("analytics DB not reachable")
+    try:
+        days = await export(db, out_dir)
+    finally:
+        await db.close()
+    print(f"exported {len(days)} day(s) to {out_dir}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    ap = argparse.ArgumentParser(description="Parquet archive of analytics events")
+    ap.add_argument("command", choices=("export", "stats"))
+    ap.add_argument("--dir", default=ARCHIVE_DIR)
+    ap.add_argument("--from", dest="d0")
+    ap.add_argument("--to", dest="d1")
+    args = ap.parse_args(argv)
+    if args.command == "export":
+        asyncio.run(_export_cli(args.dir))
+        return
+    days = archived_days(args.dir)
+    if not days:
+        raise SystemExit(f"no archived days in {args.dir}")
+    print(json.dumps(stats(args.dir, args.d0 or days[0], args.d1 or days[-1]), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Optional in-memory columnar engine for analytics aggregates (NumPy).
+
+Loads a date range of raw `events` into column arrays and answers the
+dashboard reads with vectorised NumPy instead of SQL. An offline tool: it
+backs archive.py's `stats` over Parquet files and scripts/bench_columnar.py,
+where a whole range is scanned once and then sliced many ways. The app does
+not serve panels from it; AnalyticsDB reads per-day rollups and sketches,
+whose cost follows the number of days, not of raw events (which retention
+may already have dropped).
+
+    engine = await ColumnarEngine.load(analytics_db, "2025-01-01", "2025-12-31")
+    engine.funnel("2025-03-01", "2025-03-31")
+
+Strings (day, event type, ids and every breakdown dimension) are dictionary
+encoded: each column is an int32 array of codes into a per-column value list.
+Breakdown dimensions encode NULL as 'direct', like COALESCE in the SQL path.
+
+funnel/breakdown/timeseries/totals return the same shapes as AnalyticsDB.
+Distinct counts here are exact, whereas AnalyticsDB reads HyperLogLog
+sketches (see sketches.py). NumPy is imported lazily, so nothing else in the
+app depends on it.
+"""
+from __future__ import annotations
+
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from analytics import BREAKDOWN_FIELDS, _COLUMNS, _EXPLORE_CLASSES
+
+_CODED = ("day", "event_type", "session_id", "visitor_hash") + BREAKDOWN_FIELDS
+_INTS = ("scroll_depth", "weight")
+
+
+class ColumnarEngine:
+    def __init__(self):
+        self.values: Dict[str, List[Optional[str]]] = {c: [] for c in _CODED}
+        self._index: Dict[str, Dict[Optional[str], int]] = {c: {} for c in _CODED}
+        self._buf: Dict[str, array] = {c: array("i") for c in _CODED + _INTS}
+        self.cols: Dict[str, Any] = {}
+        self.rows = 0
+
+    # -- loading ------------------------------------------------------------
+    @classmethod
+    async def load(cls, db, d0: str, d1: str) -> "ColumnarEngine":
+        """Scan [d0, d1] from an AnalyticsDB, one chunk at a time."""
+        engine = cls()
+        async for rows in db.iter_events(d0, d1, chunk=20000):
+            engine.extend(rows)
+        return engine.finish()
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple]) -> "ColumnarEngine":
+        engine = cls()
+        engine.extend(rows)
+        return engine.finish()
+
+    def extend(self, rows: Iterable[Tuple]) -> None:
+        """Append row tuples in analytics._COLUMNS order."""
+        coded = [(self._buf[c], self._index[c], self.values[c], _COLUMNS.index(c),
+                  c in BREAKDOWN_FIELDS) for c in _CODED]
+        depth, i_depth = self._buf["scroll_depth"], _COLUMNS.index("scroll_depth")
+        weight, i_weight = self._buf["weight"], _COLUMNS.index("weight")
+        n = 0
+        for r in rows:
+            for buf, index, values, i, direct in coded:
+                v = r[i]
+                if v is None and direct:
+                    v = "direct"
+                code = index.get(v)
+                if code is None:
+                    code = index[v] = len(values)
+                    values.append(v)
+                buf.append(code)
+            v = r[i_depth]
+            depth.append(-1 if v is None else int(v))
+            v = r[i_weight]
+            weight.append(1 if v is None else int(v))
+            n += 1
+        self.rows += n
+
+    def finish(self) -> "ColumnarEngine":
+        import numpy as np
+
+        for c, buf in self._buf.items():
+            self.cols[c] = np.frombuffer(buf, dtype=np.int32)
+        return self
+
+    @classmethod
+    def from_codes(cls, cols: Dict[str, Any],
+                   values: Dict[str, List[Optional[str]]]) -> "ColumnarEngine":
+        """Build from already dictionary-encoded columns (e.g. Arrow files)."""
+        engine = cls()
+        engine.cols = cols
+        engine.values = values
+        engine.rows = len(cols["day"])
+        return engine
+
+    @classmethod
+    def from_arrow(cls, table) -> "ColumnarEngine":
+        """Build from a pyarrow Table with analytics._COLUMNS (e.g. the
+        Parquet archive, see archive.py). Dictionary columns are reused as
+        they are; plain string columns are dictionary encoded here."""
+        import numpy as np
+        import pyarrow as pa
+
+        if table.num_rows:
+            table = table.unify_dictionaries().combine_chunks()
+        cols: Dict[str, Any] = {}
+        values: Dict[str, List[Optional[str]]] = {}
+        for c in _CODED:
+            arr = table.column(c).combine_chunks()
+            if not pa.types.is_dictionary(arr.type):
+                arr = arr.dictionary_encode()
+            vals = arr.dictionary.to_pylist()
+            null = "direct" if c in BREAKDOWN_FIELDS else None
+            if arr.null_count:
+                if null not in vals:
+                    vals.append(null)
+                arr_codes = arr.indices.fill_null(vals.index(null))
+            else:
+                arr_codes = arr.indices
+            cols[c] = arr_codes.to_numpy(zero_copy_only=False).astype(np.int32)
+            values[c] = vals
+        for c, default in (("scroll_depth", -1), ("weight", 1)):
+            cols[c] = table.column(c).combine_chunks().fill_null(default) \
+                .to_numpy(zero_copy_only=False).astype(np.int32)
+        return cls.from_codes(cols, values)
+
+    # -- helpers ------------------------------------------------------------
+    def _code(self, col: str, value: Optional[str]) -> int:
+        try:
+            return self.values[col].index(value)
+        except ValueError:
+            return -1
+
+    def _range(self, d0: str, d1: str):
+        import numpy as np
+
+        ok = np.array([d0 <= d <= d1 for d in self.values["day"]], dtype=bool)
+        return ok[self.cols["day"]]
+
+    def _type(self, name: str):
+        return self.cols["event_type"] == self._code("event_type", name)
+
+    def _distinct(self, col: str, mask) -> int:
+        import numpy as np
+
+        codes = self.cols[col][mask]
+        if not len(codes):
+            return 0
+        seen = np.bincount(codes, minlength=len(self.values[col])) > 0
+        none = self._code(col, None)
+        if none >= 0:
+            seen[none] = False  # COUNT(DISTINCT) ignores NULL
+        return int(np.count_nonzero(seen))
+
+    def _weighted(self, mask) -> int:
+        return int(self.cols["weight"][mask].sum())
+
+    # -- reads (same shapes as AnalyticsDB) ---------------------------------
+    def funnel(self, d0: str, d1: str) -> Dict[str, int]:
+        import numpy as np
+
+        rng = self._range(d0, d1)
+        explore = np.array([v in _EXPLORE_CLASSES for v in self.values["page_class"]],
+                           dtype=bool)
+        on_explore = explore[self.cols["page_class"]]
+        scrolled = self._type("scroll") & (self.cols["scroll_depth"] >= 50)
+        explored = self._type("nav_click") | (self._type("pageview") & on_explore)
+        return {
+            "landing": self._distinct("session_id", rng),
+            "scrolled": self._distinct("session_id", rng & scrolled),
+            "explored": self._distinct("session_id", rng & explored),
+            "form_view": self._distinct("session_id", rng & self._type("form_view")),
+            "form_submit": self._distinct("session_id", rng & self._type("form_submit")),
+        }
+
+    def totals(self, d0: str, d1: str) -> Dict[str, int]:
+        rng = self._range(d0, d1)
+        return {
+            "visitors": self._distinct("visitor_hash", rng),
+            "sessions": self._distinct("session_id", rng),
+            "pageviews": self._weighted(rng & self._type("pageview")),
+            "leads": self._weighted(rng & self._type("form_submit")),
+        }
+
+    def timeseries(self, d0: str, d1: str) -> List[Dict[str, Any]]:
+        import numpy as np
+
+        rng = self._range(d0, d1)
+        n_days = len(self.values["day"])
+        n_vis = max(1, len(self.values["visitor_hash"]))
+        has_vis = rng & (self.cols["visitor_hash"] != self._code("visitor_hash", None))
+        pairs = np.sort(
+            self.cols["day"][has_vis].astype(np.int64) * n_vis
+            + self.cols["visitor_hash"][has_vis]
+        )
+        pairs = pairs[np.diff(pairs, prepend=-1) != 0]  # distinct (day, visitor)
+        visitors = np.bincount(pairs // n_vis, minlength=n_days)
+        pv = rng & self._type("pageview")
+        pageviews = np.bincount(self.cols["day"][pv], weights=self.cols["weight"][pv],
+                                minlength=n_days)
+        active = np.bincount(self.cols["day"][rng], minlength=n_days) > 0
+        out = [
+            {"day": self.values["day"][c], "visitors": int(visitors[c]),
+             "pageviews": int(pageviews[c])}
+            for c in np.flatnonzero(active)
+        ]
+        out.sort(key=lambda r: r["day"])
+        return out
+
+    def breakdowns(self, fields: Tuple[str, ...], d0: str, d1: str,
+                   limit: int = 12) -> Dict[str, List[Dict[str, Any]]]:
+        import numpy as np
+
+        for f in fields:
+            if f not in BREAKDOWN_FIELDS:
+                raise KeyError(f)
+        pv = self._range(d0, d1) & self._type("pageview")
+        weights = self.cols["weight"][pv]
+        out: Dict[str, List[Dict[str, Any]]] = {}
+        for f in fields:
+            labels = self.values[f]
+            hits = np.bincount(self.cols[f][pv], weights=weights, minlength=len(labels))
+            top = list(np.flatnonzero(hits))
+            top.sort(key=lambda c: (-hits[c], labels[c]))
+            out[f] = [{"label": labels[c], "hits": int(hits[c])} for c in top[:limit]]
+        return out
+
+    def breakdown(self, field: str, d0: str, d1: str,
+                  limit: int = 12) -> List[Dict[str, Any]]:
+        return self.breakdowns((field,), d0, d1, limit)[field]
@@ -0,0 +1,182 @@
+"""Funnel and goal definitions of the analytics dashboard.
+
+They live in a JSON file (backend/funnels.json, or the path in
+ANALYTICS_FUNNELS):
+
+    {"funnels": [{"id": "dental", "label": "Dental clinics", "steps": [
+        {"id": "viewed", "label": "Viewed dental page",
+         "match": {"event_type": "pageview", "page_type": "v-dental"}},
+        {"id": "whatsapp", "label": "Clicked WhatsApp",
+         "match": {"event_type": "cta_click", "meta": {"cta": "whatsapp"}}},
+        {"id": "lead", "label": "Submitted form", "match": {"event_type": "form_submit"}}
+     ]}],
+     "goals": [{"id": "lead", "label": "Lead", "match": {"event_type": "form_submit"}}]}
+
+A `match` is a condition on one event: an object whose keys must all hold, or
+a list of such objects of which any may hold; {} matches every event. Keys:
+
+    event_type, page, page_class, page_type   a value or a list of values
+    page_prefix                               a prefix or a list of prefixes
+    min_scroll                                scroll_depth >= this
+    meta                                      {key: value or list} on event meta
+
+page_type is the pages.PAGES type of the page (e.g. "v-dental"). load()
+compiles every distinct match once into a predicate over event rows;
+analytics.py gives each one a stable bit and ORs the bits an event sets into
+its session's `steps` at ingest. A funnel step counts the sessions that have
+its bit and, unless the funnel says "cumulative": false, the bits of all
+earlier steps (reached in any order). A goal counts the sessions with its bit.
+"""
+from __future__ import annotations
+
+import json
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pages import page_type
+
+logger = logging.getLogger("onda.analytics")
+
+_FIELDS = ("event_type", "page", "page_class", "page_type")
+_KEYS = set(_FIELDS) | {"page_prefix", "min_scroll", "meta"}
+
+# The steps the dashboard funnel always had, in the order of their bits in
+# `sessions` tables written before funnels were configurable (and the names
+# of their agg_hll sketches, which older days fall back to).
+LEGACY = [
+    ("scrolled", {"event_type": "scroll", "min_scroll": 50}),
+    ("explored", [{"event_type": "nav_click"},
+                  {"event_type": "pageview",
+                   "page_class": ["portfolio", "process", "example"]}]),
+    ("form_view", {"event_type": "form_view"}),
+    ("form_submit", {"event_type": "form_submit"}),
+]
+
+# Used when the file is missing or invalid: the legacy funnel.
+DEFAULT: Dict[str, Any] = {
+    "funnels": [{
+        "id": "main", "label": "Conversion funnel", "cumulative": False,
+        "steps": [{"id": "landing", "label": "Landing", "match": {}}] + [
+            {"id": name, "label": label, "match": match}
+            for (name, match), label in zip(LEGACY, (
+                "Scrolled 50%+", "Viewed work", "Saw contact form", "Submitted form"))
+        ],
+    }],
+    "goals": [],
+}
+
+
+def match_key(match: Any) -> str:
+    """Canonical text of a match; equal conditions share one key (and bit)."""
+    return json.dumps(match, sort_keys=True, separators=(",", ":"))
+
+
+class Config:
+    """Compiled definitions.
+
+    funnels: [{"id", "label", "cumulative", "steps": [{"id", "label", "key"}]}]
+    goals:   [{"id", "label", "key"}]
+    matchers: {key: predicate(row) -> bool} for every non-empty match; steps
+    whose match is {} have key None (every session).
+    """
+
+    def __init__(self, spec: Dict[str, Any], columns: Tuple[str, ...]):
+        self.funnels: List[Dict[str, Any]] = []
+        self.goals: List[Dict[str, Any]] = []
+        self.matchers: Dict[str, Callable[[Tuple], bool]] = {}
+        seen = set()
+        for f in spec.get("funnels") or []:
+            fid = _ident(f, "funnel")
+            if fid in seen:
+                raise ValueError(f"duplicate funnel id {fid!r}")
+            seen.add(fid)
+            steps = f.get("steps") or []
+            if not steps:
+                raise ValueError(f"funnel {fid!r} has no steps")
+            self.funnels.append({
+                "id": fid, "label": str(f.get("label") or fid),
+                "cumulative": bool(f.get("cumulative", True)),
+                "steps": [self._item(s, f"step{i + 1}", columns) for i, s in enumerate(steps)],
+            })
+        if not self.funnels:
+            raise ValueError("no funnels defined")
+        self.goals = [self._item(g, None, columns) for g in spec.get("goals") or []]
+
+    def _item(self, item: Dict[str, Any], default_id: Optional[str],
+              columns: Tuple[str, ...]) -> Dict[str, Any]:
+        iid = str(item.get("id") or default_id or _ident(item, "goal"))
+        if "match" not in item:
+            raise ValueError(f"{iid!r} has no match")
+        match = item["match"]
+        key = None
+        if match not in ({}, []):
+            key = match_key(match)
+            if key not in self.matchers:
+                self.matchers[key] = compile_match(match, columns)
+        return {"id": iid, "label": str(item.get("label") or iid), "key": key}
+
+
+def _ident(item: Any, what: str) -> str:
+    if not isinstance(item, dict) or not item.get("id"):
+        raise ValueError(f"every {what} needs an id")
+    return str(item["id"])
+
+
+def _values(v: Any) -> frozenset:
+    return frozenset(v if isinstance(v, list) else [v])
+
+
+def compile_match(match: Any, columns: Tuple[str, ...]) -> Callable[[Tuple], bool]:
+    """Predicate over event rows (tuples in `columns` order) for a match."""
+    if isinstance(match, list):
+        preds = [compile_match(m, columns) for m in match]
+        return lambda r: any(p(r) for p in preds)
+    if not isinstance(match, dict):
+        raise ValueError(f"a match is an object or a list of them, not {match!r}")
+    unknown = set(match) - _KEYS
+    if unknown:
+        raise ValueError(f"unknown match keys: {', '.join(sorted(unknown))}")
+    idx = {c: columns.index(c) for c in ("event_type", "page", "page_class",
+                                          "scroll_depth", "meta")}
+    tests: List[Callable[[Tuple], bool]] = []  # cheapest first
+    for field in _FIELDS:
+        if field in match:
+            allowed = _values(match[field])
+            if field == "page_type":
+                i = idx["page"]
+                tests.append(lambda r, a=allowed, i=i: page_type(r[i]) in a)
+            else:
+                tests.append(lambda r, a=allowed, i=idx[field]: r[i] in a)
+    if "page_prefix" in match:
+        prefixes, i = tuple(_values(match["page_prefix"])), idx["page"]
+        tests.append(lambda r: bool(r[i]) and r[i].startswith(prefixes))
+    if "min_scroll" in match:
+        low, i = int(match["min_scroll"]), idx["scroll_depth"]
+        tests.append(lambda r: (r[i] or 0) >= low)
+    if "meta" in match:
+        want = {k: _values(v) for k, v in dict(match["meta"]).items()}
+        i = idx["meta"]
+
+        def meta_ok(r: Tuple) -> bool:
+            try:
+                meta = json.loads(r[i]) if r[i] else None
+            except ValueError:
+                return False
+            return isinstance(meta, dict) and all(meta.get(k) in v for k, v in want.items())
+
+        tests.append(meta_ok)
+    return lambda r: all(t(r) for t in tests)
+
+
+def load(path: str, columns: Tuple[str, ...]) -> Config:
+    """Compile the definitions in `path`; DEFAULT (with an error logged)
+    when it is missing or invalid, so a bad edit cannot stop ingest."""
+    try:
+        with open(path) as f:
+            return Config(json.load(f), columns)
+    except FileNotFoundError:
+        logger.info("No funnel definitions at %s; using the default funnel", path)
+    except (OSError, ValueError, TypeError) as e:
+        logger.error("Invalid funnel definitions in %s (%s); using the default funnel",
+                     path, e)
+    return Config(DEFAULT, columns)
@@ -0,0 +1,127 @@
+"""The dashboard's "right now" panel: a sliding window over tracked events.
+
+Every event accepted by AnalyticsDB.enqueue() updates LiveWindow in memory
+(no DB involved): one entry per visitor with when they were last seen, on
+which page and from which referrer, in last-seen order, so expiry just pops
+from the front. LiveHub turns the window into one JSON snapshot per tick and
+hands the same payload to every subscribed SSE stream, so the cost does not
+grow with the number of open /admin tabs.
+
+The window is per process: with several workers each one sees its share of
+the traffic.
+"""
+from __future__ import annotations
+
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+logger = logging.getLogger("onda.analytics")
+
+WINDOW_S = int(os.getenv("ANALYTICS_LIVE_WINDOW_S", "300"))
+TICK_S = float(os.getenv("ANALYTICS_LIVE_TICK_S", "2"))
+MAX_VISITORS = 50000  # oldest entries are dropped past this
+TOP_N = 10
+
+
+class LiveWindow:
+    """Visitors seen in the last WINDOW_S seconds."""
+
+    def __init__(self, window_s: int = WINDOW_S):
+        self.window_s = window_s
+        # visitor -> [last seen (monotonic), page, referrer host]
+        self._seen: "collections.OrderedDict[str, List[Any]]" = collections.OrderedDict()
+
+    def add(self, ev: Dict[str, Any], now: Optional[float] = None) -> None:
+        key = ev.get("visitor_hash") or ev.get("session_id")
+        if not key:
+            return
+        now = time.monotonic() if now is None else now
+        v = self._seen.get(key)
+        if v is None:
+            self._seen[key] = [now, ev.get("page"), ev.get("referrer_host")]
+            if len(self._seen) > MAX_VISITORS:
+                self._seen.popitem(last=False)
+            return
+        self._seen.move_to_end(key)
+        v[0] = now
+        if ev.get("page"):
+            v[1] = ev["page"]
+        if ev.get("referrer_host"):
+            v[2] = ev["referrer_host"]  # internal navigation keeps the source
+
+    def snapshot(self, now: Optional[float] = None) -> Dict[str, Any]:
+        """Active visitors and their current pages and referrers."""
+        now = time.monotonic() if now is None else now
+        seen = self._seen
+        while seen:
+            _, v = next(iter(seen.items()))
+            if now - v[0] <= self.window_s:
+                break
+            seen.popitem(last=False)
+        pages: Dict[str, int] = collections.Counter()
+        refs: Dict[str, int] = collections.Counter()
+        for _, page, ref in seen.values():
+            pages[page or "(none)"] += 1
+            refs[ref or "direct"] += 1
+
+        def top(c: Dict[str, int]) -> List[Dict[str, Any]]:
+            return [{"label": k, "visitors": n} for k, n in
+                    sorted(c.items(), key=lambda kv: (-kv[1], kv[0]))[:TOP_N]]
+
+        return {
+            "window_s": self.window_s,
+            "active_visitors": len(seen),
+            "pages": top(pages),
+            "referrers": top(refs),
+        }
+
+
+class LiveHub:
+    """Fans one snapshot per tick out to any number of SSE streams. The tick
+    task only runs while someone is subscribed."""
+
+    def __init__(self, window: LiveWindow, tick_s: float = TICK_S):
+        self.window = window
+        self.tick_s = tick_s
+        self._payload = "{}"
+        self._tick = asyncio.Condition()
+        self._subscribers = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        while self._subscribers:
+            try:
+                payload = json.dumps(self.window.snapshot(), separators=(",", ":"))
+            except Exception as e:  # keep the streams alive
+                logger.warning("Live snapshot failed: %s", e)
+            else:
+                async with self._tick:
+                    self._payload = payload
+                    self._tick.notify_all()
+            await asyncio.sleep(self.tick_s)
+        self._task = None
+
+    async def stream(self) -> AsyncIterator[str]:
+        """SSE frames: the current snapshot, then one per tick."""
+        self._subscribers += 1
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        try:
+            yield "data: " + json.dumps(self.window.snapshot(), separators=(",", ":")) + "\n\n"
+            while True:
+                async with self._tick:
+                    await self._tick.wait()
+                    payload = self._payload
+                yield f"data: {payload}\n\n"
+        finally:
+            self._subscribers -= 1
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -4,6 +4,7 @@ from fastapi.responses import (
     FileResponse,
     PlainTextResponse,
     Response,
+    StreamingResponse,
     HTMLResponse,
     JSONResponse,
 )
@@ -11,19 +12,29 @@ from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from brotli_asgi import BrotliMiddleware
 from pydantic import BaseModel, Field
+import asyncio
+import csv
 import html
+import io
 import hashlib
+import json
 import logging
 import os
 import time
 import secrets
 import datetime as _dt
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from collections import defaultdict
 from dotenv import load_dotenv
 from pathlib import Path
 
-import analytics as _an
+# Load .env from backend/ so it works when run from project root (e.g. python backend/main.py).
+# Before the local imports: analytics reads its settings at import time.
+load_dotenv(dotenv_path=Path(__file__).resolve().parent / ".env")
+
+import analytics as _an  # noqa: E402
+import live as _live  # noqa: E402
+from pages import PAGES  # noqa: E402  canonical page set: (path, filename, lang, page_type)
 
 # Canonical site origin (used for SEO tags, sitemap, llms.txt)
 SITE_URL = os.getenv("SITE_URL", "https://agencyonda.com")
@@ -33,56 +44,13 @@ FRONTEND_DIR = BASE_DIR / "frontend"
 # (path -> filename) for the language-specific homepages.
 LANG_HOME = {"en": "index_v5.html", "es": "index_es.html"}
 
-# Canonical page set: (path, filename, lang, page_type)
-PAGES = [
-    ("/", "index_es.html", "es", "home"),
-    ("/index_v5.html", "index_v5.html", "en", "home"),
-    ("/portfolio.html", "portfolio.html", "en", "portfolio"),
-    ("/portfolio_es.html", "portfolio_es.html", "es", "portfolio"),
-    ("/process.html", "process.html", "en", "process"),
-    ("/process_es.html", "process_es.html", "es", "process"),
-    # Industry landing pages + blog (EN + ES; same page_type per slug so the
-    # sitemap emits the en/es hreflang cluster).
-    ("/web-design-dental-clinics.html", "web-design-dental-clinics.html", "en", "v-dental"),
-    ("/web-design-dental-clinics-es.html", "web-design-dental-clinics-es.html", "es", "v-dental"),
-    ("/web-design-restaurants.html", "web-design-restaurants.html", "en", "v-restaurants"),
-    ("/web-design-restaurants-es.html", "web-design-restaurants-es.html", "es", "v-restaurants"),
-    ("/web-design-real-estate.html", "web-design-real-estate.html", "en", "v-realestate"),
-    ("/web-design-real-estate-es.html", "web-design-real-estate-es.html", "es", "v-realestate"),
-    ("/web-design-aesthetic-clinics.html", "web-design-aesthetic-clinics.html", "en", "v-aesthetic"),
-    ("/web-design-aesthetic-clinics-es.html", "web-design-aesthetic-clinics-es.html", "es", "v-aesthetic"),
-    ("/web-design-architecture-studios.html", "web-design-architecture-studios.html", "en", "v-architecture"),
-    ("/web-design-architecture-studios-es.html", "web-design-architecture-studios-es.html", "es", "v-architecture"),
-    ("/blog.html", "blog.html", "en", "blog"),
-    ("/blog-es.html", "blog-es.html", "es", "blog"),
-    ("/how-much-does-a-website-cost-spain.html", "how-much-does-a-website-cost-spain.html", "en", "post-cost"),
-    ("/how-much-does-a-website-cost-spain-es.html", "how-much-does-a-website-cost-spain-es.html", "es", "post-cost"),
-    ("/how-to-choose-a-web-designer.html", "how-to-choose-a-web-designer.html", "en", "post-choose"),
-    ("/how-to-choose-a-web-designer-es.html", "how-to-choose-a-web-designer-es.html", "es", "post-choose"),
-    # Case studies (EN + es per slug -> en/es hreflang cluster)
-    ("/case-selbstentdeckung.html", "case-selbstentdeckung.html", "en", "case-selbstentdeckung"),
-    ("/case-selbstentdeckung-es.html", "case-selbstentdeckung-es.html", "es", "case-selbstentdeckung"),
-    ("/case-anna-romeo.html", "case-anna-romeo.html", "en", "case-anna-romeo"),
-    ("/case-anna-romeo-es.html", "case-anna-romeo-es.html", "es", "case-anna-romeo"),
-    # Legal pages
-    ("/privacy.html", "privacy.html", "en", "legal-privacy"),
-    ("/privacy-es.html", "privacy-es.html", "es", "legal-privacy"),
-    ("/terms.html", "terms.html", "en", "legal-terms"),
-    ("/terms-es.html", "terms-es.html", "es", "legal-terms"),
-    # Case studies (en + es per case)
-    ("/case-proadikt.html", "case-proadikt.html", "en", "case-proadikt"),
-    ("/case-proadikt-es.html", "case-proadikt-es.html", "es", "case-proadikt"),
-]
-
-# Load .env from backend/ so it works when run from project root (e.g. python backend/main.py)
-_env_path = Path(__file__).resolve().parent / ".env"
-load_dotenv(dotenv_path=_env_path)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
 # Compress text responses (HTML/CSS/JS) — Brotli with gzip fallback (~15% smaller than gzip).
-app.add_middleware(BrotliMiddleware, quality=5, minimum_size=500, gzip_fallback=True)
+app.add_middleware(BrotliMiddleware, quality=5, minimum_size=500, gzip_fallback=True,
+                   excluded_handlers=[r"^/api/admin/live$"])  # SSE: no buffering
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -93,6 +61,7 @@ app.add_middleware(
 
 # --- Analytics (cookieless) -------------------------------------------------
 analytics_db = _an.AnalyticsDB(os.getenv("DATABASE_URL"))
+live_hub = _live.LiveHub(analytics_db.live)
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "")
 _basic = HTTPBasic()
 
@@ -127,6 +96,7 @@ async def _startup() -> None:
 
 @app.on_event("shutdown")
 async def _shutdown() -> None:
+    await live_hub.close()
     await analytics_db.close()
 
 
@@ -152,6 +122,7 @@ class TrackEvent(BaseModel):
     referrer: Optional[str] = None
     scroll_depth: Optional[int] = None
     meta: Optional[Dict[str, Any]] = None
+    age_ms: Optional[int] = None  # ms between capture and send (batched beacons)
 
 
 class ContactRequest(BaseModel):
@@ -258,7 +229,10 @@ async def cache_control(request: Request, call_next):
     """Replace the page-level no-cache meta tags with sane HTTP caching."""
     response = await call_next(request)
     path = request.url.path
-    if path.startswith("/api/admin") or path.startswith("/api/track") or path == "/admin":
+    if path == "/api/admin/stats":
+        # Revalidated every time via ETag (see admin_stats), never shared.
+        response.headers["Cache-Control"] = "private, no-cache"
+    elif path.startswith("/api/admin") or path.startswith("/api/track") or path == "/admin":
         response.headers["Cache-Control"] = "no-store"
     elif path.endswith((".woff2", ".woff", ".ttf", ".otf")):
         # Fonts are content-stable: cache hard.
@@ -426,43 +400,179 @@ def _client_ip(request: Request) -> str:
     return request.client.host if request.client else "0.0.0.0"
 
 
+def _ingest(ev: TrackEvent, request: Request) -> None:
+    """Validate, enrich and enqueue one event (rate limit is per event)."""
+    if ev.event_type not in _an.EVENT_TYPES:
+        return
+    ip = _client_ip(request)
+    if _rate_limited(ip):
+        return
+    ua = request.headers.get("user-agent", "")
+    site_host = SITE_URL.split("//")[-1]
+    country = (
+        request.headers.get("cf-ipcountry")
+        or request.headers.get("x-vercel-ip-country")
+        or None
+    )
+    sd = ev.scroll_depth
+    if sd is not None:
+        sd = max(0, min(100, int(sd)))
+    age = ev.age_ms
+    if age is not None:
+        age = max(0, min(TRACK_AGE_MAX_MS, int(age)))
+    # Enqueue only: the write-behind task batches the INSERTs.
+    analytics_db.enqueue({
+        "event_type": ev.event_type,
+        "session_id": (ev.session_id or "")[:64] or None,
+        "visitor_hash": _an.visitor_hash(ip, ua),
+        "page": (ev.page or "")[:256] or None,
+        "lang": (ev.lang or "")[:8] or None,
+        "referrer_host": _an.referrer_host(ev.referrer or "", site_host),
+        "utm_source": _an.utm_source_from(ev.page or "", ev.referrer or ""),
+        "device": _an.device_from_ua(ua),
+        "country": (country or None),
+        "scroll_depth": sd,
+        "meta": ev.meta if isinstance(ev.meta, dict) else None,
+        "age_ms": age,
+    })
+
+
 @app.post("/api/track", status_code=204)
 async def track(ev: TrackEvent, request: Request):
     """Cookieless event ingestion. Never raises to the client."""
     try:
-        if ev.event_type not in _an.EVENT_TYPES:
-            return Response(status_code=204)
-        ip = _client_ip(request)
-        if _rate_limited(ip):
-            return Response(status_code=204)
-        ua = request.headers.get("user-agent", "")
-        site_host = SITE_URL.split("//")[-1]
-        country = (
-            request.headers.get("cf-ipcountry")
-            or request.headers.get("x-vercel-ip-country")
-            or None
-        )
-        sd = ev.scroll_depth
-        if sd is not None:
-            sd = max(0, min(100, int(sd)))
-        await analytics_db.insert_event({
-            "event_type": ev.event_type,
-            "session_id": (ev.session_id or "")[:64] or None,
-            "visitor_hash": _an.visitor_hash(ip, ua),
-            "page": (ev.page or "")[:256] or None,
-            "lang": (ev.lang or "")[:8] or None,
-            "referrer_host": _an.referrer_host(ev.referrer or "", site_host),
-            "utm_source": _an.utm_source_from(ev.page or "", ev.referrer or ""),
-            "device": _an.device_from_ua(ua),
-            "country": (country or None),
-            "scroll_depth": sd,
-            "meta": ev.meta if isinstance(ev.meta, dict) else None,
-        })
+        _ingest(ev, request)
     except Exception as e:  # analytics must never break a page
         logger.error("track failed: %s", e)
     return Response(status_code=204)
 
 
+# Upper bound on events per coalesced beacon (analytics.js flushes far fewer).
+TRACK_BATCH_MAX = 50
+# Upper bound on an event's client-reported age_ms: a buffered event is dated
+# back by at most this much, whatever the client claims.
+TRACK_AGE_MAX_MS = 5 * 60 * 1000
+# Upper bound on a tracking request body; larger beacons are ignored.
+TRACK_BODY_MAX = 32 * 1024
+
+
+@app.post("/api/track/batch", status_code=204)
+async def track_batch(events: List[Any], request: Request):
+    """Coalesced beacon from analytics.js: a JSON array of TrackEvent objects.
+
+    Each event is validated and rate limited on its own, exactly as if it had
+    been POSTed to /api/track; invalid ones are skipped, never the batch.
+    """
+    for raw in events[:TRACK_BATCH_MAX]:
+        try:
+            _ingest(TrackEvent(**raw), request)
+        except Exception as e:  # analytics must never break a page
+            logger.debug("track batch item skipped: %s", e)
+    return Response(status_code=204)
+
+
+_TRACK_STR_FIELDS = ("session_id", "page", "lang", "referrer")
+_TRACK_INT_FIELDS = ("scroll_depth", "age_ms")
+
+
+def _parse_track_event(raw: Any) -> Optional[TrackEvent]:
+    """Hand-rolled equivalent of TrackEvent validation for the fast path:
+    same fields, same types, same coercion of scroll_depth and age_ms; None
+    if invalid."""
+    if not isinstance(raw, dict) or not isinstance(raw.get("event_type"), str):
+        return None
+    for f in _TRACK_STR_FIELDS:
+        v = raw.get(f)
+        if v is not None and not isinstance(v, str):
+            return None
+    ints = {}
+    for f in _TRACK_INT_FIELDS:
+        v = raw.get(f)
+        if isinstance(v, bool):
+            v = int(v)
+        elif isinstance(v, float):
+            if not v.is_integer():
+                return None
+            v = int(v)
+        elif isinstance(v, str):
+            try:
+                num = float(v)
+            except ValueError:
+                return None
+            if not num.is_integer():
+                return None
+            v = int(num)
+        elif v is not None and not isinstance(v, int):
+            return None
+        ints[f] = v
+    meta = raw.get("meta")
+    if meta is not None and not isinstance(meta, dict):
+        return None
+    return TrackEvent.model_construct(
+        event_type=raw["event_type"],
+        session_id=raw.get("session_id"),
+        page=raw.get("page"),
+        lang=raw.get("lang"),
+        referrer=raw.get("referrer"),
+        scroll_depth=ints["scroll_depth"],
+        meta=meta,
+        age_ms=ints["age_ms"],
+    )
+
+
+class TrackFastPath:
+    """Raw ASGI handler for POST /api/track and /api/track/batch.
+
+    Sits outside every other middleware: beacons skip Brotli, CORS, the
+    cache_control wrapper, routing and pydantic, and get a bare 204 with the
+    headers those layers would have added. Everything else passes through.
+    """
+
+    _HEADERS = [
+        (b"cache-control", b"no-store"),
+        (b"access-control-allow-origin", b"*"),
+        (b"x-content-type-options", b"nosniff"),
+    ]
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path")
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or path not in ("/api/track", "/api/track/batch")
+        ):
+            await self.app(scope, receive, send)
+            return
+        try:
+            body = b""
+            more = True
+            while more:
+                msg = await receive()
+                body += msg.get("body", b"")
+                more = msg.get("more_body", False)
+                if len(body) > TRACK_BODY_MAX:
+                    body = b""
+                    break
+            if body:
+                data = json.loads(body)
+                items = data[:TRACK_BATCH_MAX] if (
+                    path == "/api/track/batch" and isinstance(data, list)
+                ) else [data]
+                request = Request(scope)
+                for raw in items:
+                    ev = _parse_track_event(raw)
+                    if ev is not None:
+                        _ingest(ev, request)
+        except Exception as e:  # analytics must never break a page
+            logger.debug("track fast path skipped: %s", e)
+        await send({"type": "http.response.start", "status": 204,
+                    "headers": self._HEADERS})
+        await send({"type": "http.response.body", "body": b""})
+
+
 def _date_range(frm: Optional[str], to: Optional[str]):
     today = _dt.datetime.utcnow().date()
     try:
@@ -476,45 +586,216 @@ def _date_range(frm: Optional[str], to: Optional[str]):
     return d0.isoformat(), d1.isoformat()
 
 
+# Ranges of fewer days than this get an hourly timeseries unless the request
+# asks for ?granularity=day (or hour).
+HOURLY_MAX_DAYS = 3
+
+
 @app.get("/api/admin/stats")
 async def admin_stats(request: Request, _: bool = Depends(_require_admin)):
     frm = request.query_params.get("from")
     to = request.query_params.get("to")
     d0, d1 = _date_range(frm, to)
+    granularity = request.query_params.get("granularity", "auto")
+    if granularity not in ("day", "hour"):
+        granularity = "hour" if (
+            _dt.date.fromisoformat(d1) - _dt.date.fromisoformat(d0)
+        ).days < HOURLY_MAX_DAYS else "day"
+
+    # The ETag is a version of the data in range, checked before any panel
+    # runs, so an unchanged refresh is a cheap 304. Ingest counters and
+    # timings are not part of it.
+    version = await analytics_db.data_version(d0, d1)
+    etag = '"' + hashlib.md5(f"{granularity}:{version}".encode()).hexdigest() + '"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    # Panels are independent: run them concurrently over the read pool and
+    # report how long each took (JSON + Server-Timing).
+    timings: Dict[str, float] = {}
+
+    async def timed(name: str, coro):
+        t0 = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            timings[name] = round((time.perf_counter() - t0) * 1000, 1)
+
+    t0 = time.perf_counter()
+    funnels, goals, sessions, entries, totals, timeseries, dims = await asyncio.gather(
+        timed("funnel", analytics_db.funnels(d0, d1)),
+        timed("goals", analytics_db.goals(d0, d1)),
+        timed("sessions", analytics_db.session_stats(d0, d1)),
+        timed("entry_pages", analytics_db.entry_pages(d0, d1)),
+        timed("totals", analytics_db.totals(d0, d1)),
+        timed("timeseries", analytics_db.timeseries(d0, d1, granularity)),
+        timed("breakdowns", analytics_db.breakdowns(
+            ("page", "page_class", "referrer_host", "device", "country", "lang"), d0, d1
+        )),
+    )
+    timings["total"] = round((time.perf_counter() - t0) * 1000, 1)
+
+    def funnel_steps(f: Dict[str, Any]) -> List[Dict[str, Any]]:
+        counts = funnels[f["id"]]
+        steps = [(s["label"], counts[s["id"]]) for s in f["steps"]]
+        out = []
+        for i, (name, count) in enumerate(steps):
+            prev = steps[i - 1][1] if i > 0 else count
+            drop = 0.0
+            if i > 0 and prev > 0:
+                drop = round((1 - count / prev) * 100, 1)
+            conv = 0.0
+            if steps[0][1] > 0:
+                conv = round(count / steps[0][1] * 100, 1)
+            out.append({
+                "step": name, "count": count,
+                "drop_from_prev_pct": drop, "of_landing_pct": conv,
+            })
+        return out
+
+    config = analytics_db.config
+    funnels_out = [{"id": f["id"], "label": f["label"], "steps": funnel_steps(f)}
+                   for f in config.funnels]
+    goals_out = [{
+        "id": g["id"], "label": g["label"], "count": goals[g["id"]],
+        "rate": round(goals[g["id"]] / sessions["sessions"] * 100, 1)
+        if sessions["sessions"] else 0.0,
+    } for g in config.goals]
+
+    body = {
+        "range": {"from": d0, "to": d1},
+        "totals": totals,
+        "funnel": funnels_out[0]["steps"],
+        "funnels": funnels_out,
+        "goals": goals_out,
+        "sessions": sessions,
+        "granularity": granularity,
+        "timeseries": timeseries,
+        "top_pages": dims["page"],
+        "entry_pages": entries,
+        "sections": dims["page_class"],
+        "sources": dims["referrer_host"],
+        "devices": dims["device"],
+        "countries": dims["country"],
+        "languages": dims["lang"],
+        "ingest": analytics_db.ingest_stats(),
+        "db_ready": analytics_db.ready,
+    }
+    headers = {
+        "ETag": etag,
+        "Server-Timing": ", ".join(f"{k};dur={v}" for k, v in timings.items()),
+    }
+    body["timings_ms"] = timings
+    return JSONResponse(body, headers=headers)
+
+
+@app.get("/api/admin/paths")
+async def admin_paths(request: Request, _: bool = Depends(_require_admin)):
+    """How visitors move through the site: top page-to-page transitions plus
+    entry and exit pages, all from pre-aggregated tables."""
+    q = request.query_params
+    d0, d1 = _date_range(q.get("from"), q.get("to"))
+    try:
+        limit = min(max(int(q.get("limit", 20)), 1), 200)
+    except ValueError:
+        limit = 20
+    transitions, entries, exits = await asyncio.gather(
+        analytics_db.transitions(d0, d1, limit),
+        analytics_db.entry_pages(d0, d1, limit),
+        analytics_db.exit_pages(d0, d1, limit),
+    )
+    return {
+        "range": {"from": d0, "to": d1},
+        "transitions": transitions,
+        "entry_pages": entries,
+        "exit_pages": exits,
+    }
+
+
+@app.get("/api/admin/live")
+async def admin_live(_: bool = Depends(_require_admin)):
+    """Server-Sent Events: active visitors of the last few minutes with their
+    current pages and referrers, from the in-memory live window. All open
+    streams share one snapshot per tick."""
+    return StreamingResponse(live_hub.stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
 
-    funnel = await analytics_db.funnel(d0, d1)
-    steps = [
-        ("Landing", funnel["landing"]),
-        ("Scrolled 50%+", funnel["scrolled"]),
-        ("Viewed work", funnel["explored"]),
-        ("Saw contact form", funnel["form_view"]),
-        ("Submitted form", funnel["form_submit"]),
-    ]
-    funnel_out = []
-    for i, (name, count) in enumerate(steps):
-        prev = steps[i - 1][1] if i > 0 else count
-        drop = 0.0
-        if i > 0 and prev > 0:
-            drop = round((1 - count / prev) * 100, 1)
-        conv = 0.0
-        if steps[0][1] > 0:
-            conv = round(count / steps[0][1] * 100, 1)
-        funnel_out.append({
-            "step": name, "count": count,
-            "drop_from_prev_pct": drop, "of_landing_pct": conv,
-        })
 
-    return JSONResponse({
+@app.get("/api/admin/events")
+async def admin_events(request: Request, _: bool = Depends(_require_admin)):
+    """Raw events, newest first, filtered by EVENT_FILTERS and paged with an
+    opaque `after` cursor ("day:id" of the last row of the previous page)."""
+    q = request.query_params
+    d0, d1 = _date_range(q.get("from"), q.get("to"))
+    after = None
+    if q.get("after"):
+        day, _sep, eid = q["after"].partition(":")
+        try:
+            after = (_dt.date.fromisoformat(day).isoformat(), int(eid))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="invalid cursor")
+    try:
+        limit = min(max(int(q.get("limit", 100)), 1), 500)
+    except ValueError:
+        limit = 100
+    rows, nxt = await analytics_db.events(
+        d0, d1, {f: q.get(f) for f in _an.EVENT_FILTERS}, after, limit
+    )
+    return {
         "range": {"from": d0, "to": d1},
-        "totals": await analytics_db.totals(d0, d1),
-        "funnel": funnel_out,
-        "timeseries": await analytics_db.timeseries(d0, d1),
-        "top_pages": await analytics_db.breakdown("page", d0, d1),
-        "sources": await analytics_db.breakdown("referrer_host", d0, d1),
-        "devices": await analytics_db.breakdown("device", d0, d1),
-        "countries": await analytics_db.breakdown("country", d0, d1),
-        "languages": await analytics_db.breakdown("lang", d0, d1),
-        "db_ready": analytics_db.ready,
+        "events": rows,
+        "next": f"{nxt[0]}:{nxt[1]}" if nxt else None,
+    }
+
+
+_EXPORT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+# Leading characters a spreadsheet reads as a formula; CSV cells holding
+# visitor-sent text (page, referrer, UTM) that start with one get a "'".
+_CSV_FORMULA_START = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _csv_row(row) -> list:
+    return ["'" + v if isinstance(v, str) and v.startswith(_CSV_FORMULA_START) else v
+            for v in row]
+
+
+@app.get("/api/admin/export")
+async def admin_export(request: Request, _: bool = Depends(_require_admin)):
+    """Raw events of a date range as NDJSON or CSV, streamed chunk by chunk
+    (keyset-paged on day and id), so memory stays flat for any range."""
+    fmt = request.query_params.get("format", "ndjson")
+    if fmt not in _EXPORT_TYPES:
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    d0, d1 = _date_range(request.query_params.get("from"), request.query_params.get("to"))
+    cols = _an.EVENT_COLUMNS
+
+    async def body():
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator="\n")
+        if fmt == "csv":
+            writer.writerow(cols)
+        try:
+            async for rows in analytics_db.iter_events(d0, d1):
+                if fmt == "csv":
+                    writer.writerows(_csv_row(r) for r in rows)
+                else:
+                    for r in rows:
+                        buf.write(json.dumps(dict(zip(cols, r)), ensure_ascii=False))
+                        buf.write("\n")
+                yield buf.getvalue().encode()
+                buf.seek(0)
+                buf.truncate()
+        except Exception as e:
+            # Headers are already sent; the truncated body is all we can signal.
+            logger.warning("Event export %s..%s failed: %s", d0, d1, e)
+            return
+        if buf.tell():
+            yield buf.getvalue().encode()
+
+    return StreamingResponse(body(), media_type=_EXPORT_TYPES[fmt], headers={
+        "Content-Disposition": f'attachment; filename="events-{d0}-{d1}.{fmt}"',
     })
 
 
@@ -529,10 +810,10 @@ font:15px/1.5 system-ui,-apple-system,sans-serif;padding:24px;max-width:1100px;m
 h1{font-size:20px;font-weight:700;letter-spacing:-.02em}
 .row{display:flex;gap:12px;flex-wrap:wrap;align-items:center}
 .bar{justify-content:space-between;margin-bottom:20px}
-input,button{background:var(--surf);color:var(--tx);border:1px solid var(--bd);
+input,button,select{background:var(--surf);color:var(--tx);border:1px solid var(--bd);
 border-radius:8px;padding:8px 12px;font:inherit}
 button{cursor:pointer}button:hover{border-color:var(--ac)}
-.cards{display:grid;grid-template-columns:repeat(4,1fr);gap:12px;margin:18px 0}
+.cards{display:grid;grid-template-columns:repeat(3,1fr);gap:12px;margin:18px 0}
 .card{background:var(--surf);border:1px solid var(--bd);border-radius:12px;padding:16px}
 .card .k{font-size:12px;color:var(--mut);text-transform:uppercase;letter-spacing:.05em}
 .card .v{font-size:26px;font-weight:700;margin-top:6px}
@@ -561,19 +842,38 @@ svg{width:100%;height:90px;display:block}
 </style></head><body>
 <div class="row bar"><h1>〰 Onda Analytics</h1>
 <div class="row"><input type="date" id="from"><input type="date" id="to">
-<button onclick="load()">Refresh</button></div></div>
+<button onclick="load();paths()">Refresh</button>
+<button onclick="exp('csv')">Export CSV</button></div></div>
 <div id="warn" class="muted" style="margin-bottom:12px"></div>
 <div class="cards" id="cards"></div>
-<div class="sec"><h2>Conversion funnel — where people drop off</h2><div id="funnel"></div></div>
-<div class="sec"><h2>Unique visitors / day</h2><svg id="ts" viewBox="0 0 600 90" preserveAspectRatio="none"></svg>
+<div class="sec"><h2>Right now</h2><div class="v" style="font-size:26px;font-weight:700" id="live">–</div>
+<div class="muted" id="livelab">connecting…</div>
+<div class="grid2" style="margin-top:12px"><table id="livepages"></table><table id="liverefs"></table></div></div>
+<div class="sec"><div class="row bar"><h2>Conversion funnel — where people drop off</h2>
+<select id="fsel" onchange="funnel()"></select></div><div id="funnel"></div></div>
+<div class="sec"><h2 id="tsh">Unique visitors / day</h2><svg id="ts" viewBox="0 0 600 90" preserveAspectRatio="none"></svg>
 <div class="muted" id="tslab"></div></div>
 <div class="grid2">
 <div class="sec"><h2>Top pages</h2><table id="pages"></table></div>
+<div class="sec"><h2>Sections</h2><table id="sections"></table></div>
+<div class="sec"><h2>Entry pages</h2><table id="entries"></table></div>
+<div class="sec"><h2>Goals</h2><table id="goals"></table></div>
+<div class="sec"><h2>Top paths</h2><table id="paths"></table></div>
+<div class="sec"><h2>Exit pages</h2><table id="exits"></table></div>
 <div class="sec"><h2>Sources</h2><table id="sources"></table></div>
 <div class="sec"><h2>Devices</h2><table id="devices"></table></div>
 <div class="sec"><h2>Countries</h2><table id="countries"></table></div>
-</div>
 <div class="sec"><h2>Languages</h2><table id="languages"></table></div>
+</div>
+<div class="sec"><h2>Events</h2>
+<div class="row" style="margin-bottom:12px"><select id="ev_event_type"><option value="">any type</option>
+<option>pageview</option><option>scroll</option><option>cta_click</option><option>nav_click</option>
+<option>form_view</option><option>form_submit</option></select>
+<input id="ev_page" placeholder="page"><input id="ev_page_class" placeholder="section" size="9"><input id="ev_session_id" placeholder="session"><input id="ev_device" placeholder="device">
+<input id="ev_country" placeholder="country" size="7"><button onclick="events()">Search</button></div>
+<div id="timeline"></div>
+<table id="events"></table><button id="more" style="display:none;margin-top:10px" onclick="events(next)">More</button></div>
+<div class="muted" id="timing"></div>
 <script>
 function esc(s){return String(s==null?'':s).replace(/[&<>]/g,c=>({'&':'&amp;','<':'&lt;','>':'&gt;'}[c]))}
 function tbl(id,rows,h){var t=document.getElementById(id);
@@ -581,43 +881,106 @@ if(!rows||!rows.length){t.innerHTML='<tr><td class="muted">No data yet</td></tr>
 var html='<tr><th>'+h[0]+'</th><th>'+h[1]+'</th></tr>';
 rows.forEach(r=>{html+='<tr><td>'+esc(r.label)+'</td><td>'+r.hits+'</td></tr>'});
 t.innerHTML=html}
+function exp(fmt){location.href='/api/admin/export?format='+fmt+
+'&from='+document.getElementById('from').value+'&to='+document.getElementById('to').value}
+var next=null;
+function events(after){
+var q='from='+document.getElementById('from').value+'&to='+document.getElementById('to').value;
+['event_type','page','page_class','session_id','device','country'].forEach(k=>{var v=document.getElementById('ev_'+k).value;
+if(v)q+='&'+k+'='+encodeURIComponent(v)});
+if(after)q+='&after='+encodeURIComponent(after);
+fetch('/api/admin/events?'+q,{credentials:'same-origin'}).then(r=>r.json()).then(d=>{
+var t=document.getElementById('events'),h=after?'':'<tr><th>Time</th><th>Type</th><th>Page</th><th>Device</th><th>Session</th></tr>';
+(d.events||[]).forEach(e=>{h+='<tr><td>'+esc(e.ts.replace('T',' ').slice(0,19))+'</td><td>'+esc(e.event_type)+
+'</td><td>'+esc(e.page)+'</td><td>'+esc(e.device)+'</td><td><a href="#" style="color:var(--ac)" onclick="timeline(this.textContent);return false">'+
+esc(e.session_id)+'</a></td></tr>'});
+if(after)t.innerHTML+=h;else t.innerHTML=h;
+next=d.next;document.getElementById('more').style.display=next?'':'none'})}
+function timeline(sid){
+fetch('/api/admin/events?limit=500&session_id='+encodeURIComponent(sid)+'&from='+document.getElementById('from').value+
+'&to='+document.getElementById('to').value,{credentials:'same-origin'}).then(r=>r.json()).then(d=>{
+var ev=(d.events||[]).reverse(),t0=ev.length?Date.parse(ev[0].ts):0;
+document.getElementById('timeline').innerHTML='<div class="muted">Session '+esc(sid)+' · '+ev.length+' events</div>'+
+'<div class="frow" style="flex-wrap:wrap;margin-bottom:14px">'+ev.map(e=>'<span class="card" style="padding:6px 10px;font-size:12px">+'+
+Math.round((Date.parse(e.ts)-t0)/1000)+'s · <b>'+esc(e.event_type)+'</b> '+esc(e.page)+
+(e.scroll_depth!=null?' '+e.scroll_depth+'%':'')+'</span>').join('')+'</div>'})}
 function load(){
 var f=document.getElementById('from').value,t=document.getElementById('to').value;
 fetch('/api/admin/stats?from='+f+'&to='+t,{credentials:'same-origin'})
 .then(r=>r.json()).then(d=>{
-document.getElementById('warn').textContent=d.db_ready?'':'⚠ Analytics database not connected — set DATABASE_URL.';
-var T=d.totals||{};
+var I=d.ingest||{};
+document.getElementById('warn').textContent=(d.db_ready?'':'⚠ Analytics database not connected — set DATABASE_URL. ')+
+((I.dropped||I.sampled)?'Under load since restart: '+(I.sampled||0)+' scroll/nav events sampled out, '+(I.dropped||0)+' dropped.':'');
+var T=d.totals||{},S=d.sessions||{};
 document.getElementById('cards').innerHTML=
 card('Unique visitors',T.visitors)+card('Sessions',T.sessions)+
-card('Pageviews',T.pageviews)+card('Leads (form submits)',T.leads);
-var fn=d.funnel||[],max=Math.max(1,fn.length?fn[0].count:1),h='';
-fn.forEach(s=>{var w=Math.round(s.count/max*100);
-h+='<div class="frow"><div class="fname">'+esc(s.step)+'</div>'+
-'<div class="ftrack"><div class="ffill" style="width:'+w+'%"></div>'+
-'<span class="fval">'+s.count+'</span></div>'+
-'<div class="fmeta">'+s.of_landing_pct+'% of landing'+
-(s.drop_from_prev_pct>0?' · <span class="drop">−'+s.drop_from_prev_pct+'%</span>':'')+
-'</div></div>'});
-document.getElementById('funnel').innerHTML=h;
+card('Pageviews',T.pageviews)+card('Leads (form submits)',T.leads)+
+card('Bounce rate',(S.bounce_rate||0)+'%')+card('Avg. session',dur(S.avg_duration_s||0));
+var sel=document.getElementById('fsel'),cur=sel.value;FN=d.funnels||[];
+sel.innerHTML=FN.map(f=>'<option value="'+esc(f.id)+'">'+esc(f.label)+'</option>').join('');
+if(FN.some(f=>f.id==cur))sel.value=cur;
+funnel();
 var ts=d.timeseries||[],n=ts.length,mx=Math.max(1,...ts.map(x=>x.visitors||0));
-var bw=n?600/n:600,sv='';
-ts.forEach((x,i)=>{var bh=(x.visitors||0)/mx*80;
-sv+='<rect x="'+(i*bw+1)+'" y="'+(85-bh)+'" width="'+Math.max(1,bw-2)+
-'" height="'+bh+'" fill="#3B82F6" rx="1"></rect>'});
+var hr=d.granularity=='hour',unit=hr?'hour':'day',t0=Date.parse(d.range.from);
+var slots=hr?((Date.parse(d.range.to)-t0)/864e5+1)*24:n,bw=slots?600/slots:600,sv='';
+ts.forEach((x,i)=>{var bh=(x.visitors||0)/mx*80,j=hr?(Date.parse(x.day)-t0)/864e5*24+x.hour:i;
+sv+='<rect x="'+(j*bw+1)+'" y="'+(85-bh)+'" width="'+Math.max(1,bw-2)+
+'" height="'+bh+'" fill="#3B82F6" rx="1"><title>'+x.day+(hr?' '+x.hour+':00':'')+' · '+
+(x.visitors||0)+'</title></rect>'});
 document.getElementById('ts').innerHTML=sv;
-document.getElementById('tslab').textContent=n?(ts[0].day+' → '+ts[n-1].day+
-'  ·  peak '+mx+' visitors/day'):'No data yet';
+document.getElementById('tsh').textContent='Unique visitors / '+(hr?'hour (UTC)':'day');
+document.getElementById('tslab').textContent=n?(ts[0].day+(hr?' '+ts[0].hour+':00':'')+' → '+
+ts[n-1].day+(hr?' '+ts[n-1].hour+':00':'')+'  ·  peak '+mx+' visitors/'+unit):'No data yet';
 tbl('pages',d.top_pages,['Page','Views']);
+tbl('sections',d.sections,['Section','Views']);
+var go=d.goals||[],gh='<tr><th>Goal</th><th>Rate</th><th>Sessions</th></tr>';
+go.forEach(g=>{gh+='<tr><td>'+esc(g.label)+'</td><td>'+g.rate+'%</td><td>'+g.count+'</td></tr>'});
+document.getElementById('goals').innerHTML=go.length?gh:'<tr><td class="muted">No goals defined</td></tr>';
+var en=d.entry_pages||[],eh='<tr><th>Entry page</th><th>Bounce</th><th>Sessions</th></tr>';
+en.forEach(r=>{eh+='<tr><td>'+esc(r.label)+'</td><td>'+r.bounce_rate+'%</td><td>'+r.sessions+'</td></tr>'});
+document.getElementById('entries').innerHTML=en.length?eh:'<tr><td class="muted">No data yet</td></tr>';
 tbl('sources',d.sources,['Referrer','Views']);
 tbl('devices',d.devices,['Device','Views']);
 tbl('countries',d.countries,['Country','Views']);
 tbl('languages',d.languages,['Language','Views']);
+var tm=d.timings_ms||{};
+document.getElementById('timing').textContent=Object.keys(tm).map(k=>k+' '+tm[k]+' ms').join(' · ');
 }).catch(e=>{document.getElementById('warn').textContent='Failed to load stats: '+e})}
+var FN=[];
+function funnel(){
+var id=document.getElementById('fsel').value,f=FN.find(x=>x.id==id)||FN[0]||{},
+fn=f.steps||[],max=Math.max(1,fn.length?fn[0].count:1),h='';
+fn.forEach(s=>{var w=Math.round(s.count/max*100);
+h+='<div class="frow"><div class="fname">'+esc(s.step)+'</div>'+
+'<div class="ftrack"><div class="ffill" style="width:'+w+'%"></div>'+
+'<span class="fval">'+s.count+'</span></div>'+
+'<div class="fmeta">'+s.of_landing_pct+'% of first step'+
+(s.drop_from_prev_pct>0?' · <span class="drop">−'+s.drop_from_prev_pct+'%</span>':'')+
+'</div></div>'});
+document.getElementById('funnel').innerHTML=h}
+function paths(){
+fetch('/api/admin/paths?from='+document.getElementById('from').value+'&to='+document.getElementById('to').value,
+{credentials:'same-origin'}).then(r=>r.json()).then(d=>{
+var tr=d.transitions||[],h='<tr><th>From</th><th>To</th><th>Times</th></tr>';
+tr.forEach(e=>{h+='<tr><td>'+esc(e.from)+'</td><td>→ '+esc(e.to)+'</td><td>'+e.count+'</td></tr>'});
+document.getElementById('paths').innerHTML=tr.length?h:'<tr><td class="muted">No data yet</td></tr>';
+var ex=d.exit_pages||[],xh='<tr><th>Exit page</th><th>Sessions</th></tr>';
+ex.forEach(r=>{xh+='<tr><td>'+esc(r.label)+'</td><td>'+r.sessions+'</td></tr>'});
+document.getElementById('exits').innerHTML=ex.length?xh:'<tr><td class="muted">No data yet</td></tr>'})}
+function live(){
+var es=new EventSource('/api/admin/live');
+es.onmessage=e=>{var d=JSON.parse(e.data),m=r=>(r||[]).map(x=>({label:x.label,hits:x.visitors}));
+document.getElementById('live').textContent=d.active_visitors;
+document.getElementById('livelab').textContent='active visitors · last '+Math.round(d.window_s/60)+' min';
+tbl('livepages',m(d.pages),['Current page','Visitors']);
+tbl('liverefs',m(d.referrers),['Referrer','Visitors'])};
+es.onerror=()=>{document.getElementById('livelab').textContent='reconnecting…'}}
+function dur(s){return s<60?s+'s':Math.floor(s/60)+'m '+(s%60)+'s'}
 function card(k,v){return '<div class="card"><div class="k">'+k+
 '</div><div class="v">'+(v==null?0:v)+'</div></div>'}
 (function(){var t=new Date(),f=new Date(Date.now()-29*864e5);
 document.getElementById('to').value=t.toISOString().slice(0,10);
-document.getElementById('from').value=f.toISOString().slice(0,10);load()})();
+document.getElementById('from').value=f.toISOString().slice(0,10);load();paths();events();live()})();
 </script></body></html>"""
 
 
@@ -626,6 +989,11 @@ async def admin_page(_: bool = Depends(_require_admin)):
     return HTMLResponse(_ADMIN_HTML)
 
 
+# Added last so it wraps every middleware above (including cache_control).
+# ANALYTICS_FAST_TRACK=0 falls back to the FastAPI /api/track routes.
+if os.getenv("ANALYTICS_FAST_TRACK", "1") != "0":
+    app.add_middleware(TrackFastPath)
+
 # Mount frontend files LAST so it never overrides the API/SEO routes above.
 app.mount("/", StaticFiles(directory=str(FRONTEND_DIR), html=True), name="frontend")
 
@@ -0,0 +1,89 @@
+"""Page registry of the site and the page classes analytics groups it by.
+
+PAGES drives what main.py serves and links. page_class() maps a tracked path
+(location.pathname) to one of PAGE_CLASSES; analytics stores it on every event
+at ingest, so the funnel and section breakdowns filter on equality instead of
+matching path substrings.
+"""
+from typing import Optional
+
+# Canonical page set: (path, filename, lang, page_type). main.py serves and
+# links these (sitemap, hreflang); page_class() below classifies them.
+PAGES = [
+    ("/", "index_es.html", "es", "home"),
+    ("/index_v5.html", "index_v5.html", "en", "home"),
+    ("/portfolio.html", "portfolio.html", "en", "portfolio"),
+    ("/portfolio_es.html", "portfolio_es.html", "es", "portfolio"),
+    ("/process.html", "process.html", "en", "process"),
+    ("/process_es.html", "process_es.html", "es", "process"),
+    # Industry landing pages + blog (EN + ES; same page_type per slug so the
+    # sitemap emits the en/es hreflang cluster).
+    ("/web-design-dental-clinics.html", "web-design-dental-clinics.html", "en", "v-dental"),
+    ("/web-design-dental-clinics-es.html", "web-design-dental-clinics-es.html", "es", "v-dental"),
+    ("/web-design-restaurants.html", "web-design-restaurants.html", "en", "v-restaurants"),
+    ("/web-design-restaurants-es.html", "web-design-restaurants-es.html", "es", "v-restaurants"),
+    ("/web-design-real-estate.html", "web-design-real-estate.html", "en", "v-realestate"),
+    ("/web-design-real-estate-es.html", "web-design-real-estate-es.html", "es", "v-realestate"),
+    ("/web-design-aesthetic-clinics.html", "web-design-aesthetic-clinics.html", "en", "v-aesthetic"),
+    ("/web-design-aesthetic-clinics-es.html", "web-design-aesthetic-clinics-es.html", "es", "v-aesthetic"),
+    ("/web-design-architecture-studios.html", "web-design-architecture-studios.html", "en", "v-architecture"),
+    ("/web-design-architecture-studios-es.html", "web-design-architecture-studios-es.html", "es", "v-architecture"),
+    ("/blog.html", "blog.html", "en", "blog"),
+    ("/blog-es.html", "blog-es.html", "es", "blog"),
+    ("/how-much-does-a-website-cost-spain.html", "how-much-does-a-website-cost-spain.html", "en", "post-cost"),
+    ("/how-much-does-a-website-cost-spain-es.html", "how-much-does-a-website-cost-spain-es.html", "es", "post-cost"),
+    ("/how-to-choose-a-web-designer.html", "how-to-choose-a-web-designer.html", "en", "post-choose"),
+    ("/how-to-choose-a-web-designer-es.html", "how-to-choose-a-web-designer-es.html", "es", "post-choose"),
+    # Case studies (EN + es per slug -> en/es hreflang cluster)
+    ("/case-selbstentdeckung.html", "case-selbstentdeckung.html", "en", "case-selbstentdeckung"),
+    ("/case-selbstentdeckung-es.html", "case-selbstentdeckung-es.html", "es", "case-selbstentdeckung"),
+    ("/case-anna-romeo.html", "case-anna-romeo.html", "en", "case-anna-romeo"),
+    ("/case-anna-romeo-es.html", "case-anna-romeo-es.html", "es", "case-anna-romeo"),
+    # Legal pages
+    ("/privacy.html", "privacy.html", "en", "legal-privacy"),
+    ("/privacy-es.html", "privacy-es.html", "es", "legal-privacy"),
+    ("/terms.html", "terms.html", "en", "legal-terms"),
+    ("/terms-es.html", "terms-es.html", "es", "legal-terms"),
+    # Case studies (en + es per case)
+    ("/case-proadikt.html", "case-proadikt.html", "en", "case-proadikt"),
+    ("/case-proadikt-es.html", "case-proadikt-es.html", "es", "case-proadikt"),
+]
+
+PAGE_CLASSES = ("home", "portfolio", "process", "example", "vertical", "blog",
+                "case", "legal", "other")
+# page_type -> class, by prefix; the remaining types are classes themselves.
+_TYPE_PREFIXES = (("v-", "vertical"), ("post-", "blog"), ("case-", "case"),
+                  ("legal-", "legal"))
+
+
+def _class_of_type(page_type: str) -> str:
+    for prefix, cls in _TYPE_PREFIXES:
+        if page_type.startswith(prefix):
+            return cls
+    return page_type if page_type in PAGE_CLASSES else "other"
+
+
+_BY_PATH = {path: _class_of_type(t) for path, _f, _lg, t in PAGES}
+_TYPE_BY_PATH = {path: t for path, _f, _lg, t in PAGES}
+
+
+def page_type(path: Optional[str]) -> Optional[str]:
+    """Registry page_type of a tracked page path (e.g. "v-dental"); None for
+    pages outside PAGES."""
+    if not path:
+        return None
+    path = path.split("?", 1)[0].split("#", 1)[0]
+    return _TYPE_BY_PATH.get(path) or _TYPE_BY_PATH.get(path + ".html")
+
+
+def page_class(path: Optional[str]) -> Optional[str]:
+    """Class of a tracked page path; None without a path."""
+    if not path:
+        return None
+    path = path.split("?", 1)[0].split("#", 1)[0]
+    cls = _BY_PATH.get(path) or _BY_PATH.get(path + ".html")
+    if cls:
+        return cls
+    if "/examples/" in path:  # demo sites, /examples/... and /<lang>/examples/...
+        return "example"
+    return "other"
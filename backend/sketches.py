@@ -0,0 +1,152 @@
+"""Sketches for the dashboard: HyperLogLog for distinct counts, Space-Saving
+for top values.
+
+One sketch per (day, kind) is kept in the analytics DB (see analytics.py) and
+multi-day ranges are answered by merging the daily sketches, so the cost of a
+uniques query depends on the number of days, not on the number of events.
+
+Registers are one byte each and stored as a plain bytes blob (BLOB/BYTEA), so
+no DB extension is needed. With P = 12 (4096 registers, 4 KiB per sketch) the
+relative standard error is 1.04 / sqrt(4096) ~= 1.6%, i.e. estimates are
+within ~3.2% of the true count 95% of the time. Small counts (below ~10k) use
+linear counting and are near exact.
+
+TopK keeps the `k` heaviest values of a stream in O(k) memory whatever the
+number of distinct values (Space-Saving): a new value past capacity takes
+over the smallest counter and inherits its count as error. Every value
+whose true count exceeds total/k is kept, counts are overestimated by at
+most the smallest counter, and with at most `k` distinct values it is exact.
+Summaries merge by adding counts, a value missing from a full summary
+counting that summary's smallest counter, which keeps those guarantees: per-
+batch summaries fold into the per-day ones and per-day ones answer any range.
+"""
+from __future__ import annotations
+
+import collections
+import hashlib
+import heapq
+import json
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+P = 12
+M = 1 << P
+_ALPHA = 0.7213 / (1 + 1.079 / M)
+_HIGH = int.from_bytes(b"\x80" * M, "big")  # top bit of every register
+_INV_POW2 = [2.0 ** -r for r in range(65)]
+
+
+class HLL:
+    __slots__ = ("regs",)
+
+    def __init__(self, regs: bytes = b""):
+        self.regs = bytearray(regs) if regs else bytearray(M)
+
+    def add(self, item: str) -> None:
+        x = int.from_bytes(
+            hashlib.blake2b(item.encode(), digest_size=8).digest(), "big"
+        )
+        i = x >> (64 - P)
+        rank = (64 - P) - (x & ((1 << (64 - P)) - 1)).bit_length() + 1
+        if rank > self.regs[i]:
+            self.regs[i] = rank
+
+    @classmethod
+    def union(cls, blobs: Iterable[bytes]) -> "HLL":
+        """Register-wise max of many sketches.
+
+        Done on the registers packed into one big int (SWAR): per byte,
+        (a | 0x80) - b keeps the top bit iff a >= b (registers are < 0x80 so
+        nothing borrows across bytes), which becomes a 0x00/0xff select mask.
+        """
+        acc = 0
+        for blob in blobs:
+            b = int.from_bytes(blob, "big")
+            ge = (((acc | _HIGH) - b) & _HIGH) >> 7
+            mask = (ge << 8) - ge
+            acc = (acc & mask) | (b & ~mask)
+        return cls(acc.to_bytes(M, "big"))
+
+    def count(self) -> int:
+        hist = collections.Counter(self.regs)
+        est = _ALPHA * M * M / sum(n * _INV_POW2[r] for r, n in hist.items())
+        zeros = hist.get(0, 0)
+        if est <= 2.5 * M and zeros:
+            est = M * math.log(M / zeros)  # linear counting for small ranges
+        return int(round(est))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.regs)
+
+
+class TopK:
+    """Space-Saving summary: value -> [count, error] for at most k values."""
+
+    __slots__ = ("k", "counters", "_heap")
+
+    def __init__(self, k: int = 200, counters: Optional[Dict[str, List[int]]] = None):
+        self.k = k
+        self.counters: Dict[str, List[int]] = counters or {}
+        # (count, value) entries, stale ones skipped on pop: finding the
+        # smallest counter is O(log k) instead of a scan
+        self._heap = [(c, v) for v, (c, _) in self.counters.items()]
+        heapq.heapify(self._heap)
+
+    def add(self, value: str, n: int = 1) -> None:
+        c = self.counters.get(value)
+        if c is not None:
+            c[0] += n
+        elif len(self.counters) < self.k:
+            c = self.counters[value] = [n, 0]
+        else:
+            while True:
+                low, victim = heapq.heappop(self._heap)
+                if self.counters.get(victim, (None,))[0] == low:
+                    break
+            del self.counters[victim]
+            c = self.counters[value] = [low + n, low]
+        heapq.heappush(self._heap, (c[0], value))
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(c, v) for v, (c, _) in self.counters.items()]
+            heapq.heapify(self._heap)
+
+    @classmethod
+    def merge(cls, summaries: Iterable["TopK"], k: Optional[int] = None) -> "TopK":
+        """Counter-wise sum, keeping the k largest. A value missing from a full
+        summary counts that summary's smallest counter (the most it can have
+        had there); a plain sum would rank a steady value that one summary
+        evicted below values seen once."""
+        summaries = list(summaries)
+        floors = [
+            min(c for c, _ in s.counters.values()) if len(s.counters) >= s.k else 0
+            for s in summaries
+        ]
+        acc: Dict[str, List[int]] = {}
+        for s in summaries:
+            for v in s.counters:
+                acc.setdefault(v, [0, 0])
+        for s, floor in zip(summaries, floors):
+            for v, a in acc.items():
+                c = s.counters.get(v)
+                if c is None:
+                    a[0] += floor
+                    a[1] += floor
+                else:
+                    a[0] += c[0]
+                    a[1] += c[1]
+        k = k or max((s.k for s in summaries), default=0) or 200
+        kept = heapq.nlargest(k, acc.items(), key=lambda kv: (kv[1][0], kv[0]))
+        return cls(k, {v: c for v, c in kept})
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+        """The n heaviest (value, count), ties by value."""
+        ranked = sorted(self.counters.items(), key=lambda kv: (-kv[1][0], kv[0]))
+        return [(v, c) for v, (c, _) in ranked[:n]]
+
+    def to_json(self) -> str:
+        return json.dumps([[v, c, e] for v, (c, e) in self.counters.items()],
+                          separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, data: str, k: int = 200) -> "TopK":
+        return cls(k, {v: [c, e] for v, c, e in json.loads(data)})
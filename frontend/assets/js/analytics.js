@@ -3,7 +3,11 @@
 (function () {
   "use strict";
   try {
-    var ENDPOINT = "/api/track";
+    /* Events are coalesced and flushed as one beacon when the page is hidden,
+       after a short idle pause, or when the buffer fills up. Each carries
+       age_ms (capture to send), so the server dates it when it happened. */
+    var ENDPOINT = "/api/track/batch";
+    var IDLE_MS = 3000, MAX_BUFFER = 20;
 
     function sid() {
       try {
@@ -15,33 +19,59 @@
           sessionStorage.setItem(k, v);
         }
         return v;
-      } catch (e) { return "nostore"; }
+      } catch (e) {  /* no storage: one session per page load */
+        return "s-" + Date.now() + "-" + Math.random().toString(16).slice(2);
+      }
     }
 
     var SESSION = sid();
     var LANG = (document.documentElement.getAttribute("lang") || "").slice(0, 8);
 
+    var buffer = [], idle = null;
+
+    function flush() {
+      if (idle) { clearTimeout(idle); idle = null; }
+      if (!buffer.length) return;
+      try {
+        var now = Date.now();
+        for (var i = 0; i < buffer.length; i++) {
+          buffer[i].age_ms = Math.max(0, now - buffer[i].age_ms);
+        }
+        var body = JSON.stringify(buffer);
+        buffer = [];
+        if (navigator.sendBeacon
+            && navigator.sendBeacon(ENDPOINT, new Blob([body], { type: "application/json" }))) {
+          return;
+        }
+        fetch(ENDPOINT, {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: body, keepalive: true
+        });
+      } catch (e) { /* analytics must never break the page */ }
+    }
+
     function send(type, extra) {
       try {
-        var body = JSON.stringify(Object.assign({
+        buffer.push(Object.assign({
           event_type: type,
           session_id: SESSION,
           page: location.pathname,
           lang: LANG,
-          referrer: document.referrer || ""
+          referrer: document.referrer || "",
+          age_ms: Date.now()  /* capture time until flush() turns it into an age */
         }, extra || {}));
-        if (navigator.sendBeacon) {
-          navigator.sendBeacon(ENDPOINT, new Blob([body], { type: "application/json" }));
-        } else {
-          fetch(ENDPOINT, {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: body, keepalive: true
-          });
-        }
+        if (buffer.length >= MAX_BUFFER) { flush(); return; }
+        if (idle) clearTimeout(idle);
+        idle = setTimeout(flush, IDLE_MS);
       } catch (e) { /* analytics must never break the page */ }
     }
 
+    document.addEventListener("visibilitychange", function () {
+      if (document.visibilityState === "hidden") flush();
+    });
+    window.addEventListener("pagehide", flush);
+
     /* pageview */
     send("pageview");
 
@@ -64,13 +94,15 @@
     }
     window.addEventListener("scroll", throttled, { passive: true });
 
-    /* delegated clicks: CTA to contact + navigation to work pages */
+    /* delegated clicks: CTAs (contact, WhatsApp) + navigation to work pages */
     document.addEventListener("click", function (e) {
       var a = e.target && e.target.closest ? e.target.closest("a[href]") : null;
       if (!a) return;
       var href = a.getAttribute("href") || "";
       if (href.indexOf("#contact") !== -1) {
-        send("cta_click", { meta: { href: href } });
+        send("cta_click", { meta: { href: href, cta: "contact" } });
+      } else if (/^https?:\/\/(wa\.me|api\.whatsapp\.com)\//.test(href)) {
+        send("cta_click", { meta: { href: href, cta: "whatsapp" } });
       } else if (/(?:^|\/)(portfolio|process)(_es|_ka)?\.html/.test(href)
                  || /(?:^|\/)examples\//.test(href)) {
         send("nav_click", { meta: { href: href } });
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""Columnar (NumPy) engine vs. SQL over raw events: parity + timings.
+
+For each size, fills a throwaway SQLite file with synthetic events (90 days,
+realistic event mix), then answers totals, funnel, timeseries and five
+breakdowns twice:
+  sql      = exact GROUP BY / COUNT(DISTINCT) queries over `events`
+  columnar = backend/columnar.py (load once, then vectorised reads)
+and checks both give identical results. A small run through AnalyticsDB also
+checks ColumnarEngine.load() against the rollup/sketch reads (exact for hits,
+within the HyperLogLog error for uniques).
+
+The speedup is against raw-event SQL. The dashboard itself reads per-day
+rollups, not raw events, and does not use the columnar engine.
+
+Needs numpy.  Usage:  python3 scripts/bench_columnar.py [events ...]
+(default 1000000 10000000)
+"""
+import asyncio
+import datetime as dt
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+os.environ.setdefault("ANALYTICS_SPOOL", "")
+
+import analytics as an  # noqa: E402
+from pages import page_class  # noqa: E402
+from columnar import ColumnarEngine  # noqa: E402
+
+DIMS = ("page", "referrer_host", "device", "country", "lang")
+D0, D1 = "2025-01-01", "2025-03-31"
+PAGES = ["/", "/portfolio.html", "/process.html", "/blog.html", "/contact.html",
+         "/en/examples/dental.html", "/web-design-dental-clinics.html"] + \
+        [f"/blog/post-{i}.html" for i in range(40)]
+REFS = [None, None, "google.com", "bing.com", "instagram.com", "linkedin.com"]
+TYPES = ["pageview"] * 6 + ["scroll"] * 3 + ["nav_click"] * 2 + ["form_view", "form_submit"]
+
+SQL = {
+    "totals": """SELECT COUNT(DISTINCT visitor_hash) AS visitors,
+      COUNT(DISTINCT session_id) AS sessions,
+      SUM(CASE WHEN event_type='pageview' THEN COALESCE(weight, 1) ELSE 0 END) AS pageviews,
+      SUM(CASE WHEN event_type='form_submit' THEN COALESCE(weight, 1) ELSE 0 END) AS leads
+      FROM events WHERE day BETWEEN ? AND ?""",
+    "funnel": """SELECT COUNT(DISTINCT session_id) AS landing,
+      COUNT(DISTINCT CASE WHEN event_type='scroll' AND scroll_depth>=50 THEN session_id END) AS scrolled,
+      COUNT(DISTINCT CASE WHEN event_type='nav_click' OR (event_type='pageview'
+        AND page_class IN ('portfolio', 'process', 'example')) THEN session_id END) AS explored,
+      COUNT(DISTINCT CASE WHEN event_type='form_view' THEN session_id END) AS form_view,
+      COUNT(DISTINCT CASE WHEN event_type='form_submit' THEN session_id END) AS form_submit
+      FROM events WHERE day BETWEEN ? AND ?""",
+    "timeseries": """SELECT day, COUNT(DISTINCT visitor_hash) AS visitors,
+      SUM(CASE WHEN event_type='pageview' THEN COALESCE(weight, 1) ELSE 0 END) AS pageviews
+      FROM events WHERE day BETWEEN ? AND ? GROUP BY day ORDER BY day""",
+    "breakdown": """SELECT COALESCE({col}, 'direct') AS label, SUM(COALESCE(weight, 1)) AS hits
+      FROM events WHERE event_type='pageview' AND day BETWEEN ? AND ?
+      GROUP BY COALESCE({col}, 'direct') ORDER BY hits DESC, label LIMIT 12""",
+}
+
+
+def events(n: int, seed: int = 7):
+    rnd = random.Random(seed)
+    base = dt.date(2025, 1, 1)
+    for i in range(n):
+        day = (base + dt.timedelta(days=rnd.randrange(90))).isoformat()
+        sess = rnd.randrange(n // 8 + 1)
+        et = rnd.choice(TYPES)
+        page = rnd.choice(PAGES)
+        yield (
+            day + "T12:00:00Z", day, et, f"s{sess}", f"v{sess // 2}",
+            page, rnd.choice(["es", "en", None]), rnd.choice(REFS),
+            None, rnd.choice(["mobile", "desktop", "tablet"]),
+            rnd.choice(["ES", "GB", "DE", None]),
+            rnd.choice([25, 50, 75, 100]) if et == "scroll" else None, None,
+            rnd.choice([None] * 9 + [10]), page_class(page),
+        )
+
+
+def sql_reads(con: sqlite3.Connection):
+    con.row_factory = sqlite3.Row
+    one = lambda sql: {k: int(v or 0) for k, v in dict(con.execute(sql, (D0, D1)).fetchone()).items()}
+    return {
+        "totals": one(SQL["totals"]),
+        "funnel": one(SQL["funnel"]),
+        "timeseries": [dict(r) for r in con.execute(SQL["timeseries"], (D0, D1))],
+        "breakdowns": {d: [dict(r) for r in con.execute(SQL["breakdown"].format(col=d), (D0, D1))]
+                       for d in DIMS},
+    }
+
+
+def columnar_reads(eng: ColumnarEngine):
+    return {
+        "totals": eng.totals(D0, D1),
+        "funnel": eng.funnel(D0, D1),
+        "timeseries": eng.timeseries(D0, D1),
+        "breakdowns": eng.breakdowns(DIMS, D0, D1),
+    }
+
+
+def bench(n: int, tmp: str) -> None:
+    path = os.path.join(tmp, f"bench{n}.db")
+    con = sqlite3.connect(path)
+    con.executescript(an._SCHEMA_SQLITE)
+    con.execute("CREATE INDEX idx_events_day ON events(day)")
+    t = time.perf_counter()
+    con.executemany(an._INSERT, events(n))
+    con.commit()
+    print(f"{n:>12,} events   (generated + inserted in {time.perf_counter() - t:.1f}s)")
+
+    t = time.perf_counter()
+    sql = sql_reads(con)
+    t_sql = time.perf_counter() - t
+
+    t = time.perf_counter()
+    con.row_factory = None
+    cur = con.execute(f"SELECT {', '.join(an._COLUMNS)} FROM events WHERE day BETWEEN ? AND ?", (D0, D1))
+    eng = ColumnarEngine()
+    while True:
+        rows = cur.fetchmany(50000)
+        if not rows:
+            break
+        eng.extend(rows)
+    eng.finish()
+    t_load = time.perf_counter() - t
+    t = time.perf_counter()
+    col = columnar_reads(eng)
+    t_col = time.perf_counter() - t
+    con.close()
+
+    ok = col == sql
+    print(f"  sql (all panels)        {t_sql * 1000:>10.0f} ms")
+    print(f"  columnar load           {t_load * 1000:>10.0f} ms")
+    print(f"  columnar (all panels)   {t_col * 1000:>10.0f} ms   {t_sql / t_col:>6.1f}x vs sql")
+    print(f"  parity                  {'OK' if ok else 'MISMATCH'}")
+    if not ok:
+        for k in sql:
+            if sql[k] != col[k]:
+                print(f"    {k}: sql={str(sql[k])[:200]}\n    {k}: col={str(col[k])[:200]}")
+        sys.exit(1)
+
+
+async def db_parity(tmp: str) -> None:
+    db = an.AnalyticsDB("sqlite://" + os.path.join(tmp, "parity.db"))
+    await db.connect()
+    rows = list(events(20000, seed=3))
+    for i in range(0, len(rows), 500):
+        assert await db._write_events(rows[i:i + 500])
+    eng = await ColumnarEngine.load(db, D0, D1)
+    got = {"totals": await db.totals(D0, D1), "funnel": await db.funnel(D0, D1),
+           "breakdowns": await db.breakdowns(DIMS, D0, D1)}
+    await db.close()
+    exp = columnar_reads(eng)
+    exact = got["breakdowns"] == exp["breakdowns"] and all(
+        got["totals"][k] == exp["totals"][k] for k in ("pageviews", "leads"))
+    worst = max(abs(got[g][k] - exp[g][k]) / max(1, exp[g][k])
+                for g in ("totals", "funnel") for k in exp[g])
+    print(f"AnalyticsDB vs ColumnarEngine.load() (20,000 events): hits "
+          f"{'OK' if exact else 'MISMATCH'}, uniques worst error {worst:.2%}")
+    if not exact or worst > 0.05:
+        sys.exit(1)
+
+
+def main() -> None:
+    sizes = [int(float(a)) for a in sys.argv[1:]] or [1_000_000, 10_000_000]
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(db_parity(tmp))
+        for n in sizes:
+            bench(n, tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Requests/sec for POST /api/track: raw-ASGI fast path vs. the full stack.
+
+Drives backend/main.py's ASGI app in-process (no sockets, no extra deps) with
+a throwaway SQLite DB. Each mode runs in its own interpreter because the fast
+path is wired at import time:
+  after  = TrackFastPath (default)
+  before = ANALYTICS_FAST_TRACK=0 -> Brotli + CORS + cache_control + FastAPI
+           routing + pydantic TrackEvent
+Usage:  python3 scripts/bench_track.py [requests]   (default 20000)
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BODY = json.dumps({
+    "event_type": "pageview", "session_id": "7f7c6f0e-3d3b-4b8e-9a57-0c1f2d3e4f5a",
+    "page": "/web-design-dental-clinics.html", "lang": "en",
+    "referrer": "https://www.google.com/",
+}).encode()
+
+
+async def _run(n: int) -> float:
+    sys.path.insert(0, os.path.join(ROOT, "backend"))
+    import main
+
+    await main.analytics_db.connect()
+    app = main.app
+
+    async def one(i: int) -> None:
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if sent:
+                return {"type": "http.disconnect"}
+            sent = True
+            return {"type": "http.request", "body": BODY, "more_body": False}
+
+        async def send(msg):
+            if msg["type"] == "http.response.start":
+                assert msg["status"] == 204, msg
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": "POST", "scheme": "https", "path": "/api/track",
+            "raw_path": b"/api/track", "root_path": "", "query_string": b"",
+            "client": ("127.0.0.1", 50000), "server": ("testserver", 443),
+            "headers": [
+                (b"host", b"testserver"),
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(BODY)).encode()),
+                (b"user-agent", b"Mozilla/5.0 (iPhone; CPU iPhone OS 17_0)"),
+                (b"accept-encoding", b"gzip, br"),
+                # one IP per 50 requests keeps the per-IP rate limit out of the way
+                (b"x-forwarded-for", f"10.{i // 12500 % 256}.{i // 50 % 250}.1".encode()),
+            ],
+        }
+        await app(scope, receive, send)
+
+    for i in range(min(n, 500)):  # warm-up
+        await one(i)
+    t0 = time.perf_counter()
+    for i in range(n):
+        await one(i)
+    dt = time.perf_counter() - t0
+    await main.analytics_db.close()
+    return n / dt
+
+
+def main() -> None:
+    if len(sys.argv) > 2 and sys.argv[1] == "--child":
+        print(f"{asyncio.run(_run(int(sys.argv[2]))):.0f}")
+        return
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, fast in (("before (full stack)", "0"), ("after (fast path)", "1")):
+            env = dict(os.environ, ANALYTICS_FAST_TRACK=fast,
+                       DATABASE_URL="sqlite://" + os.path.join(tmp, f"bench{fast}.db"),
+                       ANALYTICS_SPOOL="")
+            out = subprocess.run(
+                [sys.executable, __file__, "--child", str(n)], env=env,
+                capture_output=True, text=True, check=True,
+            ).stdout
+            results[label] = float(out.strip().splitlines()[-1])
+            print(f"  {label:22s} {results[label]:>9,.0f} req/s")
+    before, after = results.values()
+    print(f"  speed-up               {after / before:>9.2f}x")
+
+
+if __name__ == "__main__":
+    print("POST /api/track, in-process ASGI:")
+    main()
@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+import time
+
+# The backend modules import each other as top-level modules (see main.py).
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "backend"))
+os.environ.setdefault("ANALYTICS_SPOOL", "")
+# For the app (main.py), which opens its DB at import.
+os.environ["DATABASE_URL"] = "sqlite://" + os.path.join(tempfile.mkdtemp(), "analytics.db")
+os.environ["ADMIN_PASSWORD"] = "test"
+ADMIN = ("admin", "test")
+
+import pytest  # noqa: E402
+
+import analytics as an  # noqa: E402
+
+
+def event(day, event_type="pageview", session="s", page="/", referrer=None, **kw):
+    """A stored event row (analytics.EVENT_COLUMNS order)."""
+    row = dict.fromkeys(an.EVENT_COLUMNS)
+    row.update(ts=f"{day}T10:00:00Z", day=day, event_type=event_type, session_id=session,
+               visitor_hash="v" + session, page=page, referrer_host=referrer,
+               device="desktop", page_class="home", **kw)
+    return tuple(row[c] for c in an.EVENT_COLUMNS)
+
+
+@pytest.fixture
+def sqlite_url(tmp_path):
+    return "sqlite://" + str(tmp_path / "analytics.db")
+
+
+@pytest.fixture(scope="session")
+def client():
+    """The app with its lifespan running (one per session: the analytics
+    queue is bound to the loop that first uses it)."""
+    from fastapi.testclient import TestClient
+
+    import main
+
+    with TestClient(main.app) as c:
+        yield c
+
+
+def export(client, fmt="ndjson", until=""):
+    """/api/admin/export once its rows contain `until` (the write-behind
+    queue stores events within a second)."""
+    for _ in range(50):
+        r = client.get(f"/api/admin/export?format={fmt}", auth=ADMIN)
+        rows = r.text.partition("\n")[2] if fmt == "csv" else r.text
+        if rows and until in rows:
+            return r
+        time.sleep(0.1)
+    raise AssertionError(f"{until!r} never exported")
@@ -0,0 +1,59 @@
+import asyncio
+
+import analytics as an
+from conftest import event
+
+
+def test_dims_gc_waits_for_a_batch_in_flight(sqlite_url):
+    async def run():
+        db = an.AnalyticsDB(sqlite_url)
+        await db.connect(background=False)
+        try:
+            assert await db._write_events([event("2025-01-01", session="old")])
+            assert await db._write_events([event("2025-01-02", session="new")])
+            # Retention dropped the day "old" was stored on; its id is still
+            # in the writer's cache.
+            await db._exec("DELETE FROM events WHERE day = ?", ("2025-01-01",))
+
+            exec_many = db._exec_many
+
+            async def slow_exec_many(*args):
+                await asyncio.sleep(0.05)  # ids looked up, rows not stored yet
+                return await exec_many(*args)
+
+            db._exec_many = slow_exec_many
+            ok, _ = await asyncio.gather(
+                db._write_events([event("2025-01-03", session="old")]), db._dims_gc(),
+            )
+            assert ok
+            await db._dims_gc()
+            return await db._query(
+                "SELECT COUNT(*) AS n FROM events e LEFT JOIN dims d ON d.id = e.session_id"
+                " WHERE d.id IS NULL"
+            ), await db.iter_events("2025-01-03", "2025-01-03").__anext__()
+        finally:
+            await db.close()
+
+    dangling, rows = asyncio.run(run())
+    assert dangling == [{"n": 0}]
+    assert rows[0][an.EVENT_COLUMNS.index("session_id")] == "old"
+
+
+def test_dims_gc_evicts_deleted_ids_from_the_cache(sqlite_url):
+    async def run():
+        db = an.AnalyticsDB(sqlite_url)
+        await db.connect(background=False)
+        try:
+            assert await db._write_events([event("2025-01-01", session="old")])
+            assert await db._write_events([event("2025-01-02", session="new")])
+            await db._exec("DELETE FROM events WHERE day = ?", ("2025-01-01",))
+            await db._dims_gc()
+            assert db._ids.get(("session_id", "old")) is None
+            assert db._ids.get(("session_id", "new")) is not None
+            assert await db._write_events([event("2025-01-03", session="old")])
+            return await db.iter_events("2025-01-03", "2025-01-03").__anext__()
+        finally:
+            await db.close()
+
+    rows = asyncio.run(run())
+    assert rows[0][an.EVENT_COLUMNS.index("session_id")] == "old"
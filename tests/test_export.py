@@ -0,0 +1,20 @@
+import csv
+import io
+
+from conftest import export
+
+
+def test_csv_export_neutralises_formulas(client):
+    formula = '=HYPERLINK("http://evil.example","x")'
+    client.post("/api/track", json={
+        "event_type": "pageview", "session_id": "csv-formula", "page": "-2+3",
+        "referrer": "https://ref.example/?utm_source=" + formula,
+    })
+    rows = list(csv.DictReader(io.StringIO(export(client, "csv", "csv-formula").text)))
+    ndjson = export(client, until="csv-formula").text
+    row = next(r for r in rows if r["session_id"] == "csv-formula")
+    assert row["utm_source"] == "'" + formula
+    assert row["page"] == "'-2+3"
+    assert row["referrer_host"] == "ref.example"
+    assert row["event_type"] == "pageview"
+    assert '"utm_source": "=HYPERLINK' in ndjson  # JSON is not a spreadsheet
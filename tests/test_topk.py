@@ -0,0 +1,58 @@
+import asyncio
+import random
+
+import analytics as an
+from conftest import event
+from sketches import TopK
+
+
+def test_merge_is_exact_below_capacity():
+    a, b = TopK(10), TopK(10)
+    for v in "aab":
+        a.add(v)
+    for v in "bbc":
+        b.add(v)
+    assert TopK.merge([a, b]).top(3) == [("b", 3), ("a", 2), ("c", 1)]
+
+
+def test_merge_keeps_a_heavy_hitter_seen_once_per_batch():
+    # The day's summary fills with spam before google.com shows up; from then
+    # on each batch has one google.com hit among 150 one-off spam values.
+    random.seed(1)
+    day = TopK(200)
+    google = 0
+    for b in range(1000):
+        batch = TopK(200)
+        if b >= 5:
+            batch.add("google.com")
+            google += 1
+        for _ in range(150):
+            batch.add(f"spam{random.randrange(10**9)}.xyz")
+        day = TopK.merge([batch, day], 200)
+    value, count = day.top(1)[0]
+    assert value == "google.com"
+    assert google <= count <= google + day.counters[value][1]
+
+
+def test_ingest_batches_keep_a_heavy_hitter(sqlite_url, monkeypatch):
+    monkeypatch.setattr(an, "TOPK_CAPACITY", 20)
+    random.seed(2)
+
+    async def run():
+        db = an.AnalyticsDB(sqlite_url)
+        await db.connect(background=False)
+        try:
+            for b in range(60):
+                rows = [event("2025-01-10", session=f"s{b}-{i}",
+                              referrer=f"spam{random.randrange(10**9)}.xyz")
+                        for i in range(30)]
+                if b >= 2:
+                    rows.append(event("2025-01-10", session=f"g{b}", referrer="google.com"))
+                assert await db._write_events(rows)
+            return await db._top_values(("referrer_host",), "2025-01-10", "2025-01-10", 3)
+        finally:
+            await db.close()
+
+    top = asyncio.run(run())["referrer_host"]
+    assert top[0]["label"] == "google.com"
+    assert top[0]["hits"] >= 58
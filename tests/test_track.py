@@ -0,0 +1,38 @@
+import datetime as dt
+import json
+
+import pytest
+
+import main
+from conftest import export
+
+
+def _ts(client, last):
+    rows = [json.loads(line) for line in export(client, until=last).text.splitlines()]
+    return {r["session_id"]: dt.datetime.fromisoformat(r["ts"].rstrip("Z")) for r in rows}
+
+
+@pytest.mark.parametrize("fast_path", [True, False])
+def test_batch_events_are_dated_by_their_age(client, fast_path, monkeypatch):
+    if not fast_path:  # through the FastAPI route instead of TrackFastPath
+        monkeypatch.setattr(main.TrackFastPath, "__call__",
+                            lambda self, scope, receive, send: self.app(scope, receive, send))
+    tag = "fast" if fast_path else "route"
+    before = dt.datetime.utcnow()
+    client.post("/api/track/batch", json=[
+        {"event_type": "pageview", "session_id": f"{tag}-now"},
+        {"event_type": "scroll", "session_id": f"{tag}-old", "scroll_depth": 50,
+         "age_ms": 90_000},
+        {"event_type": "scroll", "session_id": f"{tag}-future", "age_ms": -5000},
+        {"event_type": "scroll", "session_id": f"{tag}-bad", "age_ms": "soon"},
+        {"event_type": "scroll", "session_id": f"{tag}-ancient", "age_ms": 10 ** 12},
+    ])
+    ts = _ts(client, f"{tag}-ancient")
+    after = dt.datetime.utcnow()
+    cap = dt.timedelta(milliseconds=main.TRACK_AGE_MAX_MS)
+    second = dt.timedelta(seconds=1)
+    assert before - second <= ts[f"{tag}-now"] <= after
+    assert before - dt.timedelta(seconds=91) <= ts[f"{tag}-old"] <= after - dt.timedelta(seconds=89)
+    assert before - second <= ts[f"{tag}-future"] <= after  # never dated ahead
+    assert before - cap - second <= ts[f"{tag}-ancient"] <= after - cap
+    assert f"{tag}-bad" not in ts  # invalid like any other field